@@ -30,6 +30,29 @@ def create_app(config_name):
 
 	config[config_name].init_app(app)
 
+	from .models import credentials_cache, instrument_directory, heartbeats
+	from .models import model_registry, row_counts, latest_readings
+
+	credentials_cache.configure(maxsize=app.config['API_CREDENTIALS_CACHE_SIZE'],
+								ttl=app.config['API_CREDENTIALS_CACHE_TTL'])
+	instrument_directory.configure(ttl=app.config['INSTRUMENT_DIRECTORY_TTL'],
+								miss_ttl=app.config['INSTRUMENT_DIRECTORY_MISS_TTL'])
+	row_counts.configure(maxsize=app.config['API_ROW_COUNT_CACHE_SIZE'],
+						ttl=app.config['API_ROW_COUNT_TTL'])
+	latest_readings.configure(maxsize=app.config['API_ROW_COUNT_CACHE_SIZE'],
+						ttl=app.config['LATEST_READING_TTL'])
+	heartbeats.configure(app, interval=app.config['HEARTBEAT_INTERVAL'])
+	model_registry.configure(maxsize=app.config['ML_MODEL_CACHE_SIZE'],
+							mmap_mode=app.config['ML_MODEL_MMAP_MODE'])
+
+	from .ingest import ingest_buffer
+	from .aggregation import rollups
+	from .compression import compressor
+
+	ingest_buffer.init_app(app)
+	rollups.configure(app, interval=app.config['ROLLUP_INTERVAL'])
+	compressor.init_app(app)
+
 	# register static assets
 	js = Bundle(
 		'js/jquery-3.3.1.min.js',
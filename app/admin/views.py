@@ -154,6 +154,55 @@ def user():
 
 	return render_template('admin/edit-user.html', title='User', form=form)
 
+@admin.route('/recalibrate')
+@login_required
+@admin_required
+@confirmation_required
+def recalibrate():
+	"""Recalibrate an instrument's historical data in the background
+	"""
+	from .. import socketio
+	from ..parsers import parse_timestamp
+
+	sn = request.args.get('sn')
+	i = Instrument.query.filter_by(sn=sn).first_or_404()
+
+	try:
+		t0 = parse_timestamp(request.args['t0']) if request.args.get('t0') else None
+		tf = parse_timestamp(request.args['tf']) if request.args.get('tf') else None
+	except ValueError:
+		flash("Invalid time range", 'error')
+
+		return redirect( url_for('admin.instrument', sn=sn) )
+
+	if not any(i.model_ids.values()):
+		flash("{} does not have a calibration model".format(sn), 'error')
+
+		return redirect( url_for('admin.instrument', sn=sn) )
+
+	app = current_app._get_current_object()
+
+	def run(id, username):
+		with app.app_context():
+			instrument = Instrument.query.get(id)
+
+			try:
+				n = instrument.recalibrate(t0=t0, tf=tf)
+
+				instrument.log_event(message='{} values recalibrated by {}'.format(n, username))
+			except Exception as e:
+				db.session.rollback()
+
+				instrument.log_event(message='Recalibration failed: {}'.format(e), level='WARNING')
+			finally:
+				db.session.remove()
+
+	socketio.start_background_task(run, i.id, current_user.username)
+
+	flash("Recalibrating {}; a log entry will be added when it's done.".format(sn), 'info')
+
+	return redirect( url_for('admin.index') )
+
 @admin.route('/model-upload', methods=['GET', 'POST'])
 @admin_required
 @confirmation_required
@@ -180,6 +229,9 @@ def upload_model():
 				db.session.add(new)
 				db.session.commit()
 
+				# Drop this worker's cached copy; others reload when the mtime changes
+				model_registry.invalidate(model_id=new.id, filename=new.filename)
+
 				flash("{} has been uploaded.".format(file.filename), 'info')
 			except Exception as e:
 				print (e)
@@ -286,3 +338,13 @@ def drop_instrument():
 	flash("Instrument has been deleted along with its children :/", 'success')
 
 	return redirect( url_for('admin.index') )
+
+@admin.route('/ingest-stats')
+@login_required
+@admin_required
+def ingest_stats():
+	"""Queue depth and flush latency for this worker's write-behind buffer
+	"""
+	from ..ingest import ingest_buffer
+
+	return jsonify(ingest_buffer.stats())
@@ -0,0 +1,471 @@
+"""Resampling of readings into fixed-width time buckets.
+
+Buckets are aligned to the unix epoch, so a `1d` bucket always runs from
+midnight to midnight UTC. Means, minima, maxima, sums and counts are computed
+by the database on MySQL and SQLite; percentiles (and other databases) are
+computed with pandas from just the columns that are needed.
+
+Hourly and daily buckets are also kept in the `rollup` table, which is updated
+as readings are stored (see `RollupTracker`) so long time ranges can be read
+without scanning the raw data.
+"""
+import atexit
+import datetime
+import threading
+import pandas as pd
+from collections import OrderedDict
+from sqlalchemy import event
+from . import db, sentry, socketio
+from .exceptions import ValidationError
+from .models import Data, MITData, EBamData, TrexData, TrexPMData, Rollup
+from .models import latest_readings
+from .parsers import parse_timestamp
+
+FREQUENCIES = {'10min': 600, '1h': 3600, '1d': 86400}
+
+SQL_AGGREGATES = {
+    'mean': db.func.avg,
+    'min': db.func.min,
+    'max': db.func.max,
+    'count': db.func.count,
+    'sum': db.func.sum,
+}
+
+def p95(values):
+    return values.quantile(.95)
+
+PANDAS_AGGREGATES = {
+    'mean': 'mean',
+    'min': 'min',
+    'max': 'max',
+    'count': 'count',
+    'sum': 'sum',
+    'p95': p95,
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+DATA_MODELS = (Data, MITData, EBamData, TrexData, TrexPMData)
+
+# Bucket widths kept in the rollup table and what can be read back from it
+HOURLY, DAILY = 3600, 86400
+ROLLUP_AGGREGATES = ('mean', 'min', 'max', 'count', 'sum')
+
+def parse_frequency(value):
+    """Return the bucket width in seconds for a ?freq= value."""
+    if value not in FREQUENCIES:
+        raise ValidationError("freq must be one of {}".format(', '.join(sorted(FREQUENCIES))))
+
+    return FREQUENCIES[value]
+
+def parse_aggregates(value):
+    """Return the list of aggregates in a comma-separated ?agg= value."""
+    aggregates = [each.strip() for each in value.split(',') if each.strip()]
+
+    if not aggregates or any(each not in PANDAS_AGGREGATES for each in aggregates):
+        raise ValidationError("agg must be a list of {}".format(', '.join(PANDAS_AGGREGATES)))
+
+    return aggregates
+
+def parse_range(start=None, end=None, default=datetime.timedelta(days=7)):
+    """Return the (start, end) of a request; a week up to now by default."""
+    try:
+        end = parse_timestamp(end) if end else datetime.datetime.utcnow()
+        start = parse_timestamp(start) if start else end - default
+    except (ValueError, OverflowError):
+        raise ValidationError("Invalid start or end")
+
+    if start >= end:
+        raise ValidationError("start must be before end")
+
+    return start, end
+
+def value_columns(model, cols):
+    """The numeric columns of `model` in `cols` that can be aggregated."""
+    return [c for c in model.__table__.columns if c.key in cols and not c.foreign_keys
+                and not c.primary_key and c.key != 'flag'
+                and isinstance(c.type, (db.Float, db.Integer))]
+
+def group_columns(model, cols):
+    """Columns the buckets are split on as well as time (orphans can report
+    several parameters)."""
+    return [c for c in model.__table__.columns if c.key == 'parameter' and c.key in cols]
+
+def bucket(column, seconds, dialect):
+    """SQL for the epoch-aligned bucket number of `column`, or None if the
+    database isn't supported."""
+    if dialect == 'mysql':
+        # TIMESTAMPDIFF doesn't depend on the session time zone, UNIX_TIMESTAMP does
+        return db.func.floor(db.func.timestampdiff(db.text('SECOND'), EPOCH, column) / seconds)
+
+    if dialect == 'sqlite':
+        return db.cast(db.func.strftime('%s', column), db.Integer) / seconds
+
+    return None
+
+def floor(timestamp, seconds):
+    """The start of the bucket `timestamp` falls in."""
+    return EPOCH + datetime.timedelta(seconds=int((timestamp - EPOCH).total_seconds()) // seconds * seconds)
+
+def rollup_columns(model):
+    """The columns of `model` kept in the rollup table: every numeric value the
+    API serves."""
+    return value_columns(model, [column for field, column, unit
+                                    in model.json_columns + model.researcher_json_columns])
+
+def aggregate(model, sn, columns, seconds, aggregates, start, end, keys=(), from_rollups=False):
+    """Aggregate the readings of instrument `sn` between start (inclusive) and
+    end (exclusive) into buckets of `seconds`.
+
+    Returns a list of {'timestamp', <keys>, '<column>_<aggregate>'} dicts in time
+    order, one per bucket (and key) that has readings. With `from_rollups`,
+    hourly and daily buckets are read from the rollup table when it holds
+    everything asked for; the first and last bucket then cover the whole bucket.
+    """
+    if from_rollups and seconds in (HOURLY, DAILY) and \
+            all(each in ROLLUP_AGGREGATES for each in aggregates) and \
+            {c.key for c in columns} <= {c.key for c in rollup_columns(model)}:
+        return _aggregate_rollups(sn, columns, seconds, aggregates, start, end, keys)
+
+    expression = bucket(model.timestamp, seconds, db.engine.dialect.name)
+
+    query = db.session.query(model).filter(model.instr_sn == sn,
+                model.timestamp >= start, model.timestamp < end)
+
+    if expression is not None and all(each in SQL_AGGREGATES for each in aggregates):
+        return _aggregate_sql(query, expression, columns, seconds, aggregates, keys)
+
+    return _aggregate_pandas(model, query, columns, seconds, aggregates, keys)
+
+def _aggregate_sql(query, expression, columns, seconds, aggregates, keys):
+    names = ['{}_{}'.format(c.key, each) for c in columns for each in aggregates]
+    values = [SQL_AGGREGATES[each](c) for c in columns for each in aggregates]
+
+    query = query.with_entities(expression.label('bucket'), *keys,
+                *[value.label(name) for value, name in zip(values, names)]) \
+                .group_by(db.text('bucket'), *keys) \
+                .order_by(db.text('bucket'), *keys)
+
+    results = []
+    for row in query:
+        result = {'timestamp': (EPOCH + datetime.timedelta(seconds=int(row.bucket) * seconds)).isoformat()}
+
+        for c in keys:
+            result[c.key] = getattr(row, c.key)
+
+        for name in names:
+            result[name] = getattr(row, name)
+
+        results.append(result)
+
+    return results
+
+def _aggregate_rollups(sn, columns, seconds, aggregates, start, end, keys):
+    table = Rollup.__table__
+
+    query = db.select([table]) \
+                .where(table.c.instr_sn == sn) \
+                .where(table.c.freq == seconds) \
+                .where(table.c.timestamp >= floor(start, seconds)) \
+                .where(table.c.timestamp < end) \
+                .where(table.c.field.in_([c.key for c in columns])) \
+                .order_by(table.c.timestamp, table.c.parameter)
+
+    names = ['{}_{}'.format(c.key, each) for c in columns for each in aggregates]
+
+    results = OrderedDict()
+    for row in db.session.execute(query):
+        key = (row['timestamp'], row['parameter'])
+
+        result = results.get(key)
+        if result is None:
+            result = {'timestamp': row['timestamp'].isoformat()}
+
+            for c in keys:
+                result[c.key] = row['parameter']
+
+            # Columns without any values in the bucket have no rollup row
+            for name in names:
+                result[name] = 0 if name.endswith('_count') else None
+
+            results[key] = result
+
+        values = {each: row[each] for each in ('count', 'sum', 'min', 'max')}
+        values['mean'] = values['sum'] / values['count'] if values['count'] else None
+
+        for each in aggregates:
+            result['{}_{}'.format(row['field'], each)] = values[each]
+
+    return list(results.values())
+
+def _aggregate_pandas(model, query, columns, seconds, aggregates, keys):
+    query = query.with_entities(model.timestamp, *(list(keys) + columns))
+
+    df = pd.read_sql(query.statement, query.session.bind, parse_dates=['timestamp'])
+
+    if df.empty:
+        return []
+
+    df['timestamp'] = df['timestamp'].dt.floor(pd.Timedelta(seconds=seconds))
+
+    df = df.groupby(['timestamp'] + [c.key for c in keys]) \
+            .agg({c.key: [PANDAS_AGGREGATES[each] for each in aggregates] for c in columns})
+
+    # agg keeps the order of the columns and of the functions
+    df.columns = ['{}_{}'.format(c.key, each) for c in columns for each in aggregates]
+
+    df = df.reset_index()
+
+    results = []
+    for record in df.to_dict('records'):
+        result = {'timestamp': record.pop('timestamp').isoformat()}
+
+        for name, value in record.items():
+            result[name] = None if pd.isnull(value) else getattr(value, 'item', lambda: value)()
+
+        results.append(result)
+
+    return results
+
+def _runs(buckets, width):
+    """Merge sorted bucket starts into [start, end) ranges of adjacent buckets."""
+    runs = []
+    for each in buckets:
+        if runs and each <= runs[-1][1]:
+            runs[-1][1] = each + width
+        else:
+            runs.append([each, each + width])
+
+    return runs
+
+def _hourly_rollups(model, sn, start, end, bind):
+    """Hourly rollup rows of `sn` between start and end from the raw readings."""
+    table = model.__table__
+    columns = [table.c[c.key] for c in rollup_columns(model)]
+    keys = [table.c[c.key] for c in group_columns(model, table.columns.keys())]
+
+    query = db.select([bucket(table.c.timestamp, HOURLY, db.engine.dialect.name).label('bucket')] + keys +
+                      [f(c) for c in columns for f in (db.func.count, db.func.sum, db.func.min, db.func.max)]) \
+                .where(table.c.instr_sn == sn) \
+                .where(table.c.timestamp >= start) \
+                .where(table.c.timestamp < end) \
+                .group_by(db.text('bucket'), *keys)
+
+    rows = []
+    for row in bind.execute(query):
+        timestamp = EPOCH + datetime.timedelta(seconds=int(row[0]) * HOURLY)
+        parameter = (row[1] if keys else None) or ''
+        values = row[1 + len(keys):]
+
+        for i, c in enumerate(columns):
+            count, total, minimum, maximum = values[4 * i:4 * i + 4]
+
+            if count:
+                rows.append(dict(instr_sn=sn, freq=HOURLY, timestamp=timestamp, field=c.key,
+                                 parameter=parameter, count=int(count), sum=total,
+                                 min=minimum, max=maximum))
+
+    return rows
+
+def _daily_rollups(sn, start, end, bind):
+    """Daily rollup rows of `sn` between start and end from the hourly ones."""
+    table = Rollup.__table__
+
+    query = db.select([bucket(table.c.timestamp, DAILY, db.engine.dialect.name).label('bucket'),
+                       table.c.field, table.c.parameter, db.func.sum(table.c.count),
+                       db.func.sum(table.c.sum), db.func.min(table.c.min), db.func.max(table.c.max)]) \
+                .where(table.c.instr_sn == sn) \
+                .where(table.c.freq == HOURLY) \
+                .where(table.c.timestamp >= start) \
+                .where(table.c.timestamp < end) \
+                .group_by(db.text('bucket'), table.c.field, table.c.parameter)
+
+    return [dict(instr_sn=sn, freq=DAILY, timestamp=EPOCH + datetime.timedelta(seconds=int(row[0]) * DAILY),
+                 field=row[1], parameter=row[2], count=int(row[3]), sum=row[4], min=row[5], max=row[6])
+            for row in bind.execute(query)]
+
+def _replace_rollups(sn, freq, start, end, rows, bind):
+    table = Rollup.__table__
+
+    bind.execute(table.delete()
+                    .where(table.c.instr_sn == sn)
+                    .where(table.c.freq == freq)
+                    .where(table.c.timestamp >= start)
+                    .where(table.c.timestamp < end))
+
+    if rows:
+        bind.execute(table.insert(), rows)
+
+def refresh_rollups(model, sn, timestamps, bind=None):
+    """Recompute the hourly and daily rollups of instrument `sn` (a `model`)
+    covering `timestamps` from its raw readings. Returns the number of hours
+    recomputed; nothing is done on databases `bucket` doesn't support.
+    """
+    bind = bind if bind is not None else db.session
+
+    if bucket(model.timestamp, HOURLY, db.engine.dialect.name) is None:
+        return 0
+
+    hours = sorted({floor(ts, HOURLY) for ts in timestamps if ts is not None})
+
+    for start, end in _runs(hours, datetime.timedelta(seconds=HOURLY)):
+        _replace_rollups(sn, HOURLY, start, end, _hourly_rollups(model, sn, start, end, bind), bind)
+
+    days = sorted({floor(ts, DAILY) for ts in hours})
+
+    for start, end in _runs(days, datetime.timedelta(seconds=DAILY)):
+        _replace_rollups(sn, DAILY, start, end, _daily_rollups(sn, start, end, bind), bind)
+
+    # Aggregates served from the rollups just changed
+    if hours:
+        latest_readings.touch(sn, bind=bind)
+
+    return len(hours)
+
+def rebuild_rollups(instrument, start=None, end=None, chunk=datetime.timedelta(days=30)):
+    """Recompute every rollup of `instrument` between start and end (all of
+    its data by default) a chunk of days at a time. Returns the number of
+    hours with readings.
+    """
+    model = instrument._get_data_model()
+
+    if start is None or end is None:
+        first, last = db.session.query(db.func.min(model.timestamp), db.func.max(model.timestamp)) \
+                        .filter(model.instr_sn == instrument.sn).one()
+
+        if first is None:
+            return 0
+
+        start = start or first
+        end = end or last + datetime.timedelta(seconds=1)
+
+    if bucket(model.timestamp, HOURLY, db.engine.dialect.name) is None:
+        return 0
+
+    start = floor(start, DAILY)
+    hours = 0
+
+    while start < end:
+        stop = min(start + chunk, floor(end, DAILY) + datetime.timedelta(seconds=DAILY))
+
+        rows = _hourly_rollups(model, instrument.sn, start, stop, db.session)
+        hours += len({row['timestamp'] for row in rows})
+
+        _replace_rollups(instrument.sn, HOURLY, start, stop, rows, db.session)
+        _replace_rollups(instrument.sn, DAILY, start, stop,
+                         _daily_rollups(instrument.sn, start, stop, db.session), db.session)
+
+        db.session.commit()
+
+        start = stop
+
+    return hours
+
+class RollupTracker(object):
+    """Keeps the rollup table up to date as readings are stored.
+
+    The hours touched by new or changed readings are collected here and
+    recomputed from the raw data every `interval` seconds by a background task.
+    With an interval of 0 they're recomputed right away using the caller's
+    session or connection instead.
+    """
+    def __init__(self, interval=60):
+        self.app = None
+        self.interval = interval
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._running = False
+        self._registered = False
+
+    def configure(self, app, interval):
+        self.app = app
+        self.interval = interval
+
+        if interval and not self._registered:
+            atexit.register(self.close)
+            self._registered = True
+
+    def close(self):
+        """Recompute whatever is pending (called at exit)"""
+        if self.app is not None and self._pending:
+            with self.app.app_context():
+                self.flush()
+
+    def mark(self, model, rows, bind=None):
+        """Record that readings of `model` (mappings or instances with instr_sn
+        and timestamp) were stored or changed.
+        """
+        with self._lock:
+            for row in rows:
+                sn, timestamp = (row['instr_sn'], row['timestamp']) if isinstance(row, dict) \
+                                    else (row.instr_sn, row.timestamp)
+
+                if sn is not None and timestamp is not None:
+                    self._pending.setdefault((model, sn), set()).add(floor(timestamp, HOURLY))
+
+        if not self.interval or self.app is None:
+            self.flush(bind if bind is not None else db.session)
+        else:
+            self._start()
+
+    def pending(self):
+        with self._lock:
+            return {key: set(hours) for key, hours in self._pending.items()}
+
+    def flush(self, bind=None):
+        """Recompute every pending hour, each instrument in a transaction of its
+        own (or all of them using `bind`, a session or connection); returns the
+        number of hours recomputed. If an instrument fails, it and the ones not
+        reached yet are put back to be retried.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+
+        pending = list(pending.items())
+
+        hours = 0
+        for index, ((model, sn), touched) in enumerate(pending):
+            try:
+                if bind is None:
+                    with db.engine.begin() as conn:
+                        hours += refresh_rollups(model, sn, touched, conn)
+                else:
+                    hours += refresh_rollups(model, sn, touched, bind)
+            except Exception:
+                with self._lock:
+                    for key, each in pending[index:]:
+                        self._pending.setdefault(key, set()).update(each)
+                raise
+
+        return hours
+
+    def _start(self):
+        if self._running:
+            return
+
+        with self._lock:
+            if self._running:
+                return
+
+            self._running = True
+
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                sentry.captureException()
+
+rollups = RollupTracker()
+
+def _reading_changed(mapper, connection, target):
+    rollups.mark(type(target), [target], bind=connection)
+
+for _model in DATA_MODELS:
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event, _reading_changed)
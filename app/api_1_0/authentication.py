@@ -1,42 +1,83 @@
 from .errors import forbidden, unauthorized, bad_request
 from . import api_1_0
 from .decorators import json
-from ..models import User, Credentials, Instrument
+from ..models import User, Credentials, Instrument, credentials_cache
+from ..models import instrument_directory
 
 from functools import wraps
-from flask import request
+from flask import request, g
 import flask_sqlalchemy
 
+def get_api_key():
+    ''' Return the API key sent with the request (or None) '''
+    auth = request.authorization
+    if not auth:
+        return None
+
+    if isinstance(auth.username, bytes):
+        auth.username = auth.username.decode('utf-8')
+
+    return auth.username
+
+def get_principal(apikey):
+    ''' Resolve an API key to a Principal (or None if the key does not exist).
+
+    The key is resolved at most once per request and then served from the
+    per-worker credentials cache until it expires or is invalidated.
+    '''
+    if not apikey:
+        return None
+
+    principal = g.get('principal')
+    if principal is not None and principal.key == apikey:
+        return principal
+
+    principal = credentials_cache.get(apikey)
+    if principal is None:
+        credentials = Credentials.query.filter_by(key=apikey).first()
+        if credentials is None:
+            return None
+
+        principal = credentials_cache.set(apikey, credentials.to_principal())
+
+    g.principal = principal
+
+    return principal
+
 def check_auth(apikey):
     ''' If the API key exists, return True '''
-    if Credentials.query.filter_by(key=apikey).count() == 0:
-        return False
-    else:
-        return True
+    return get_principal(apikey) is not None
 
 def can_write(apikey):
-    credentials = Credentials.query.filter_by(key=apikey).first()
-    if credentials is None:
+    principal = get_principal(apikey)
+    if principal is None:
         return False
 
-    return credentials.can_write
+    return 'WRITE' in principal.scopes
 
 def can_drop(apikey):
-    credentials = Credentials.query.filter_by(key=apikey).first()
-    if credentials is None:
+    principal = get_principal(apikey)
+    if principal is None:
         return False
 
-    return credentials.can_drop
+    return 'DROP' in principal.scopes
 
 def requires_credentials(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
+        if not check_auth(get_api_key()):
+            return unauthorized("Invalid credentials")
+        return f(*args, **kwargs)
 
-        if isinstance(auth.username, bytes):
-            auth.username = auth.username.decode('utf-8')
+    return decorated
 
-        if not auth or not check_auth(auth.username):
+def requires_user_credentials(f):
+    """The API key must exist and belong to a user rather than an instrument
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        principal = get_principal(get_api_key())
+        if principal is None or principal.user_id is None:
             return unauthorized("Invalid credentials")
         return f(*args, **kwargs)
 
@@ -45,12 +86,7 @@ def requires_credentials(f):
 def requires_write_access(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-
-        if isinstance(auth.username, bytes):
-            auth.username = auth.username.decode('utf-8')
-
-        if not auth or not can_write(auth.username):
+        if not can_write(get_api_key()):
             return unauthorized("You do not have write access")
         return f(*args, **kwargs)
 
@@ -59,12 +95,7 @@ def requires_write_access(f):
 def requires_drop_access(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-
-        if isinstance(auth.username, bytes):
-            auth.username = auth.username.decode('utf-8')
-
-        if not auth or not can_drop(auth.username):
+        if not can_drop(get_api_key()):
             return unauthorized("You do not have write access")
         return f(*args, **kwargs)
 
@@ -76,18 +107,14 @@ def requires_viewing_privileges(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         sn = kwargs.get('sn', None)
-        auth = request.authorization
-
-        if isinstance(auth.username, bytes):
-            auth.username = auth.username.decode('utf-8')
 
         # Get the credentials
-        key = Credentials.query.filter_by(key=auth.username).first()
+        principal = get_principal(get_api_key())
 
-        device = Instrument.query.filter_by(sn=sn).first()
+        device = instrument_directory.access(sn)
 
         # Make sure the key exists
-        if not key or not key.user_id:
+        if not principal or not principal.user_id:
             return bad_request("Invalid API key")
 
         # Make sure the device exists
@@ -95,7 +122,7 @@ def requires_viewing_privileges(f):
             return bad_request("No device exists with this serial number.")
 
         # Check to see if the user can view the device
-        if not key.User.canview(device):
+        if not principal.canview(device):
             return unauthorized("This API does not have permisssions to view this device.")
 
         return f(*args, **kwargs)
@@ -106,21 +133,15 @@ def requires_research_privileges(f):
     """
     @wraps(f)
     def decorated(*args, **kwargs):
-        sn = kwargs.get('sn', None)
-        auth = request.authorization
-
-        if isinstance(auth.username, bytes):
-            auth.username = auth.username.decode('utf-8')
-
         # Get the credentials
-        key = Credentials.query.filter_by(key=auth.username).first()
+        principal = get_principal(get_api_key())
 
         # Make sure the key exists
-        if not key or not key.user_id:
+        if not principal or not principal.user_id:
             return bad_request("Invalid API key")
 
         # Check to see if the user can view the device
-        if not key.User.can_view_research_data:
+        if 'RESEARCH' not in principal.scopes:
             return unauthorized("This API does not have permisssions to view research level data.")
 
         return f(*args, **kwargs)
@@ -134,23 +155,14 @@ def filter_on_instrument_permissions(model):
         def wrapped(*args, **kwargs):
             query = f(*args, **kwargs)
 
-            auth = request.authorization
-
-            if isinstance(auth.username, bytes):
-                auth.username = auth.username.decode('utf-8')
-
             # Get authorization
-            key = Credentials.query.filter_by(key=auth.username).first()
-            if key is None:
-                return unauthorized("Invalid credentials")
-
-            user = key.User
-            if user is None:
+            principal = get_principal(get_api_key())
+            if principal is None or principal.user_id is None:
                 return unauthorized("Invalid credentials")
 
             # Make sure the user can view the Instrument
             # This should return all devices the user can view, not just the ones it owns!
-            query = user.following
+            query = principal.following
 
             # do some magic
             return query
@@ -84,7 +84,9 @@ def bot_chat():
                         # Try to get the status of the sensor
                         dev = check_for_valid_device(message_blob)
                         if dev is not None:
-                            msg = "Hi! {} was last updated {}".format(dev.sn, time_since_update(dev.last_updated))
+                            last = latest_readings.timestamp(dev.sn, dev._get_data_model()) or dev.last_updated
+
+                            msg = "Hi! {} was last updated {}".format(dev.sn, time_since_update(last))
                         else:
                             msg = "Oops. It looks like you have an invalid serial number."
                     else:
@@ -7,16 +7,23 @@ Endpoints to add:
 """
 from ..models import *
 from flask import request, abort, url_for, current_app, jsonify
-from flask import app, make_response
+from flask import app, make_response, Response, stream_with_context
 from flask_login import login_required, current_user
 from .. import db, sentry
 from . import api_1_0
-from .authentication import requires_credentials, requires_write_access
+from .authentication import requires_credentials, requires_user_credentials, requires_write_access
 from .authentication import requires_viewing_privileges, requires_research_privileges
-from .decorators import json, collection, _collection, _filter_query
+from .authentication import get_principal, get_api_key
+from .decorators import json, collection, conditional, _collection, _filter_query
 from ..helpers import calculate_days
+from ..ingest import split_readings, validate_reading, as_row, to_row, insert_rows
+from ..ingest import reading_key
+from ..ingest import READING_ERRORS, ingest_buffer
+from ..exceptions import ValidationError
+from ..parsers import parse_timestamp
+from .. import aggregation, formats
+from sqlalchemy.exc import IntegrityError
 import datetime
-import dateutil.parser
 
 @api_1_0.route('/data/webhook/', methods=['POST'])
 @requires_write_access
@@ -25,10 +32,10 @@ def webhook_post():
     """POST a new datapoint from through a Particle webhook"""
     coreid = request.form['coreid']
     data = request.form['data']
-    dev = Instrument.query.filter_by(particle_id=coreid).first_or_404()
+    dev = instrument_directory.get_or_404(particle_id=coreid)
 
     # In order to use this, I need to rewrite the from_json methods of MIT and EBAM
-    model = dev._get_data_model()
+    model = dev.data_model
 
     # If the device has a model attached, try to evaluate and add the so2 to the dictionary
     # So, evaluate() should return a new data object and should intake data in webhook format (or not)
@@ -44,14 +51,67 @@ def webhook_post():
         sentry.captureMessage("Invalid timestamp /data/webhook")
         abort(400)
 
+    if ingest_buffer.put(model, [to_row(new_pt)], [dev.id]):
+        return {"Webhook Post": "Queued"}, 202
+
     # Load in the ML model and set the
-    dev.update()
+    Instrument.touch([dev.id])
 
-    db.session.add(new_pt)
+    inserted = insert_rows(model, [to_row(new_pt)])
     db.session.commit()
 
+    # Particle retries on timeouts; a repeat is acknowledged but not stored
+    if not inserted:
+        return {"Webhook Post": "Duplicate"}, 200
+
     return {"Webhook Post": "All good!"}, 201
 
+@api_1_0.route('/data/webhook/batch/', methods=['POST'])
+@requires_write_access
+@json
+def webhook_post_batch():
+    """POST many datapoints for a single device through a Particle webhook.
+
+    `data` holds one comma-separated reading per line (or separated by `;`).
+    Each reading is accepted or rejected on its own and all accepted readings
+    are written with a single bulk insert.
+    """
+    coreid = request.form['coreid']
+    readings = split_readings(request.form['data'])
+    dev = instrument_directory.get_or_404(particle_id=coreid)
+
+    model = dev.data_model
+    if not hasattr(model, 'from_webhook'):
+        raise ValidationError("This device does not accept webhook data.")
+
+    rows, results = [], []
+    for index, reading in enumerate(readings):
+        try:
+            data = model.from_webhook(reading, dev.sn)
+            data = dev.evaluate(data=data)
+
+            rows.append(as_row(model, validate_reading(data)))
+        except READING_ERRORS as e:
+            results.append({'index': index, 'status': 'rejected',
+                            'message': str(e) or e.__class__.__name__})
+        else:
+            results.append({'index': index, 'status': 'accepted'})
+
+    if not rows:
+        return {'accepted': 0, 'rejected': len(results), 'results': results}, 400
+
+    status = 202
+    if not ingest_buffer.put(model, rows, [dev.id]):
+        status = 201
+
+        Instrument.touch([dev.id])
+
+        insert_rows(model, rows)
+        db.session.commit()
+
+    return {'accepted': len(rows), 'rejected': len(results) - len(rows),
+            'results': results}, status
+
 @api_1_0.route('/data/webhook/meta/', methods=['POST'])
 @requires_write_access
 @json
@@ -64,7 +124,7 @@ def webhook_post_meta():
     if coreid == 'api':
         return {'Webhook Post': 'NA'}, 200
 
-    dev = Instrument.query.filter_by(particle_id=coreid).first_or_404()
+    dev = instrument_directory.get_or_404(particle_id=coreid)
 
     # data contains the message, name contains the webhook endpoint
     name = request.form['name']
@@ -93,35 +153,161 @@ def data_post():
     data = request.json
     sn = data['instr_sn']
 
-    i = Instrument.query.filter_by(sn=sn).first_or_404()
+    i = instrument_directory.get_or_404(sn=sn)
 
     # Fix datetime
-    data['timestamp'] = dateutil.parser.parse(data['timestamp'])
+    data['timestamp'] = parse_timestamp(data['timestamp'])
 
     # Get the data model
-    model = i._get_data_model()
+    model = i.data_model
 
     new = model.create(data)
 
     if new.timestamp.year > datetime.datetime.utcnow().year:
         abort(400)
 
-    db.session.add(new)
-    db.session.commit()
+    # Posting the same reading twice returns the stored datapoint
+    key = {column: getattr(new, column) for column in reading_key(model)}
+
+    existing = model.query.filter_by(**key).first()
+    if existing is not None:
+        return existing, 200
+
+    if ingest_buffer.put(model, [to_row(new)], [i.id]):
+        return {'status': 'queued', 'instr_sn': i.sn,
+                'timestamp': new.timestamp.isoformat()}, 202
+
+    Instrument.touch([i.id])
 
-    new.update_parent()
+    try:
+        db.session.add(new)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+        return model.query.filter_by(**key).first_or_404(), 200
+
+    count_new_readings(model, {i.sn: 1})
 
     return new, 201
 
+@api_1_0.route('/data/bulk/', methods=['POST'])
+@requires_write_access
+@json
+def data_post_bulk():
+    """POST an array of datapoints that may span several instruments.
+
+    Each instrument is resolved once, rows are grouped by data model and each
+    group is written with a single bulk insert. Every item is reported back as
+    either `created` or `rejected`.
+    """
+    items = request.json
+
+    if isinstance(items, dict):
+        items = items.get('data')
+
+    if not isinstance(items, list):
+        raise ValidationError("Expected an array of datapoints.")
+
+    groups, updated, results = dict(), set(), []
+    for index, item in enumerate(items):
+        result = {'index': index, 'status': 'created'}
+
+        try:
+            data = dict(item)
+
+            result['instr_sn'] = data['instr_sn']
+
+            dev = instrument_directory.get(sn=data['instr_sn'])
+            if dev is None:
+                raise ValidationError("No device exists with this serial number.")
+
+            data['timestamp'] = parse_timestamp(data['timestamp'])
+
+            model = dev.data_model
+
+            groups.setdefault(model, []).append(as_row(model, validate_reading(data)))
+            updated.add(dev.id)
+        except READING_ERRORS as e:
+            result['status'] = 'rejected'
+            result['message'] = str(e) or e.__class__.__name__
+
+        results.append(result)
+
+    created = sum(len(rows) for rows in groups.values())
+
+    if not created:
+        return {'created': 0, 'rejected': len(results), 'results': results}, 400
+
+    # Anything that doesn't fit in the write-behind buffer is written now
+    status = 202
+    for model, rows in groups.items():
+        if not ingest_buffer.put(model, rows, updated):
+            status = 201
+
+            insert_rows(model, rows)
+
+    if status == 201:
+        Instrument.touch(updated)
+
+        db.session.commit()
+
+    return {'created': created, 'rejected': len(results) - created,
+            'results': results}, status
+
+def _data_version(sn, **kwargs):
+    """@conditional validator for the readings of one instrument"""
+    dev = instrument_directory.get(sn=sn)
+    if dev is None or dev.data_model is None:
+        return None
+
+    version, modified = latest_readings.version(dev.sn, dev.data_model)
+
+    # timestamp_local depends on the timezone
+    return (version, dev.timezone), modified
+
+def _aggregate_version(sn, **kwargs):
+    """@conditional validator for aggregates, which only stand still when
+    ?end= is given; the default window ends now"""
+    if not request.args.get('end'):
+        return None
+
+    return _data_version(sn)
+
+def _following(principal):
+    """The sn of every instrument `principal` can view, limited to ?sn=a,b,c"""
+    query = principal.following.with_entities(Instrument.sn)
+
+    if request.args.get('sn'):
+        sns = [sn.strip() for sn in request.args['sn'].split(',') if sn.strip()]
+
+        query = query.filter(Instrument.sn.in_(sns))
+
+    return query
+
+def _latest_version():
+    """@conditional validator for the latest readings of many instruments"""
+    principal = get_principal(get_api_key())
+    if principal is None or principal.user_id is None:
+        return None
+
+    count, revisions, modified = _following(principal) \
+                .outerjoin(LatestReading, LatestReading.instr_sn == Instrument.sn) \
+                .with_entities(db.func.count(Instrument.sn), db.func.sum(LatestReading.revision),
+                               db.func.max(LatestReading.modified)).one()
+
+    return (count, revisions, modified), modified
+
 @api_1_0.route('/device/<string:sn>/data/', methods=['GET'])
 @requires_viewing_privileges
+@conditional(_data_version)
 @json
 def get_data_by_dev(sn):
     """_filter and _sort first! Oh, and get the model name..."""
-    dev = Instrument.query.filter_by(sn=sn).first_or_404()
+    dev = instrument_directory.get_or_404(sn=sn)
 
     # Choose model
-    model = dev._get_data_model()
+    model = dev.data_model
     data = _collection(model, model.query.filter_by(instr_sn=dev.sn),
                     name='data', sn=dev.sn, researcher=False)
 
@@ -130,27 +316,68 @@ def get_data_by_dev(sn):
 @api_1_0.route('/researcher/device/<string:sn>/data/', methods=['GET'])
 @requires_credentials
 @requires_research_privileges
+@conditional(_data_version)
 @json
 def get_research_data_by_dev(sn):
     """Return the research data by device
     """
-    dev = Instrument.query.filter_by(sn=sn).first_or_404()
+    dev = instrument_directory.get_or_404(sn=sn)
 
     # Choose model
-    model = dev._get_data_model()
+    model = dev.data_model
     data = _collection(model, model.query.filter_by(instr_sn=dev.sn),
                     name='data', sn=dev.sn, researcher=True)
 
     return data, 200
 
+@api_1_0.route('/device/<string:sn>/aggregate/', methods=['GET'])
+@requires_viewing_privileges
+@conditional(_aggregate_version)
+@json
+def get_aggregate_by_dev(sn):
+    """Return the data resampled into buckets of ?freq= (10min, 1h or 1d) with
+    the aggregates in ?agg= (any of mean, min, max, count and p95)
+    """
+    dev = instrument_directory.get_or_404(sn=sn)
+    model = dev.data_model
+
+    seconds = aggregation.parse_frequency(request.args.get('freq', '1h'))
+    aggregates = aggregation.parse_aggregates(request.args.get('agg', 'mean'))
+    start, end = aggregation.parse_range(request.args.get('start'), request.args.get('end'))
+
+    # Only aggregate the columns the key can see
+    researcher = 'RESEARCH' in get_principal(get_api_key()).scopes
+    cols = dev.private_cols if researcher else dev.public_cols
+
+    columns = aggregation.value_columns(model, cols)
+    keys = aggregation.group_columns(model, cols)
+
+    data = aggregation.aggregate(model, dev.sn, columns, seconds, aggregates, start, end, keys=keys,
+                                 from_rollups=current_app.config['AGGREGATE_FROM_ROLLUPS'])
+
+    units = {column: unit for field, column, unit in model.json_columns + model.researcher_json_columns
+                if unit is not None and column in cols}
+
+    meta = {
+        'instrument': DeviceContext.from_instrument(dev).url,
+        'freq': request.args.get('freq', '1h'),
+        'agg': aggregates,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'units': units,
+    }
+
+    return {'data': data, 'meta': meta}, 200
+
 @api_1_0.route('/device/<string:sn>/data/<int:id>', methods=['GET'])
 @requires_credentials
 @requires_viewing_privileges
+@conditional(_data_version)
 @json
 def get_datapoint_by_dev(sn, id):
     """GET individual data point by device SN."""
-    dev = Instrument.query.filter_by(sn=sn).first_or_404()
-    model = dev._get_data_model()
+    dev = instrument_directory.get_or_404(sn=sn)
+    model = dev.data_model
 
     # Query the individual data point
     data = model.query.get_or_404(id)
@@ -160,21 +387,52 @@ def get_datapoint_by_dev(sn, id):
 @api_1_0.route('/device/<string:sn>/latest', methods=['GET'])
 @requires_credentials
 @requires_viewing_privileges
+@conditional(_data_version)
 @json
 def get_most_recent_datapoint(sn):
     """GET the most recent data point for instrument with sn=sn"""
-    dev = Instrument.query.filter_by(sn=sn).first_or_404()
+    dev = instrument_directory.get_or_404(sn=sn)
 
-    m = dev._get_data_model()
-
-    # query to get the most recent data point
-    data = m.query.order_by(m.timestamp.desc()).first()
+    data = latest_readings.reading(dev.data_model, dev.sn)
 
     if data is None:
         data = {}
 
     return data, 200
 
+@api_1_0.route('/devices/latest', methods=['GET'])
+@requires_user_credentials
+@conditional(_latest_version)
+@json
+def get_latest_datapoints():
+    """GET the most recent data point of every instrument the user can view
+    (or only of those in ?sn=a,b,c) in one response, keyed by sn."""
+    principal = get_principal(get_api_key())
+
+    # Group the instruments by data model so there's one query per model
+    devices, by_model = dict(), dict()
+    for sn, in _following(principal):
+        dev = instrument_directory.get(sn=sn)
+        if dev is None:
+            continue
+
+        devices[sn] = dev
+        if dev.data_model is not None:
+            by_model.setdefault(dev.data_model, []).append(sn)
+
+    readings = dict()
+    for model, sns in by_model.items():
+        readings.update(latest_readings.readings(model, sns))
+
+    data = dict()
+    for sn, dev in devices.items():
+        reading = readings.get(sn)
+
+        data[sn] = reading.to_json(device=DeviceContext.from_instrument(dev)) \
+                        if reading is not None else None
+
+    return {'data': data, 'meta': {'count': len(data)}}, 200
+
 @api_1_0.route('/device/<string:sn>/data/<int:id>', methods=['PUT'])
 @requires_credentials
 @requires_viewing_privileges
@@ -182,8 +440,8 @@ def get_most_recent_datapoint(sn):
 def put_datapoint(sn, id):
     """The only attribute we can change is the flag!
     """
-    dev = Instrument.query.filter_by(sn=sn).first_or_404()
-    mod = dev._get_data_model()
+    dev = instrument_directory.get_or_404(sn=sn)
+    mod = dev.data_model
 
     pt = mod.query.get_or_404(id)
 
@@ -201,10 +459,10 @@ def download_csv(sn, start, end):
     """Download data and return as a csv
     If current_user has the permissions, give all the data!
     """
-    dev = Instrument.query.filter_by(sn=sn).first_or_404()
+    dev = instrument_directory.get_or_404(sn=sn)
 
     # Get the data model
-    model = dev._get_data_model()
+    model = dev.data_model
 
     # Get the data query
     dq = model.query.filter_by(instr_sn=dev.sn)
@@ -215,17 +473,22 @@ def download_csv(sn, start, end):
     # Get the columns to add to the file (based on the users permissions)
     cols_to_keep = dev.private_cols if current_user.can_view_research_data else dev.public_cols
 
-    # Get the dataframe
-    df = dev.df_from_query(dq, cols_to_keep=cols_to_keep)
+    # ?format=parquet/arrow (or an Accept header) for typed binary files
+    format = formats.export_format(request.args.get('format'), request.accept_mimetypes)
 
     # Create a filename
-    filename = "{}-{}-{}.csv".format(sn, ''.join(start.split('-')),
-                        ''.join(end.split('-')))
+    filename = "{}-{}-{}.{}".format(sn, ''.join(start.split('-')),
+                        ''.join(end.split('-')), format)
+
+    # Stream the file rather than building it in memory
+    if format == 'csv':
+        rows = dev.iter_csv(dq, cols_to_keep=cols_to_keep)
+    else:
+        schema = formats.arrow_schema(dev._export_columns(cols_to_keep))
+        rows = formats.iter_arrow(dev.iter_frames(dq, cols_to_keep=cols_to_keep), schema, format)
 
-    # Make the response
-    resp = make_response(df.to_csv(date_format='%Y-%m-%dT%H:%M:%SZ'))
+    resp = Response(stream_with_context(rows), mimetype=formats.EXPORT_FORMATS[format])
 
     resp.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
-    resp.headers['Content-Type'] = 'text/csv'
 
     return resp
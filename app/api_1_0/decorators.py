@@ -1,8 +1,20 @@
 import functools
-from flask import jsonify, url_for, request, make_response
+import re
+from flask import jsonify, url_for, request, make_response, abort, current_app
 #from .errors import bad_request
+from .. import db
+from ..exceptions import ValidationError
+from ..models import row_counts, instrument_directory, DeviceContext
+from ..parsers import parse_timestamp
+from ..helpers import to_timezone
+from ..compression import weak
+from ..formats import MSGPACK, RESPONSE_MIMETYPES, packb
+from sqlalchemy import and_, or_
+from json import dumps as json_dumps, loads as json_loads
 import flask_sqlalchemy
+import datetime
 import hashlib
+import base64
 
 def json(f):
     '''
@@ -26,7 +38,14 @@ def json(f):
         if not isinstance(rv, dict):
             rv = rv.to_json()
 
-        rv = jsonify(rv)
+        # msgpack for clients that prefer it (Accept: application/msgpack)
+        if request.accept_mimetypes.best_match(RESPONSE_MIMETYPES) == MSGPACK:
+            rv = make_response(packb(rv))
+            rv.mimetype = MSGPACK
+        else:
+            rv = jsonify(rv)
+
+        rv.vary.add('Accept')
 
         if status is not None:
             rv.status_code = status
@@ -38,37 +57,446 @@ def json(f):
     return wrapped
 
 # Documentatino is here: https://github.com/miguelgrinberg/api-pycon2015
-def _filter_query(model, query, filter_spec):
-    filters = [f.split(',') for f in filter_spec.split(';')]
-    for f in filters:
+#
+# ?filter=column,op,value;... and ?sort=column,asc|desc;... are compiled against
+# the model's filter_columns and sort_columns allow-lists. Values are coerced to
+# the column's type, and timestamp bounds are merged into one range so the
+# per-instrument queries stay on the (instr_sn, timestamp) index. Filters on
+# other (unindexed) columns of a data model need a bounded timestamp range of at
+# most API_FILTER_SCAN_DAYS days, which caps how many rows they can scan.
+FILTER_OPS = {
+    str: ('eq', 'ne', 'in', 'like'),
+    bool: ('eq', 'ne'),
+    None: ('eq', 'ne', 'lt', 'le', 'gt', 'ge', 'in'),
+}
+
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+def _coerce(column, name, value):
+    ''' Convert a filter value to the column's type '''
+    python_type = column.type.python_type
+
+    try:
+        if python_type is datetime.datetime:
+            return parse_timestamp(value)
+        if python_type is bool:
+            if value.lower() not in ('true', 'false', '1', '0'):
+                raise ValueError(value)
+
+            return value.lower() in ('true', '1')
+        if python_type in (int, float):
+            return python_type(value)
+    except (ValueError, OverflowError):
+        raise ValidationError("Invalid value for {}: {}".format(name, value))
+
+    return value
+
+def _compile_filters(model, filter_spec, researcher=False):
+    ''' Parse ?filter= into [(name, op, value)], raising a ValidationError for
+        anything outside the model's allow-list '''
+    allowed = list(getattr(model, 'filter_columns', []))
+    if researcher:
+        allowed += [column for field, column, unit in getattr(model, 'researcher_json_columns', [])]
+
+    filters = []
+    for f in filter_spec.split(';'):
+        f = f.split(',')
         if len(f) < 3 or (len(f) > 3 and f[1] != 'in'):
-            continue
-        if f[1] == 'in':
-            f = [f[0], f[1], f[2:]]
+            raise ValidationError("filter must be column,op,value")
+
+        name, op = f[0], f[1]
+        if name not in allowed:
+            raise ValidationError("Can't filter on {}".format(name))
+
+        column = getattr(model, name)
+        python_type = column.type.python_type
+
+        if op not in FILTER_OPS.get(python_type, FILTER_OPS[None]):
+            raise ValidationError("Can't use {} on {}".format(op, name))
+
+        if op == 'in':
+            value = [_coerce(column, name, v) for v in f[2:]]
+        elif op == 'like':
+            # A leading wildcard can't use an index
+            if f[2][:1] in ('%', '_'):
+                raise ValidationError("like patterns can't start with a wildcard")
+
+            value = f[2]
+        else:
+            value = _coerce(column, name, f[2])
+
+            # A bare date means the whole day
+            if python_type is datetime.datetime and op == 'eq' and _DATE.match(f[2]):
+                filters += [(name, 'ge', value), (name, 'lt', value + datetime.timedelta(days=1))]
+                continue
+
+        filters.append((name, op, value))
+
+    return filters
+
+def _filter_query(model, query, filter_spec, researcher=False):
+    filters = _compile_filters(model, filter_spec, researcher=researcher)
 
-        ops = {'eq': '__eq__', 'ne': '__ne__', 'lt': '__lt__', 'le': '__le__',
-               'gt': '__gt__', 'ge': '__ge__', 'in': 'in_', 'like': 'like'}
+    ops = {'eq': '__eq__', 'ne': '__ne__', 'lt': '__lt__', 'le': '__le__',
+           'gt': '__gt__', 'ge': '__ge__', 'in': 'in_', 'like': 'like'}
 
-        if hasattr(model, f[0]) and f[1] in ops.keys():
-            column = getattr(model, f[0])
-            op = ops[f[1]]
-            query = query.filter(getattr(column, op)(f[2]))
+    # Data models are read per instrument along (instr_sn, timestamp)
+    ranged = 'timestamp' in getattr(model, 'sort_columns', [])
+    if ranged:
+        lower, upper = None, None
+        for name, op, value in filters:
+            if name != 'timestamp':
+                continue
+
+            if op in ('gt', 'ge', 'eq') and (lower is None or value > lower[1] or
+                                              (value == lower[1] and op == 'gt')):
+                lower = (op if op != 'eq' else 'ge', value)
+            if op in ('lt', 'le', 'eq') and (upper is None or value < upper[1] or
+                                              (value == upper[1] and op == 'lt')):
+                upper = (op if op != 'eq' else 'le', value)
+
+        residual = {name for name, op, value in filters if name not in model.sort_columns}
+        if residual:
+            days = current_app.config.get('API_FILTER_SCAN_DAYS', 31)
+            end = upper[1] if upper else datetime.datetime.utcnow()
+
+            if lower is None or end - lower[1] > datetime.timedelta(days=days):
+                raise ValidationError("Filtering on {} needs a timestamp range of at most {} days".format(
+                                        ', '.join(sorted(residual)), days))
+
+        # One range on the timestamp instead of every bound given
+        filters = [f for f in filters if f[0] != 'timestamp' or f[1] in ('ne', 'in')] + \
+                  [('timestamp',) + bound for bound in (lower, upper) if bound is not None]
+
+    for name, op, value in filters:
+        query = query.filter(getattr(getattr(model, name), ops[op])(value))
 
     return query
 
 def _sort_query(model, query, sort_spec):
-    '''  '''
+    ''' Order by the columns in ?sort=, which must be in the model's allow-list '''
+    allowed = getattr(model, 'sort_columns', [])
+
     sort = [s.split(',') for s in sort_spec.split(';')]
     for s in sort:
-        if hasattr(model, s[0]):
-            column = getattr(model, s[0])
-            if len(s) == 2 and s[1] in ['asc', 'desc']:
-                query = query.order_by(getattr(column, s[1])())
-            else:
-                query = query.order_by(column.asc())
+        if s[0] not in allowed:
+            raise ValidationError("Can't sort by {}".format(s[0]))
+
+        column = getattr(model, s[0])
+        if len(s) == 2 and s[1] in ['asc', 'desc']:
+            query = query.order_by(getattr(column, s[1])())
+        else:
+            query = query.order_by(column.asc())
 
     return query
 
+COUNT_MODES = ('exact', 'estimate', 'none')
+
+def _count_mode(default='estimate'):
+    ''' How the total of a collection should be counted (?count=) '''
+    mode = request.args.get('count', default)
+
+    if mode not in COUNT_MODES:
+        raise ValidationError("count must be one of exact, estimate or none")
+
+    return mode
+
+def _count_key(model, query, sn=None, plain=False):
+    '''
+        Key for the cached count of `query`. The plain (unfiltered) data of an
+        instrument gets a fixed key so the ingest path can keep it up to date;
+        anything else is keyed by its SQL and parameters
+    '''
+    if plain and sn is not None:
+        return (model.__tablename__, sn, None)
+
+    statement = query.order_by(None).statement.compile()
+
+    return (model.__tablename__, sn, str(statement) + repr(sorted(statement.params.items())))
+
+def _table_estimate(model):
+    ''' Estimated number of rows in the whole table from the table statistics '''
+    if db.engine.dialect.name != 'mysql':
+        return None
+
+    return db.session.execute("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                              "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name",
+                              {'name': model.__tablename__}).scalar()
+
+def _range_estimate(query):
+    ''' Estimated number of rows in the index range `query` reads (one
+        instrument's readings), from the optimizer's EXPLAIN '''
+    if db.engine.dialect.name != 'mysql':
+        return None
+
+    compiled = query.order_by(None).statement.compile(dialect=db.engine.dialect)
+
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    row = db.session.connection().execute('EXPLAIN ' + str(compiled), params).first()
+
+    return None if row is None else row['rows']
+
+def _count(model, query, mode, sn=None, plain=False):
+    '''
+        Return the total for a collection: `exact` always counts (and caches
+        the result), `estimate` uses the cached count or else the table
+        statistics (everything) or the optimizer's estimate (an instrument's
+        plain data) when there is one and `none` doesn't count at all
+    '''
+    if mode == 'none':
+        return None
+
+    key = _count_key(model, query, sn=sn, plain=plain)
+
+    if mode == 'estimate':
+        total = row_counts.get(key)
+        if total is not None:
+            return total
+
+        if query.whereclause is None:
+            total = _table_estimate(model)
+        elif plain and sn is not None:
+            total = _range_estimate(query)
+
+        if total is not None:
+            return int(total)
+
+    return row_counts.set(key, query.order_by(None).count())
+
+class _Page(flask_sqlalchemy.Pagination):
+    ''' A Pagination whose total may be unknown; whether there is a next page
+        comes from reading one row past the page instead '''
+    def __init__(self, query, page, per_page, total, items, more):
+        super(_Page, self).__init__(query, page, per_page, total, items)
+
+        self.more = more
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+
+        return super(_Page, self).pages
+
+    @property
+    def has_next(self):
+        return self.more
+
+def _paginate(query, page, per_page, total, limit=None):
+    ''' query.paginate without the COUNT it always runs; pages stop after the
+        first `limit` rows when it is given '''
+    if page < 1:
+        abort(404)
+
+    offset = (page - 1) * per_page
+    size = per_page + 1 if limit is None else min(per_page + 1, limit - offset)
+
+    items = query.limit(size).offset(offset).all() if size > 0 else []
+
+    if not items and page != 1:
+        abort(404)
+
+    return _Page(query, page, per_page, total, items[:per_page], len(items) > per_page)
+
+def _page_meta(p, mode):
+    pages = {'page': p.page, 'per_page': p.per_page, 'count': mode}
+
+    if p.total is not None:
+        pages['total'] = p.total
+        pages['pages'] = p.pages
+
+    return pages
+
+def _keyset_columns(model):
+    ''' The columns cursor pagination orders by; they must be immutable and
+        unique together, so the primary key always comes last '''
+    for name in ('timestamp', 'opened'):
+        if hasattr(model, name):
+            return [getattr(model, name), model.id]
+
+    return [model.id]
+
+def _encode_cursor(values, order, backwards=False):
+    ''' Return an opaque cursor pointing at the row with key `values` '''
+    state = {'k': [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values],
+             'o': order}
+
+    if backwards:
+        state['b'] = 1
+
+    cursor = base64.urlsafe_b64encode(json_dumps(state, separators=(',', ':')).encode('utf-8'))
+
+    return cursor.decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor, columns):
+    ''' Return (values, order, backwards) from a cursor built by _encode_cursor '''
+    try:
+        state = json_loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+
+        values, order = state['k'], state['o']
+        if len(values) != len(columns) or order not in ('asc', 'desc'):
+            raise ValueError
+
+        values = [parse_timestamp(v) if c.type.python_type is datetime.datetime else v
+                    for c, v in zip(columns, values)]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValidationError("Invalid cursor")
+
+    return values, order, bool(state.get('b'))
+
+def _beyond(columns, values, op):
+    ''' (c0, c1, ...) op (v0, v1, ...), spelled out so every database can
+        use the index; the redundant c0 >= v0 (or <=) lets it seek straight
+        to the cursor instead of scanning the index up to it '''
+    clauses = []
+    for i, column in enumerate(columns):
+        clauses.append(and_(*([c == v for c, v in zip(columns[:i], values[:i])] +
+                              [getattr(column, op)(values[i])])))
+
+    if len(columns) == 1:
+        return clauses[0]
+
+    bound = columns[0].__ge__ if op == '__gt__' else columns[0].__le__
+
+    return and_(bound(values[0]), or_(*clauses))
+
+def _keyset_collection(model, query, per_page, serialize, url_kwargs, count_kwargs={}):
+    '''
+        Cursor (keyset) pagination: pages are read with a range scan on the
+        keyset columns instead of OFFSET, so every page costs the same. The
+        total is only counted when asked for with total=true.
+    '''
+    columns = _keyset_columns(model)
+    cursor = request.args.get('cursor')
+    order = request.args.get('order', 'asc')
+    backwards = False
+
+    if order not in ('asc', 'desc'):
+        raise ValidationError("order must be one of asc or desc")
+
+    if cursor:
+        values, order, backwards = _decode_cursor(cursor, columns)
+
+    ascending = (order == 'asc') != backwards
+
+    pages = {'per_page': per_page, 'order': order}
+
+    # total=true predates ?count= and means an exact count
+    mode = 'exact' if request.args.get('total', '').lower() in ('1', 'true') else _count_mode('none')
+
+    if mode != 'none':
+        pages['total'] = _count(model, query, mode, **count_kwargs)
+
+    if cursor:
+        query = query.filter(_beyond(columns, values, '__gt__' if ascending else '__lt__'))
+
+    query = query.order_by(None).order_by(*[c.asc() if ascending else c.desc() for c in columns])
+
+    items = query.limit(per_page + 1).all()
+
+    more = len(items) > per_page
+    items = items[:per_page]
+
+    if backwards:
+        items.reverse()
+
+    has_next = True if backwards else more
+    has_prev = more if backwards else bool(cursor)
+
+    pages['next'] = pages['next_url'] = pages['prev'] = pages['prev_url'] = None
+
+    if items and has_next:
+        pages['next'] = _encode_cursor([getattr(items[-1], c.key) for c in columns], order)
+        pages['next_url'] = url_for(request.endpoint, cursor=pages['next'], **url_kwargs)
+
+    if items and has_prev:
+        pages['prev'] = _encode_cursor([getattr(items[0], c.key) for c in columns], order, True)
+        pages['prev_url'] = url_for(request.endpoint, cursor=pages['prev'], **url_kwargs)
+
+    return {'data': serialize(items), 'meta': pages}
+
+def _columnar_fields(model, researcher=False):
+    ''' (field, column, unit) for every value ?format=columnar returns '''
+    fields = [('flag', 'flag', None)] + model.json_columns
+
+    if researcher:
+        fields += model.researcher_json_columns
+
+    return fields
+
+# What ?fields= may ask for besides the values in _columnar_fields
+ROW_FIELDS = ('id', 'timestamp', 'timestamp_local', 'instrument')
+
+def _projected_fields(model, researcher=False):
+    ''' The names picked with ?fields= and their (field, column, unit), or
+        None if every field is wanted. Raises a ValidationError for anything
+        unknown or beyond the caller's permissions.
+    '''
+    select = request.args.get('fields')
+    if not select:
+        return None
+
+    names = [name.strip() for name in select.split(',') if name.strip()]
+    available = {field: (field, column, unit) for field, column, unit in _columnar_fields(model, researcher)}
+
+    unknown = [name for name in names if name not in available and name not in ROW_FIELDS]
+    if unknown:
+        raise ValidationError("Unknown fields: {}".format(', '.join(unknown)))
+
+    return names, [available[name] for name in names if name in available]
+
+def _columnar_query(model, query, fields):
+    ''' Select only the columns served, as plain rows instead of ORM objects '''
+    return query.with_entities(model.id, model.timestamp,
+                               *[getattr(model, column).label(field) for field, column, unit in fields])
+
+def _to_columns(rows, fields):
+    ''' Transpose result rows into one list per field '''
+    names = ['id', 'timestamp'] + [field for field, column, unit in fields]
+    columns = dict(zip(names, map(list, zip(*rows)))) if rows else {name: [] for name in names}
+
+    columns['timestamp'] = [ts.isoformat() for ts in columns['timestamp']]
+
+    return columns
+
+def _to_rows(rows, names, fields, device=None):
+    ''' Serialize result rows like to_json would, but only the fields in `names` '''
+    position = {field: i for i, (field, column, unit) in enumerate(fields, 2)}
+    units = {field: unit for field, column, unit in fields}
+
+    items = []
+    for row in rows:
+        item = dict()
+        for name in names:
+            if name == 'id':
+                item['id'] = row[0]
+            elif name == 'timestamp':
+                item['timestamp'] = row[1].isoformat()
+            elif name == 'timestamp_local':
+                item['timestamp_local'] = to_timezone(row[1], device.tz) if device else None
+            elif name == 'instrument':
+                item['instrument'] = device.url if device else None
+            elif units[name] is None:
+                item[name] = row[position[name]]
+            else:
+                item[name] = {'value': row[position[name]], 'unit': units[name]}
+
+        items.append(item)
+
+    return items
+
+def _columnar_meta(fields, sn=None):
+    meta = {'format': 'columnar', 'units': {field: unit for field, column, unit in fields if unit is not None}}
+
+    if sn is not None:
+        meta['instrument'] = url_for('api_1_0.get_device', sn=sn, _external=True, _scheme='https')
+        meta['timezone'] = instrument_directory.get(sn=sn).timezone
+
+    return meta
+
 def _collection(model, query, id=None, name=None, default_per_page=50,
                 max_per_page=10000, researcher=False, **kwargs):
     '''
@@ -80,48 +508,96 @@ def _collection(model, query, id=None, name=None, default_per_page=50,
 
     filter = request.args.get('filter')
     if filter:
-        query = _filter_query(model, query, filter)
+        query = _filter_query(model, query, filter, researcher=researcher)
+
+    # Pagination
+    page = request.args.get('page', 1, type = int)
+    per_page = min(request.args.get('per_page', default_per_page, type=int), max_per_page)
+    expand = request.args.get('expand', 1)
+
+    format = request.args.get('format')
+    if format not in (None, 'columnar'):
+        raise ValidationError("format must be columnar")
+
+    select = request.args.get('fields')
+    projection = _projected_fields(model, researcher=researcher)
+
+    # Every row shares the instrument's URL and timezone
+    device = DeviceContext.from_instrument(instrument_directory.get(sn=kwargs['sn'])) \
+                if kwargs.get('sn') else None
+
+    # One list per field, read straight from the result rows
+    if format:
+        fields = projection[1] if projection else _columnar_fields(model, researcher=researcher)
+        query = _columnar_query(model, query, fields)
+
+        serialize = lambda items: _to_columns(items, fields)
+    elif projection:
+        # Only the columns asked for, without building ORM objects
+        names, fields = projection
+        query = _columnar_query(model, query, fields)
+
+        serialize = lambda items: _to_rows(items, names, fields, device)
+    else:
+        serialize = lambda items: [item.to_json(researcher=researcher, device=device) if expand
+                                    else item.get_url() for item in items]
+
+    if 'cursor' in request.args:
+        rv = _keyset_collection(model, query, per_page, serialize,
+                    dict(id=id, filter=filter, per_page=per_page, expand=expand, format=format,
+                         fields=select, _external=True, _scheme='https', **kwargs),
+                    dict(sn=kwargs.get('sn'), plain=not filter))
+
+        if format:
+            rv['meta'].update(_columnar_meta(fields, kwargs.get('sn')))
+
+        return rv
 
     sort = request.args.get('sort')
     if sort:
         query = _sort_query(model, query, sort)
 
-    limit = request.args.get('limit')
-    if limit:
-        query = query.limit(limit)
+    # Applied when paging rather than to the query, which is still counted
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 0:
+        raise ValidationError("limit must not be negative")
 
-    # Pagination
-    page = request.args.get('page', 1, type = int)
-    per_page = min(request.args.get('per_page', default_per_page, type=int), max_per_page)
-    expand = request.args.get('expand', 1)
+    mode = _count_mode()
+    total = _count(model, query, mode, sn=kwargs.get('sn'), plain=not filter)
+
+    if total is not None and limit is not None:
+        total = min(total, limit)
 
-    p = query.paginate(page, per_page)
-    pages = {'page': page, 'per_page': per_page, 'total': p.total, 'pages': p.pages}
+    p = _paginate(query, page, per_page, total, limit=limit)
+    pages = _page_meta(p, mode)
 
     if p.has_prev:
         pages['prev_url'] = url_for(request.endpoint, id=id, page=p.prev_num,
-                            per_page=per_page, expand=expand, _external=True, _scheme='https', **kwargs)
+                            per_page=per_page, expand=expand, format=format, fields=select,
+                            limit=limit, _external=True, _scheme='https', **kwargs)
     else:
         pages['prev_page'] = None
 
     if p.has_next:
         pages['next_url'] = url_for(request.endpoint, id=id, page=p.next_num,
-                            per_page=per_page, expand=expand, _external=True, _scheme='https', **kwargs)
+                            per_page=per_page, expand=expand, format=format, fields=select,
+                            limit=limit, _external=True, _scheme='https', **kwargs)
     else:
         pages['next_page'] = None
 
     pages['first_url'] = url_for(request.endpoint, id=id, filter=filter, sort=sort, page = 1,
-                            per_page=per_page, expand=expand, _external=True, _scheme='https', **kwargs)
+                            per_page=per_page, expand=expand, format=format, fields=select,
+                            limit=limit, _external=True, _scheme='https', **kwargs)
 
-    pages['last_url'] = url_for(request.endpoint, id=id, filter=filter, sort=sort, page=p.pages,
-                            per_page=per_page, expand=expand, _external=True, _scheme='https', **kwargs)
+    if p.pages:
+        pages['last_url'] = url_for(request.endpoint, id=id, filter=filter, sort=sort, page=p.pages,
+                            per_page=per_page, expand=expand, format=format, fields=select,
+                            limit=limit, _external=True, _scheme='https', **kwargs)
 
-    if expand:
-        items = [item.to_json(researcher=researcher) for item in p.items]
-    else:
-        items = [item.get_url() for item in p.items]
+    if format:
+        pages.update(_columnar_meta(fields, kwargs.get('sn')))
 
-    return {'data': items, 'meta': pages}
+    return {'data': serialize(p.items), 'meta': pages}
 
 def collection(model, name=None, default_per_page=50, max_per_page=10000):
     '''
@@ -147,6 +623,20 @@ def collection(model, name=None, default_per_page=50, max_per_page=10000):
             if filter:
                 query = _filter_query(model, query, filter)
 
+            # Pagination
+            page = request.args.get('page', 1, type=int)
+            per_page = min(request.args.get('per_page', default_per_page, type=int),
+                            max_per_page)
+            expand = request.args.get('expand', 1)
+
+            if 'cursor' in request.args:
+                serialize = lambda items: [item.to_json() if expand else item.get_url() for item in items]
+
+                return _keyset_collection(model, query, per_page, serialize,
+                            dict(filter=filter, per_page=per_page, expand=expand,
+                                 _external=True, _scheme='https', **kwargs),
+                            dict(sn=kwargs.get('sn')))
+
             sort = request.args.get('sort')
             if sort:
                 query = _sort_query(model, query, sort)
@@ -155,15 +645,12 @@ def collection(model, name=None, default_per_page=50, max_per_page=10000):
             #if limit:
             #    query = query.limit(limit)
 
-            # Pagination
-            page = request.args.get('page', 1, type=int)
-            per_page = min(request.args.get('per_page', default_per_page, type=int),
-                            max_per_page)
-            expand = request.args.get('expand', 1)
 
+            mode = _count_mode()
+            total = _count(model, query, mode, sn=kwargs.get('sn'))
 
-            p = query.paginate(page, per_page)
-            pages = {'page': page, 'per_page': per_page, 'total': p.total, 'pages': p.pages}
+            p = _paginate(query, page, per_page, total)
+            pages = _page_meta(p, mode)
 
             if p.has_prev:
                 pages['prev_url'] = url_for(request.endpoint, page=p.prev_num,
@@ -182,7 +669,8 @@ def collection(model, name=None, default_per_page=50, max_per_page=10000):
             pages['first_url'] = url_for(request.endpoint, filter=filter, sort=sort, page=1,
                                     per_page=per_page, expand=expand, _external=True, _scheme='https', **kwargs)
 
-            pages['last_url'] = url_for(request.endpoint, filter=filter, sort=sort, page=p.pages,
+            if p.pages:
+                pages['last_url'] = url_for(request.endpoint, filter=filter, sort=sort, page=p.pages,
                                     per_page=per_page, expand=expand, _external=True, _scheme='https', **kwargs)
 
             if expand:
@@ -215,6 +703,68 @@ def no_cache(f):
     ''' Insert a no-cache directive in the response '''
     return cache_control('private', 'no-cache', 'no-store', 'max-age=0')(f)
 
+def _not_modified():
+    ''' A 304 response, in the same shape as the other API errors '''
+    response = jsonify({'status': 304, 'error': 'not modified',
+                    'message': 'resource not modified'})
+    response.status_code = 304
+    return response
+
+def conditional(validator):
+    ''' Answer conditional GETs before the route runs.
+
+        `validator` is called with the route's arguments and returns a
+        (version, last_modified) pair that changes whenever the resource does,
+        or None to skip. A weak ETag is built from the version, the request
+        URL, the Accept header and the caller's permissions; if it matches
+        If-None-Match (or, without one, last_modified isn't newer than
+        If-Modified-Since) a 304 is returned without running the route.
+        Otherwise the response carries the ETag and Last-Modified headers, so
+        the blueprint doesn't hash its body.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method not in ['GET', 'HEAD']:
+                return f(*args, **kwargs)
+
+            validators = validator(**kwargs)
+            if validators is None:
+                return f(*args, **kwargs)
+
+            version, last_modified = validators
+
+            from .authentication import get_principal, get_api_key
+
+            principal = get_principal(get_api_key())
+            identity = None if principal is None else \
+                    (principal.user_id, principal.instr_sn, sorted(principal.group_ids), sorted(principal.scopes))
+
+            etag = 'W/"' + hashlib.md5(repr((version, request.full_path, request.headers.get('Accept'),
+                                identity)).encode('utf-8')).hexdigest() + '"'
+
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match:
+                etag_list = [weak(tag.strip()) for tag in if_none_match.split(',')]
+                if weak(etag) in etag_list or '*' in etag_list:
+                    return _not_modified()
+            elif last_modified is not None and request.if_modified_since is not None:
+                # HTTP dates have a resolution of a second
+                if last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None):
+                    return _not_modified()
+
+            rv = make_response(f(*args, **kwargs))
+
+            if rv.status_code == 200:
+                rv.headers['ETag'] = etag
+
+                if last_modified is not None:
+                    rv.last_modified = last_modified
+
+            return rv
+        return wrapped
+    return decorator
+
 def etag(f):
     ''' Add entity tag (etag) handling to the decorated route '''
     @functools.wraps(f)
@@ -225,7 +775,9 @@ def etag(f):
         rv = f(*args, **kwargs)
         rv = make_response(rv)
 
-        if rv.status_code != 200:
+        # Hashing a streamed body would read it all into memory first, and
+        # routes with a @conditional validator have already set their own
+        if rv.status_code != 200 or rv.is_streamed or 'ETag' in rv.headers:
             return rv
 
         etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
@@ -242,11 +794,9 @@ def etag(f):
                 response.status_code = 412
                 return response
         elif if_none_match:
-            etag_list = [tag.strip() for tag in if_none_match.split(',')]
+            # Weak comparison, so the compressed response's ETag matches too
+            etag_list = [weak(tag.strip()) for tag in if_none_match.split(',')]
             if etag in etag_list or '*' in etag_list:
-                response = jsonify({'status': 304, 'error': 'not modified',
-                                'message': 'resource not modified'})
-                response.status_code = 304
-                return response
+                return _not_modified()
         return rv
     return wrapped
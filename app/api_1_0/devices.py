@@ -5,7 +5,7 @@ from .. import db
 from . import api_1_0
 from .authentication import requires_credentials, requires_write_access, requires_drop_access
 from .authentication import filter_on_instrument_permissions, requires_viewing_privileges
-from .decorators import json, collection, cache_control
+from .decorators import json, collection, cache_control, conditional
 from ..helpers import calculate_days, model_type
 from .errors import bad_request
 import datetime
@@ -72,8 +72,17 @@ def get_device(sn):
 
     return dev, 200
 
+def _devices_version(**kwargs):
+    """@conditional validator for the device list; every update (heartbeats
+    included) moves last_updated"""
+    count, last_id, modified = db.session.query(db.func.count(Instrument.id),
+                db.func.max(Instrument.id), db.func.max(Instrument.last_updated)).one()
+
+    return (count, last_id, modified), modified
+
 @api_1_0.route('/device/', methods=['GET'])
 @requires_credentials
+@conditional(_devices_version)
 @json
 @collection(Instrument, 'data')
 @filter_on_instrument_permissions(Instrument)
@@ -4,7 +4,7 @@ from flask  import request, abort, url_for, current_app
 from .. import db
 from . import api_1_0
 from .authentication import requires_credentials, requires_write_access
-from .decorators import json, collection, cache_control
+from .decorators import json, collection, cache_control, conditional
 import datetime
 
 @api_1_0.route('/log/', methods=['POST'])
@@ -41,8 +41,22 @@ def update_log(id):
 
     return log, 204
 
+def _logs_version(sn=None, **kwargs):
+    """@conditional validator for the logs (of one instrument); the count and
+    highest id follow new and deleted logs, the revisions edits in place"""
+    query = Log.query
+
+    if sn is not None:
+        query = query.filter_by(instr_sn=sn)
+
+    count, last_id, revisions = query.with_entities(db.func.count(Log.id),
+                db.func.max(Log.id), db.func.sum(Log.revision)).one()
+
+    return (count, last_id, revisions), None
+
 @api_1_0.route('/log/', methods=['GET'])
 @requires_credentials
+@conditional(_logs_version)
 @json
 @collection(Log, 'data')
 def get_all_logs():
@@ -52,6 +66,7 @@ def get_all_logs():
 
 @api_1_0.route('/log/<string:sn>/', methods=['GET'])
 @requires_credentials
+@conditional(_logs_version)
 @json
 @collection(Log, 'data')
 def get_logs_by_device(sn):
@@ -0,0 +1,159 @@
+"""Negotiated compression of API responses and CSV downloads.
+
+Responses are compressed in an app-wide after_request hook, so it runs after
+the API blueprint has set its ETag from the uncompressed body. Compressed
+responses get a weak version of that ETag (the representation differs but the
+content doesn't), which the API compares weakly in If-None-Match.
+
+brotli and zstd are used when the `brotli` and `zstandard` packages are
+installed; gzip always is.
+"""
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class _Gzip(object):
+    def __init__(self, level):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+class _Brotli(object):
+    def __init__(self, level):
+        # brotli qualities go up to 11, gzip levels to 9
+        self._obj = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def flush(self):
+        return self._obj.finish()
+
+class _Zstd(object):
+    def __init__(self, level):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+def available_encodings():
+    """Content codings this process can produce."""
+    encodings = {'gzip': _Gzip}
+
+    if brotli is not None:
+        encodings['br'] = _Brotli
+
+    if zstandard is not None:
+        encodings['zstd'] = _Zstd
+
+    return encodings
+
+def weak(tag):
+    """The opaque part of an entity tag, for weak comparison."""
+    return tag[2:] if tag.startswith('W/') else tag
+
+class ResponseCompressor(object):
+    """Compresses JSON and CSV responses with the best encoding the client
+    accepts (in COMPRESS_ENCODINGS order). Bodies smaller than
+    COMPRESS_MIN_SIZE bytes are sent as is; streamed responses are compressed
+    chunk by chunk as they are sent.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.level = 6
+        self.min_size = 500
+        self.mimetypes = ('application/json', 'text/csv', 'application/msgpack',
+                          'application/vnd.apache.arrow.stream')
+        self.encodings = dict()
+        self.preference = ['gzip']
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESS_RESPONSES', self.enabled)
+        self.level = app.config.get('COMPRESS_LEVEL', self.level)
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        self.mimetypes = tuple(app.config.get('COMPRESS_MIMETYPES', self.mimetypes))
+
+        self.encodings = available_encodings()
+        self.preference = [e for e in app.config.get('COMPRESS_ENCODINGS', self.preference)
+                           if e in self.encodings]
+
+        app.after_request(self.after_request)
+
+    def negotiate(self):
+        """The encoding to use for the current request, or None."""
+        accepted = request.accept_encodings
+
+        best, quality = None, 0
+        for encoding in self.preference:
+            q = accepted[encoding]
+            if q > quality:
+                best, quality = encoding, q
+
+        return best
+
+    def after_request(self, response):
+        if not self.enabled or request.method == 'HEAD':
+            return response
+
+        if response.status_code != 200 or response.direct_passthrough or \
+                response.mimetype not in self.mimetypes or 'Content-Encoding' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        compressor = self.encodings[encoding](self.level)
+
+        if response.is_streamed:
+            response.response = self._stream(response.response, compressor)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+
+            response.set_data(compressor.compress(data) + compressor.flush())
+
+        response.headers['Content-Encoding'] = encoding
+
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+
+        return response
+
+    def _stream(self, chunks, compressor):
+        try:
+            for chunk in chunks:
+                if not isinstance(chunk, bytes):
+                    chunk = chunk.encode('utf-8')
+
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+
+            yield compressor.flush()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+compressor = ResponseCompressor()
@@ -0,0 +1,146 @@
+"""Binary encodings of exported data and API responses.
+
+Downloads can be sent as Parquet or an Arrow IPC stream (typed float and
+timestamp columns, nothing to parse on the other end) and API responses as
+msgpack. These need the optional `pyarrow` and `msgpack` packages; asking for
+a format whose package isn't installed raises a ValidationError.
+"""
+import datetime
+from .exceptions import ValidationError
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# ?format= -> mimetype of the bulk downloads
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+MSGPACK = 'application/msgpack'
+
+# What API responses can be sent as, JSON first
+RESPONSE_MIMETYPES = ['application/json'] + ([MSGPACK] if msgpack is not None else [])
+
+def export_format(name=None, accept=None):
+    """The download format named by ?format=, or else the best of
+    EXPORT_FORMATS in the Accept header (`accept`, a werkzeug MIMEAccept);
+    csv by default.
+    """
+    if name is None and accept is not None:
+        best = accept.best_match(list(EXPORT_FORMATS.values()), default='text/csv')
+        name = next(key for key, mimetype in EXPORT_FORMATS.items() if mimetype == best)
+
+    name = name or 'csv'
+
+    if name not in EXPORT_FORMATS:
+        raise ValidationError("format must be one of {}".format(', '.join(sorted(EXPORT_FORMATS))))
+
+    if name != 'csv' and pyarrow is None:
+        raise ValidationError("format {} is not available".format(name))
+
+    return name
+
+def _arrow_type(column):
+    """The Arrow type of a SQLAlchemy column; values are typed, not strings"""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return pyarrow.string()
+
+    return {
+        float: pyarrow.float64(),
+        int: pyarrow.int64(),
+        bool: pyarrow.bool_(),
+        datetime.datetime: pyarrow.timestamp('ns'),
+    }.get(python_type, pyarrow.string())
+
+def arrow_schema(columns):
+    """The schema of the frames yielded by Instrument.iter_frames, for the
+    data `columns` it was asked for
+    """
+    return pyarrow.schema([pyarrow.field('timestamp', pyarrow.timestamp('ns')),
+                           pyarrow.field('timestamp_local', pyarrow.timestamp('ns'))] +
+                          [pyarrow.field(c.key, _arrow_type(c)) for c in columns])
+
+class _Sink(object):
+    """A write-only file that hands back what was written since it was last
+    drained, so a writer's output can be streamed while it's being written.
+    """
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._written = 0
+
+    def write(self, data):
+        data = bytes(data)
+
+        self._chunks.append(data)
+        self._written += len(data)
+
+        return len(data)
+
+    def tell(self):
+        return self._written
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        data, self._chunks = b''.join(self._chunks), []
+
+        return data
+
+def iter_arrow(frames, schema, format='arrow'):
+    """Encode DataFrames (all with `schema`'s columns, timestamp as the index)
+    as one Arrow IPC stream or Parquet file, yielding bytes as each frame is
+    written. Parquet gets one row group per frame.
+    """
+    sink = _Sink()
+    stream = pyarrow.PythonFile(sink, mode='w')
+
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(stream, schema)
+    else:
+        writer = pyarrow.RecordBatchStreamWriter(stream, schema)
+
+    for frame in frames:
+        table = pyarrow.Table.from_pandas(frame.reset_index()[schema.names], preserve_index=False)
+
+        # Each frame infers its own types (a chunk of NULLs has none at all)
+        writer.write_table(table.cast(schema))
+
+        yield sink.drain()
+
+    writer.close()
+
+    yield sink.drain()
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    raise TypeError("Can't encode {!r}".format(value))
+
+def packb(value):
+    """Encode a JSON-able value (dates as ISO 8601 strings) as msgpack"""
+    if msgpack is None:
+        raise ValidationError("{} is not available".format(MSGPACK))
+
+    return msgpack.packb(value, use_bin_type=True, default=_default)
@@ -4,6 +4,9 @@
 import re
 import datetime
 import os
+import time
+import threading
+from collections import OrderedDict
 from flask import current_app
 import pytz
 
@@ -110,7 +113,8 @@ def to_timezone(timestamp, tzone, isoformat=True, replace=False):
     """
     res = None
     if tzone is not None:
-        local   = pytz.timezone(tzone)
+        # Accept a tzinfo so callers converting many timestamps look it up once
+        local   = pytz.timezone(tzone) if isinstance(tzone, str) else tzone
         res     = timestamp.replace(tzinfo=pytz.UTC).astimezone(local)
 
         if replace:
@@ -120,3 +124,96 @@ def to_timezone(timestamp, tzone, isoformat=True, replace=False):
             res = res.isoformat()
 
     return res
+
+
+def local_timestamps(index, tzone):
+    """Convert a DatetimeIndex of naive UTC timestamps to naive local time in
+    `tzone`; the vectorized equivalent of to_timezone(ts, tzone, replace=True,
+    isoformat=False) for every timestamp.
+    """
+    return index.tz_localize('UTC').tz_convert(tzone).tz_localize(None)
+
+
+class TTLCache(object):
+    """A small in-process cache that holds at most `maxsize` entries, each of
+    which expires `ttl` seconds after it was set (never, if ttl is None). The
+    least recently used entry is evicted first once the cache is full.
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize    = maxsize
+        self.ttl        = ttl
+        self._data      = OrderedDict()
+        self._lock      = threading.Lock()
+
+    def configure(self, maxsize, ttl):
+        """Update the size/ttl limits and empty the cache"""
+        self.maxsize    = maxsize
+        self.ttl        = ttl
+
+        self.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None:
+                return default
+
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+
+                return default
+
+            self._data.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return value
+
+    def update(self, key, func):
+        """Replace the value of a live entry with func(value), keeping its
+        expiry; returns the new value (or None if there was no entry)
+        """
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None or (item[1] is not None and item[1] < time.monotonic()):
+                return None
+
+            value = func(item[0])
+            self._data[key] = (value, item[1])
+
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+
+        return default if item is None else item[0]
+
+    def discard_where(self, predicate):
+        """Drop every entry whose value matches `predicate`"""
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
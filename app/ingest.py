@@ -0,0 +1,438 @@
+"""Helpers for writing batches of readings to the data tables."""
+import re
+import time
+import atexit
+import datetime
+import threading
+from collections import Counter
+from . import db, sentry, socketio
+from .exceptions import ValidationError
+from .models import heartbeats, count_new_readings, forget_counts, latest_readings
+from .aggregation import rollups
+from sqlalchemy.exc import OperationalError, InterfaceError, DisconnectionError
+
+# Errors raised while parsing or validating a single reading; anything in here
+# rejects the reading rather than the whole request
+READING_ERRORS = (IndexError, KeyError, TypeError, ValueError, OverflowError)
+
+# Errors that mean the database could not be reached or cut the transaction
+# short (lost connections, lock timeouts, deadlocks) rather than that the rows
+# were bad; buffered batches that hit one are retried
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, DisconnectionError)
+
+def split_readings(payload):
+    """Split a batched webhook payload into individual readings.
+
+    Readings are separated by newlines or semicolons; blank entries are dropped.
+    """
+    return [r.strip() for r in re.split(r'[\r\n;]+', payload) if r.strip()]
+
+def validate_reading(data):
+    """Raise a ValidationError if a parsed reading should not be stored."""
+    timestamp = data.get('timestamp')
+
+    if timestamp is None:
+        raise ValidationError("Missing timestamp")
+
+    if timestamp.year > datetime.datetime.utcnow().year:
+        raise ValidationError("Invalid timestamp")
+
+    return data
+
+def as_row(model, data):
+    """Build a model instance from `data` (so the usual from_dict validation and
+    key translation applies) and return it as a column -> value mapping that can
+    be passed to a bulk insert.
+    """
+    return to_row(model.create(data))
+
+def to_row(instance):
+    """Return a (not yet persisted) model instance as a column -> value mapping."""
+    row = dict()
+    for column in instance.__table__.columns:
+        value = getattr(instance, column.key)
+
+        # Let the database/column defaults fill these in
+        if value is None and (column.primary_key or column.default is not None):
+            continue
+
+        row[column.key] = value
+
+    return row
+
+def reading_key(model):
+    """Return the columns that identify a single reading of `model` (the
+    columns of its unique index), e.g. ['instr_sn', 'timestamp'].
+    """
+    for index in model.__table__.indexes:
+        if index.unique:
+            return [column.key for column in index.columns]
+
+    return []
+
+def insert_ignore(model):
+    """An INSERT for `model` that silently skips rows violating the unique
+    reading index (MySQL and SQLite).
+    """
+    return model.__table__.insert() \
+                .prefix_with('IGNORE', dialect='mysql') \
+                .prefix_with('OR IGNORE', dialect='sqlite')
+
+def new_rows(model, rows, bind=None):
+    """Drop rows that repeat a reading, either within `rows` or already stored.
+    Existing readings are looked up with a single query over the batch's
+    instruments and time range.
+    """
+    bind = bind if bind is not None else db.session
+    key = reading_key(model)
+
+    if not key or not rows:
+        return rows
+
+    unique, seen = [], set()
+    for row in rows:
+        k = tuple(row.get(column) for column in key)
+
+        if k not in seen:
+            seen.add(k)
+            unique.append(row)
+
+    table = model.__table__
+    timestamps = [row['timestamp'] for row in unique]
+
+    query = db.select([table.c[column] for column in key]) \
+                .where(table.c.instr_sn.in_({row['instr_sn'] for row in unique})) \
+                .where(table.c.timestamp.between(min(timestamps), max(timestamps)))
+
+    existing = set(tuple(each) for each in bind.execute(query))
+
+    return [row for row in unique if tuple(row.get(column) for column in key) not in existing]
+
+def insert_rows(model, rows, bind=None):
+    """Insert a list of column mappings for `model` with a single executemany,
+    skipping readings that are already stored. Returns the number of new rows.
+    The caller is responsible for committing the session.
+    """
+    bind = bind if bind is not None else db.session
+
+    rows = new_rows(model, rows, bind)
+    if not rows:
+        return 0
+
+    # Still INSERT ... IGNORE in case another worker wrote the same reading
+    result = bind.execute(insert_ignore(model), rows)
+
+    inserted = result.rowcount if result.rowcount >= 0 else len(rows)
+
+    counts = Counter(row['instr_sn'] for row in rows)
+    if len(counts) == 1:
+        counts = {sn: inserted for sn in counts}
+
+    if sum(counts.values()) == inserted:
+        count_new_readings(model, counts)
+    else:
+        # Some were repeats, but whose isn't known; recount them
+        forget_counts(model, counts)
+
+    if inserted:
+        rollups.mark(model, rows, bind=bind)
+
+        latest = dict()
+        for row in rows:
+            if row['instr_sn'] not in latest or latest[row['instr_sn']] < row['timestamp']:
+                latest[row['instr_sn']] = row['timestamp']
+
+        latest_readings.seen(latest, bind=bind)
+
+    return inserted
+
+def dedupe_readings(model, dry_run=False):
+    """Delete every repeat of a reading in `model`'s table, keeping the first
+    row stored (lowest id), and create the unique reading index if the table
+    predates it. Returns the number of duplicate rows.
+    """
+    table = model.__table__
+    key = [table.c[column] for column in reading_key(model)]
+
+    # MySQL won't delete from a table it selects from unless the select is
+    # wrapped in a derived table
+    keep = db.select([db.func.min(table.c.id).label('id')]).group_by(*key).alias('keep')
+
+    total = db.session.execute(db.select([db.func.count(table.c.id)])).scalar()
+    unique = db.session.execute(db.select([db.func.count()]).select_from(keep)).scalar()
+
+    if dry_run:
+        return total - unique
+
+    if total > unique:
+        db.session.execute(table.delete().where(~table.c.id.in_(db.select([keep.c.id]))))
+        db.session.commit()
+
+    inspector = db.inspect(db.engine)
+    existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+
+    for index in table.indexes:
+        if index.unique and index.name not in existing:
+            index.create(bind=db.engine)
+
+    return total - unique
+
+class IngestBuffer(object):
+    """Bounded, in-process write-behind buffer for validated readings.
+
+    When INGEST_WRITE_BEHIND is set, the ingest endpoints `put` their rows here
+    and return 202 instead of committing inside the request. A background task
+    writes everything buffered with one bulk insert per data model whenever
+    INGEST_FLUSH_ROWS rows are waiting or every INGEST_FLUSH_INTERVAL_MS, and
+    once more when the process exits.
+
+    The flusher uses its own connection rather than the request-scoped session.
+    Rows have already been acknowledged when they are written, so a batch that
+    fails with a TRANSIENT_ERRORS error is put back and retried on the next
+    flush, up to INGEST_FLUSH_RETRIES times in a row; only rows that fail for
+    any other reason (or run out of retries) are dropped, and reported.
+    """
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.capacity = 10000
+        self.flush_rows = 500
+        self.flush_interval = 1.
+        self.retries = 30
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = dict()
+        self._touched = set()
+        self._failures = dict()
+        self._depth = 0
+        self._running = False
+        self._stopping = False
+        self._registered = False
+
+        self._reset_stats()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('INGEST_WRITE_BEHIND', False)
+        self.capacity = app.config.get('INGEST_BUFFER_SIZE', self.capacity)
+        self.flush_rows = app.config.get('INGEST_FLUSH_ROWS', self.flush_rows)
+        self.flush_interval = app.config.get('INGEST_FLUSH_INTERVAL_MS', 1000) / 1000.
+        self.retries = app.config.get('INGEST_FLUSH_RETRIES', self.retries)
+
+        if self.enabled and not self._registered:
+            atexit.register(self.close)
+            self._registered = True
+
+    def _reset_stats(self):
+        self._stats = {
+            'flushes': 0,
+            'rows_flushed': 0,
+            'rows_failed': 0,
+            'rows_retried': 0,
+            'overflows': 0,
+            'last_flush_ms': None,
+            'max_flush_ms': None,
+            'last_flush_at': None,
+        }
+
+    def put(self, model, rows, instrument_ids=()):
+        """Queue `rows` for `model`. Returns False, without queueing anything, if
+        write-behind is disabled or the rows don't fit; the caller should then
+        write them synchronously.
+        """
+        if not self.enabled or self._stopping:
+            return False
+
+        with self._lock:
+            if self._depth + len(rows) > self.capacity:
+                self._stats['overflows'] += 1
+                return False
+
+            self._pending.setdefault(model, []).extend(rows)
+            self._touched.update(instrument_ids)
+            self._depth += len(rows)
+
+            depth = self._depth
+
+        self._start()
+
+        if depth >= self.flush_rows:
+            self._wakeup.set()
+
+        return True
+
+    def _start(self):
+        if self._running:
+            return
+
+        with self._lock:
+            if self._running:
+                return
+
+            self._running = True
+
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                sentry.captureException()
+
+            # Give the database a full interval to come back, however full
+            # the buffer is
+            if self._failures and not self._stopping:
+                time.sleep(self.flush_interval)
+
+        self._running = False
+
+    def flush(self):
+        """Write everything that is currently buffered; returns the number of
+        rows written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, dict()
+                touched, self._touched = self._touched, set()
+                self._depth = 0
+
+            if not pending and not touched:
+                return 0
+
+            start = time.monotonic()
+
+            with self.app.app_context():
+                written, failed, retried = self._write(pending, touched)
+
+            elapsed = round(1000. * (time.monotonic() - start), 3)
+
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['rows_flushed'] += written
+                self._stats['rows_failed'] += failed
+                self._stats['rows_retried'] += retried
+                self._stats['last_flush_ms'] = elapsed
+                self._stats['max_flush_ms'] = max(elapsed, self._stats['max_flush_ms'] or 0)
+                self._stats['last_flush_at'] = datetime.datetime.utcnow().isoformat()
+
+            return written
+
+    def _requeue(self, model, rows=(), touched=()):
+        """Put rows (and heartbeats) that could not be written back in front of
+        anything buffered since
+        """
+        with self._lock:
+            if rows:
+                self._pending[model] = list(rows) + self._pending.get(model, [])
+                self._depth += len(rows)
+
+            self._touched.update(touched)
+
+    def _retry(self, model, rows):
+        """Requeue `rows` after a transient error; returns False once `model`
+        has run out of retries
+        """
+        attempts = self._failures.get(model, 0) + 1
+
+        if attempts > self.retries or self._stopping:
+            self._failures.pop(model, None)
+
+            return False
+
+        self._failures[model] = attempts
+        self._requeue(model, rows)
+
+        return True
+
+    def _drop(self, model, rows, reason):
+        sentry.captureMessage("Dropped {} buffered {} readings: {}".format(
+                    len(rows), model.__tablename__, reason),
+                    extra={'readings': [(row.get('instr_sn'), str(row.get('timestamp')))
+                                        for row in rows[:100]]})
+
+    def _write_each(self, model, rows):
+        """Write `rows` one at a time, so one bad row can't take the rest of the
+        batch with it. Returns the rows written, the rows dropped and the rows
+        left over after a transient error.
+        """
+        written, failed = 0, 0
+        for index, row in enumerate(rows):
+            try:
+                with db.engine.begin() as conn:
+                    written += insert_rows(model, [row], bind=conn)
+            except TRANSIENT_ERRORS:
+                return written, failed, rows[index:]
+            except Exception as e:
+                failed += 1
+                self._drop(model, [row], str(e))
+
+        return written, failed, []
+
+    def _write(self, pending, touched):
+        written, failed, retried = 0, 0, 0
+        for model, rows in pending.items():
+            rest = []
+
+            try:
+                with db.engine.begin() as conn:
+                    written += insert_rows(model, rows, bind=conn)
+            except TRANSIENT_ERRORS:
+                sentry.captureException()
+
+                rest = rows
+            except Exception:
+                sentry.captureException()
+
+                w, f, rest = self._write_each(model, rows)
+                written, failed = written + w, failed + f
+
+            if not rest:
+                self._failures.pop(model, None)
+            elif self._retry(model, rest):
+                retried += len(rest)
+            else:
+                failed += len(rest)
+                self._drop(model, rest, "out of retries")
+
+        if touched:
+            try:
+                with db.engine.begin() as conn:
+                    heartbeats.beat(touched, bind=conn)
+            except TRANSIENT_ERRORS:
+                sentry.captureException()
+
+                if not self._stopping:
+                    self._requeue(None, touched=touched)
+
+        return written, failed, retried
+
+    def close(self):
+        """Stop the background flusher and write whatever is left; nothing is
+        retried once stopping.
+        """
+        self._stopping = True
+        self._wakeup.set()
+
+        if self.app is not None:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'enabled': self.enabled,
+                'depth': self._depth,
+                'capacity': self.capacity,
+                'flush_rows': self.flush_rows,
+                'flush_interval_ms': int(1000 * self.flush_interval),
+            })
+
+        return stats
+
+ingest_buffer = IngestBuffer()
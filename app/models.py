@@ -1,21 +1,25 @@
 """Models.py."""
-from . import db, login_manager, sentry
+from . import db, login_manager, sentry, socketio
 import os
 from io import StringIO
 import random
-from .utilities import safe_cast
+from .parsers import Field, compile_layout, per_sample
 from datetime import datetime, timedelta
 import pytz
 from flask import current_app, url_for, abort, send_from_directory
 import string
 from app.exceptions import EmptyDataFrameException, S3Exception
-import dateutil.parser
 import pandas as pd
-from .helpers import calculate_start_timestamp, to_timezone
-from sqlalchemy import desc
+from .helpers import calculate_start_timestamp, to_timezone, local_timestamps, TTLCache
+from collections import namedtuple
+from sqlalchemy import desc, event, case
 from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import backref, with_polymorphic
+import threading
+import time
+import atexit
 import base64
+import csv
 import onetimepass
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask_login import UserMixin, AnonymousUserMixin
@@ -352,6 +356,26 @@ class Credentials(db.Model):
 
 		return _scopes
 
+	def to_principal(self):
+		"""Return an immutable snapshot of what these credentials can do"""
+		user = self.User
+
+		scopes = set(self.get_scope())
+
+		if self.can_drop:
+			scopes.add('DROP')
+
+		if user and user.can_view_research_data:
+			scopes.add('RESEARCH')
+
+		return Principal(
+				key=self.key,
+				user_id=self.user_id,
+				instr_sn=self.instr_sn,
+				permissions=user.role.permissions if user and user.role else 0,
+				group_ids=frozenset(g.id for g in user.groups) if user else frozenset(),
+				scopes=frozenset(scopes))
+
 	def drop(self):
 		db.session.delete(self)
 		db.session.commit()
@@ -362,6 +386,76 @@ class Credentials(db.Model):
 		return "{}".format(self.key)
 
 
+class Principal(namedtuple('Principal', ['key', 'user_id', 'instr_sn',
+				'permissions', 'group_ids', 'scopes'])):
+	"""A resolved API key. Principals are cached between requests (see
+	`credentials_cache`) so they must never hold on to session-bound objects.
+	"""
+	__slots__ = ()
+
+	def can(self, permissions):
+		return (self.permissions & permissions) == permissions
+
+	@property
+	def can_manage(self):
+		return self.can(Permission.ADMINISTER)
+
+	def canview(self, device):
+		"""Mirror User.canview for anything with a group_id and user_id"""
+		if self.can_manage:
+			return True
+
+		return device.group_id in self.group_ids or \
+			(self.user_id is not None and device.user_id == self.user_id)
+
+	@property
+	def following(self):
+		"""Mirror User.following"""
+		if self.can_manage:
+			return Instrument.query
+
+		return Instrument.query.filter((Instrument.group_id.in_(self.group_ids) |
+						(Instrument.user_id == self.user_id)))
+
+
+# API key -> Principal; sized and timed in create_app. The TTL bounds how long
+# other workers may keep serving a stale principal after a change.
+credentials_cache = TTLCache()
+
+def invalidate_credentials(user_id=None):
+	"""Drop cached principals for `user_id`, or all of them"""
+	if user_id is None:
+		credentials_cache.clear()
+	else:
+		credentials_cache.discard_where(lambda p: p.user_id == user_id)
+
+@event.listens_for(Credentials, 'after_delete')
+def _credentials_deleted(mapper, connection, target):
+	credentials_cache.pop(target.key)
+
+@event.listens_for(Credentials, 'after_update')
+def _credentials_updated(mapper, connection, target):
+	# Re-keyed or re-scoped in place; the old key may still be cached too
+	for key in [target.key] + list(db.inspect(target).attrs.key.history.deleted):
+		credentials_cache.pop(key)
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+	invalidate_credentials(user_id=target.id)
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+	state = db.inspect(target)
+
+	if any(state.attrs[attr].history.has_changes() for attr in ('role_id', 'role', 'groups')):
+		invalidate_credentials(user_id=target.id)
+
+@event.listens_for(Role, 'after_update')
+def _role_updated(mapper, connection, target):
+	if db.inspect(target).attrs.permissions.history.has_changes():
+		invalidate_credentials()
+
+
 login_manager.anonymous_user = AnonymousUser
 
 ################################################################################
@@ -439,8 +533,23 @@ class Instrument(db.Model):
 	public_cols 	= ['value']
 	private_cols 	= public_cols + []
 
+	# What ?filter= and ?sort= may use; see api_1_0.decorators._filter_query.
+	# There are few enough instruments to sort by the unindexed dates as well
+	filter_columns 	= ['id', 'sn', 'discriminator', 'location', 'city', 'country', 'model',
+						'outdoors', 'private', 'active', 'creation_date', 'last_updated',
+						'user_id', 'group_id']
+	sort_columns 	= ['id', 'sn', 'discriminator', 'city', 'country', 'model',
+						'creation_date', 'last_updated']
+
 	params 			= []
 
+	# parameter -> name of the column holding the id of its calibration Model
+	calibration_models = {}
+
+	# parameter -> (calibrated column, feature columns, model id column) on the
+	# data table; used to recalibrate historical data
+	calibration_columns = {}
+
 	__mapper_args__ = {'polymorphic_on': discriminator, 'polymorphic_identity': 'other'}
 
 	@staticmethod
@@ -559,43 +668,109 @@ class Instrument(db.Model):
 	def most_recent_datapoint(self):
 		"""Return the most recent data point
 		"""
-		m = self._get_data_model()
+		return latest_readings.reading(self._get_data_model(), self.sn)
 
-		q = m.query.filter(m.instr_sn==self.sn).order_by(m.timestamp.desc()).first()
+	def _export_columns(self, cols_to_keep=None):
+		"""The data columns exported alongside the timestamp, in table order"""
+		return [c for c in self._get_data_model().__table__.columns
+					if c.key not in ('id', 'timestamp') and (cols_to_keep is None or c.key in cols_to_keep)]
 
-		return q
+	def _export_query(self, query, columns):
+		"""Only select the timestamp and `columns`, already sorted"""
+		model = self._get_data_model()
+
+		return query.with_entities(model.timestamp, *columns) \
+					.order_by(None).order_by(model.timestamp)
+
+	def _export_frame(self, df, columns):
+		# If the instrument has a timezone, add a column with local_time
+		if self.timezone:
+			df['timestamp_local'] = local_timestamps(df.index, self.timezone)
+
+			# Reorder to make a bit nicer
+			df = df[['timestamp_local'] + [c.key for c in columns]]
+		else:
+			df['timestamp_local'] = None
+
+		return df
 
 	def df_from_query(self, query, cols_to_keep=[], developer=False, dropna=False):
 		"""Create a dataframe from a query.
 		"""
-		#cols_to_keep is a list of the columns to export. If none, all are kept.
+		#cols_to_keep is a list of the columns to export. If None, all are kept.
 		#developer dictates whether to export private cols
+		columns = self._export_columns(cols_to_keep)
+		query = self._export_query(query, columns)
+
 		df = pd.read_sql(
 				query.statement,
 				query.session.bind,
 				index_col='timestamp',
-				parse_dates=True
+				parse_dates=['timestamp']
 				)
 
-		del df['id']
+		return self._export_frame(df, columns)
 
-		# Delete all columns not in cols_to_keep
-		#if not developer and cols_to_keep is not None:
-		if cols_to_keep is not None:
-			for col in df.columns:
-				if not col in cols_to_keep:
-					del df[col]
+	def iter_frames(self, query, cols_to_keep=None, chunksize=50000):
+		"""Yield df_from_query(query, cols_to_keep) `chunksize` rows at a time,
+		read with a server-side cursor
+		"""
+		columns = self._export_columns(cols_to_keep)
+		query = self._export_query(query, columns)
 
-		# If the instrument has a timezone, add a column with local_time
-		if self.timezone:
-			df['timestamp_local'] = df.index.map(lambda x: to_timezone(x, self.timezone, replace=True, isoformat=False))
+		for df in pd.read_sql(
+				query.statement.execution_options(stream_results=True),
+				query.session.bind,
+				index_col='timestamp',
+				parse_dates=['timestamp'],
+				chunksize=chunksize
+				):
+			yield self._export_frame(df, columns)
+
+	def iter_csv(self, query, cols_to_keep=None, chunksize=5000):
+		"""Yield the rows of `query` as CSV text, `chunksize` rows at a time.
+
+		The output matches df_from_query(...).to_csv(), timestamp_local included
+		(second, or last and empty without a timezone), but only the kept columns
+		are selected and rows are streamed in timestamp order with a server-side
+		cursor, so memory use doesn't grow with the time range.
+		"""
+		date_format = '%Y-%m-%dT%H:%M:%SZ'
+		tz = pytz.timezone(self.timezone) if self.timezone else None
 
-			# Reorder to make a bit nicer
-			df = df.reindex(['timestamp_local'] + list([a for a in df.columns if a != 'timestamp_local']), axis=1)
+		columns = self._export_columns(cols_to_keep)
+
+		query = self._export_query(query, columns) \
+					.execution_options(stream_results=True).yield_per(chunksize)
+
+		def fmt(value):
+			return value.strftime(date_format) if isinstance(value, datetime) else value
+
+		buffer = StringIO()
+		writer = csv.writer(buffer, lineterminator='\n')
+
+		if tz:
+			writer.writerow(['timestamp', 'timestamp_local'] + [c.key for c in columns])
 		else:
-			df['timestamp_local'] = None
+			writer.writerow(['timestamp'] + [c.key for c in columns] + ['timestamp_local'])
+
+		for n, row in enumerate(query, 1):
+			values = [fmt(value) for value in row[1:]]
 
-		return df.sort_index()
+			if tz:
+				local = to_timezone(row[0], tz, replace=True, isoformat=False)
+
+				writer.writerow([fmt(row[0]), fmt(local)] + values)
+			else:
+				writer.writerow([fmt(row[0])] + values + [None])
+
+			if n % chunksize == 0:
+				yield buffer.getvalue()
+
+				buffer.seek(0)
+				buffer.truncate()
+
+		yield buffer.getvalue()
 
 	def csv_to_aws(self, bucket_name, t0, tf, developer=False, s3=None, dropna=False):
 		"""Generate a CSV containing the data for a single day or a single month.
@@ -623,7 +798,8 @@ class Instrument(db.Model):
 		data_model = self._get_data_model()
 
 		# Query the data between the two timestamps
-		q = data_model.query.filter(data_model.timestamp >= t0, data_model.timestamp <= tf)
+		q = data_model.query.filter(data_model.instr_sn == self.sn,
+						data_model.timestamp >= t0, data_model.timestamp <= tf)
 
 		# Get the dataframe
 		df = self.df_from_query(q, cols_to_keep=self.cols_to_keep,
@@ -684,12 +860,116 @@ class Instrument(db.Model):
 
 		return True
 
+	@property
+	def model_ids(self):
+		"""Return a dict of parameter -> calibration Model id"""
+		return {param: getattr(self, attr) for param, attr in self.calibration_models.items()}
+
 	def evaluate(self, data):
 		"""Accept a dictionary of data and evaluate all models where applicable.
 		Returns an instance of the new datapoint after evaluation.
 		"""
+		return self.calibrate(data, self.model_ids)
+
+	@classmethod
+	def calibrate(cls, data, model_ids):
+		"""Evaluate the calibration models in `model_ids` (see `model_ids`)
+		against a dictionary of data. Works from ids alone so it can be used
+		without loading the instrument.
+		"""
 		return data
 
+	@staticmethod
+	def calibration_features(model, data, features):
+		"""The values `model` is evaluated on for one reading: its own
+		`prepare(data)` if it has one, otherwise `features` in order. Used both
+		at ingest and by recalibrate so the two agree.
+		"""
+		if hasattr(model, 'prepare'):
+			return model.prepare(data)
+
+		return [data[f] for f in features]
+
+	def recalibrate(self, t0=None, tf=None, chunksize=10000):
+		"""Recompute the calibrated columns of every datapoint between t0 and tf
+		with the instrument's current calibration models.
+
+		Rows are read `chunksize` at a time, each model is evaluated once per
+		chunk on the whole feature matrix and the results are written back with
+		a bulk UPDATE. Rows with missing features are left alone. Returns the
+		number of values updated.
+		"""
+		from .aggregation import rollups
+
+		data_model 	= self._get_data_model()
+		table 		= data_model.__table__
+		model_ids 	= self.model_ids
+		updated 	= 0
+
+		for param, (target, features, model_col) in self.calibration_columns.items():
+			model_id = model_ids.get(param)
+			if not model_id:
+				continue
+
+			model = model_registry.get(model_id)
+			if model is None:
+				sentry.captureMessage("Calibration model not found", extra=dict(
+							instr_sn=self.sn, param=param, model_id=model_id))
+				continue
+
+			# prepare() gets the whole reading at ingest, so give it the whole row
+			if hasattr(model, 'prepare'):
+				columns = list(table.c)
+			else:
+				columns = [table.c.id, table.c.timestamp] + [table.c[f] for f in features]
+
+			last_id = 0
+
+			while True:
+				query = db.select(columns).where(
+							table.c.instr_sn == self.sn).where(table.c.id > last_id)
+
+				if t0 is not None:
+					query = query.where(table.c.timestamp >= t0)
+
+				if tf is not None:
+					query = query.where(table.c.timestamp <= tf)
+
+				rows = db.session.execute(query.order_by(table.c.id).limit(chunksize)).fetchall()
+				if not rows:
+					break
+
+				last_id = rows[-1]['id']
+
+				ids = np.array([row['id'] for row in rows])
+				timestamps = np.array([row['timestamp'] for row in rows])
+				values = np.array([[row[f] for f in features] for row in rows], dtype=float)
+
+				valid = np.isfinite(values).all(axis=1)
+				if not valid.any():
+					continue
+
+				ids, timestamps, values = ids[valid], timestamps[valid], values[valid]
+
+				if hasattr(model, 'prepare'):
+					values = np.vstack([np.asarray(self.calibration_features(model, dict(row), features)).reshape(1, -1)
+								for row, ok in zip(rows, valid) if ok])
+
+				predicted = np.asarray(model.predict(values), dtype=float).ravel()
+
+				db.session.bulk_update_mappings(data_model, [
+						{'id': int(id), target: float(value), model_col: model_id}
+						for id, value in zip(ids, predicted)])
+
+				rollups.mark(data_model, [{'instr_sn': self.sn, 'timestamp': ts} for ts in timestamps],
+							bind=db.session)
+				latest_readings.touch(self.sn)
+				db.session.commit()
+
+				updated += len(ids)
+
+		return updated
+
 	@property
 	def api_token(self):
 		"""Return the current API token"""
@@ -719,6 +999,16 @@ class Instrument(db.Model):
 
 		return True
 
+	@staticmethod
+	def touch(ids):
+		"""Record a heartbeat for every instrument in `ids`. Heartbeats are
+		coalesced and written back every HEARTBEAT_INTERVAL seconds (see
+		HeartbeatTracker), so last_updated can lag by up to that interval.
+		"""
+		heartbeats.beat(ids)
+
+		return True
+
 	def drop(self):
 		db.session.delete(self)
 		db.session.commit()
@@ -741,6 +1031,8 @@ class Orphan(Instrument):
 
 	cols_to_keep = ['value', 'parameter', 'unit', 'flag', 'instr_sn']
 
+	calibration_models = {'value': 'ml_model_id'}
+
 	def __init__(self, private=True, **kwargs):
 		super(Orphan, self).__init__(discriminator='orphan', **kwargs)
 
@@ -798,7 +1090,9 @@ class Orphan(Instrument):
 			results['meta']['xlabel']	= "Datetime [ {} ]".format(self.timezone) if self.timezone else "Datetime [ UTC ]"
 
 			# Export the data
-			results['data'] = [each._plotly(researcher=researcher) for each in data]
+			device = DeviceContext.from_instrument(self)
+
+			results['data'] = [each._plotly(researcher=researcher, device=device) for each in data]
 
 		return results
 
@@ -850,6 +1144,15 @@ class MIT(Instrument):
 
 	params = ['pm1', 'pm25', 'pm10', 'co', 'o3', 'nox', 'so2']
 
+	calibration_models = {'so2': 'so2_model_id', 'co': 'co_model_id', 'o3': 'ox_model_id',
+							'nox': 'nox_model_id', 'pm': 'pm_model_id'}
+	calibration_columns = {
+		'so2': ('so2', ['so2_we', 'so2_ae', 'temp_i', 'rh_i'], 'so2_model_id'),
+		'co': ('co', ['co_we', 'co_ae', 'temp_i', 'rh_i'], 'co_model_id'),
+		'o3': ('o3', ['ox_we', 'ox_ae', 'temp_i', 'rh_i'], 'ox_model_id'),
+		'nox': ('nox', ['nox_we', 'nox_ae', 'temp_i', 'rh_i'], 'nox_model_id'),
+	}
+
 	def __init__(self, private=True, **kwargs):
 		super(MIT, self).__init__(discriminator='mit', **kwargs)
 
@@ -924,7 +1227,9 @@ class MIT(Instrument):
 			results['meta']['xlabel']	= "Datetime [ {} ]".format(self.timezone) if self.timezone else "Datetime [ UTC ]"
 
 			# Export the data
-			results['data'] = [each._plotly(researcher=researcher) for each in data]
+			device = DeviceContext.from_instrument(self)
+
+			results['data'] = [each._plotly(researcher=researcher, device=device) for each in data]
 
 		return results
 
@@ -1038,7 +1343,9 @@ class EBAM(Instrument):
 			results['meta']['ylabel'] 	= 'PM2.5 (ug/m3)'
 
 			# Export the data
-			results['data'] = [each._plotly(researcher=researcher) for each in data]
+			device = DeviceContext.from_instrument(self)
+
+			results['data'] = [each._plotly(researcher=researcher, device=device) for each in data]
 
 		return results
 
@@ -1080,6 +1387,9 @@ class TREX(Instrument):
 
 	params = ['so2']
 
+	calibration_models = {'so2': 'so2_model_id'}
+	calibration_columns = {'so2': ('so2', ['so2_we', 'so2_ae', 'temp', 'rh'], 'model_id')}
+
 	def __init__(self, **kwargs):
 		super(TREX, self).__init__(discriminator='trex', **kwargs)
 
@@ -1096,21 +1406,21 @@ class TREX(Instrument):
 
 		return cols
 
-	def evaluate(self, data):
+	@classmethod
+	def calibrate(cls, data, model_ids):
 		"""Evaluate the dictionary per the most up-to-date model of the parent
 		Returns a dictionary.
 		"""
+		so2_model_id = model_ids.get('so2')
+
 		# Check to see if the parent has a model
 		# If it does, evaluate and set data['so2'], else return the current dictionary
-		if self.so2_model_id:
-			model = self.so2_model.load_from_file()
+		if so2_model_id:
+			model = model_registry.get(so2_model_id)
 
 			# Ensure the model has a `predict` method
 			try:
-				if hasattr(model, 'prepare'):
-					values = model.prepare(data)
-				else:
-					values = [data['so2_we'], data['so2_ae'], data['temp'], data['rh']]
+				values = cls.calibration_features(model, data, cls.calibration_columns['so2'][1])
 			except:
 				sentry.captureException()
 
@@ -1119,7 +1429,7 @@ class TREX(Instrument):
 				data['so2'] = float(model.predict(values)[0])
 
 				# Set the model id
-				data['model_id'] = self.so2_model_id
+				data['model_id'] = so2_model_id
 			except TypeError:
 				sentry.captureException()
 
@@ -1160,7 +1470,9 @@ class TREX(Instrument):
 			results['meta']['xlabel'] = "Datetime [ {} ]".format(self.timezone) if self.timezone else "Datetime [ UTC ]"
 
 			# Export the data
-			results['data'] = [each._plotly(researcher=researcher) for each in data]
+			device = DeviceContext.from_instrument(self)
+
+			results['data'] = [each._plotly(researcher=researcher, device=device) for each in data]
 
 		return results
 
@@ -1202,6 +1514,8 @@ class TrexPM(Instrument):
 
 	params = ['pm25', 'pm10']
 
+	calibration_models = {'pm': 'pm_model_id'}
+
 	def __init__(self, **kwargs):
 		super(TrexPM, self).__init__(discriminator='trex_pm', **kwargs)
 
@@ -1218,9 +1532,6 @@ class TrexPM(Instrument):
 
 		return cols
 
-	def evaluate(self, data):
-		return None
-
 	@staticmethod
 	def create(data):
 		instrument = TrexPM()
@@ -1254,7 +1565,9 @@ class TrexPM(Instrument):
 			results['meta']['xlabel'] = "Datetime [ {} ]".format(self.timezone) if self.timezone else "Datetime [ UTC ]"
 
 			# Export the data
-			results['data'] = [each._plotly(researcher=researcher) for each in data]
+			device = DeviceContext.from_instrument(self)
+
+			results['data'] = [each._plotly(researcher=researcher, device=device) for each in data]
 
 		return results
 
@@ -1287,6 +1600,325 @@ class TrexPM(Instrument):
 		return feature
 
 
+class InstrumentDescriptor(namedtuple('InstrumentDescriptor', ['id', 'sn',
+				'particle_id', 'discriminator', 'instrument_class', 'data_model',
+				'timezone', 'model_ids', 'private', 'group_id', 'user_id',
+				'public_cols', 'private_cols'])):
+	"""A lightweight, session-free view of an Instrument"""
+	__slots__ = ()
+
+	@classmethod
+	def from_instrument(cls, instrument):
+		instrument_class = type(instrument)
+
+		return cls(
+				id=instrument.id,
+				sn=instrument.sn,
+				particle_id=instrument.particle_id,
+				discriminator=instrument.discriminator,
+				instrument_class=instrument_class,
+				data_model=instrument._get_data_model() if hasattr(instrument_class, 'results') else None,
+				timezone=instrument.timezone,
+				model_ids=instrument.model_ids,
+				private=instrument.private,
+				group_id=instrument.group_id,
+				user_id=instrument.user_id,
+				public_cols=tuple(instrument.public_cols),
+				private_cols=tuple(instrument.private_cols))
+
+	def evaluate(self, data):
+		"""Same as Instrument.evaluate"""
+		return self.instrument_class.calibrate(data, self.model_ids)
+
+	def _get_data_model(self):
+		return self.data_model
+
+	# These only need the sn, timezone and data model, so share Instrument's
+	log_event 		= Instrument.log_event
+	_export_columns = Instrument._export_columns
+	_export_query 	= Instrument._export_query
+	_export_frame 	= Instrument._export_frame
+	iter_frames 	= Instrument.iter_frames
+	iter_csv 		= Instrument.iter_csv
+
+
+class DeviceContext(object):
+	"""What the data models' to_json and _plotly need from their instrument,
+	worked out once per page rather than once per row"""
+	__slots__ = ('sn', 'timezone', 'tz', '_url')
+
+	def __init__(self, sn, timezone=None):
+		self.sn 		= sn
+		self.timezone 	= timezone
+		self.tz 		= pytz.timezone(timezone) if timezone else None
+		self._url 		= None
+
+	@classmethod
+	def from_instrument(cls, instrument):
+		return cls(instrument.sn, instrument.timezone)
+
+	@property
+	def url(self):
+		if self._url is None:
+			self._url = url_for('api_1_0.get_device', sn=self.sn, _external=True, _scheme='https')
+
+		return self._url
+
+
+class InstrumentDirectory(object):
+	"""A per-worker lookup of id, sn and particle_id -> InstrumentDescriptor.
+
+	Everything is loaded with a single polymorphic query and reloaded every `ttl`
+	seconds; entries are dropped as soon as an instrument is changed or deleted
+	in this worker. Unknown keys fall through to the database, so instruments
+	created by other workers are found right away, and misses are remembered
+	for `miss_ttl` seconds.
+
+	Descriptors may be up to `ttl` seconds stale in other workers; use access()
+	for authorization.
+	"""
+	def __init__(self, ttl=300, miss_ttl=5):
+		self.ttl 		= ttl
+		self.miss_ttl 	= miss_ttl
+		self._loaded	= None
+		self._index 	= dict()
+		self._missing 	= dict()
+		self._lock 		= threading.Lock()
+
+	def configure(self, ttl, miss_ttl=5):
+		self.ttl = ttl
+		self.miss_ttl = miss_ttl
+
+		self.clear()
+
+	def clear(self):
+		with self._lock:
+			self._index = dict()
+			self._missing = dict()
+			self._loaded = None
+
+	def discard(self, id):
+		"""Forget the instrument with `id` (and any misses, which it may now answer)"""
+		with self._lock:
+			for key in [k for k, v in self._index.items() if v.id == id]:
+				del self._index[key]
+
+			self._missing = dict()
+
+	def _add(self, descriptor):
+		self._index[('id', descriptor.id)] = descriptor
+		self._index[('sn', descriptor.sn)] = descriptor
+
+		if descriptor.particle_id:
+			self._index[('particle_id', descriptor.particle_id)] = descriptor
+
+	def _load(self, **kwargs):
+		instruments = db.session.query(with_polymorphic(Instrument, '*')).filter_by(**kwargs).all()
+
+		return [InstrumentDescriptor.from_instrument(i) for i in instruments]
+
+	def get(self, id=None, sn=None, particle_id=None):
+		"""Return the descriptor for an instrument (or None)"""
+		if self._loaded is None or time.monotonic() - self._loaded > self.ttl:
+			descriptors = self._load()
+
+			with self._lock:
+				self._index = dict()
+				self._loaded = time.monotonic()
+
+				for each in descriptors:
+					self._add(each)
+
+		field, value = [(k, v) for k, v in (('id', id), ('sn', sn),
+							('particle_id', particle_id)) if v is not None][0]
+
+		descriptor = self._index.get((field, value))
+
+		if descriptor is None:
+			expires = self._missing.get((field, value))
+			if expires is not None and expires > time.monotonic():
+				return None
+
+			for each in self._load(**{field: value}):
+				with self._lock:
+					self._add(each)
+
+				descriptor = each
+
+			if descriptor is None:
+				with self._lock:
+					self._missing[(field, value)] = time.monotonic() + self.miss_ttl
+
+		return descriptor
+
+	def access(self, sn):
+		"""The descriptor of `sn` with private, group_id and user_id read from
+		the database rather than the directory (or None), so that permission
+		changes made in other workers apply right away
+		"""
+		row = db.session.query(Instrument.private, Instrument.group_id,
+					Instrument.user_id).filter(Instrument.sn == sn).first()
+
+		if row is None:
+			return None
+
+		# It exists, whatever this worker last heard
+		with self._lock:
+			self._missing.pop(('sn', sn), None)
+
+		descriptor = self.get(sn=sn)
+		if descriptor is None:
+			return None
+
+		return descriptor._replace(private=row.private, group_id=row.group_id,
+					user_id=row.user_id)
+
+	def get_or_404(self, **kwargs):
+		descriptor = self.get(**kwargs)
+
+		if descriptor is None:
+			abort(404)
+
+		return descriptor
+
+
+instrument_directory = InstrumentDirectory()
+
+@event.listens_for(Instrument, 'after_update', propagate=True)
+def _instrument_updated(mapper, connection, target):
+	# last_updated is bumped on every reading and is not part of the descriptor
+	state = db.inspect(target)
+
+	if any(attr.history.has_changes() for attr in state.attrs if attr.key != 'last_updated'):
+		instrument_directory.discard(target.id)
+
+@event.listens_for(Instrument, 'after_insert', propagate=True)
+def _instrument_inserted(mapper, connection, target):
+	# The new instrument may be a remembered miss
+	instrument_directory.discard(target.id)
+
+@event.listens_for(Instrument, 'after_delete', propagate=True)
+def _instrument_deleted(mapper, connection, target):
+	instrument_directory.discard(target.id)
+
+
+class HeartbeatTracker(object):
+	"""Coalesces instrument heartbeats (last_updated) in memory.
+
+	Rather than rewriting the instrument row on every reading, the latest
+	heartbeat per instrument is kept here and written back with one UPDATE
+	every `interval` seconds by a background task. With an interval of 0 the
+	heartbeats are written immediately in the current session instead, which
+	is then committed along with the reading.
+	"""
+	def __init__(self, interval=30):
+		self.app 		= None
+		self.interval 	= interval
+		self._pending 	= dict()
+		self._lock 		= threading.Lock()
+		self._running 	= False
+		self._registered = False
+
+	def configure(self, app, interval):
+		self.app = app
+		self.interval = interval
+
+		if interval and not self._registered:
+			atexit.register(self.close)
+			self._registered = True
+
+	def close(self):
+		"""Write whatever is pending (called at exit)"""
+		if self.app is not None and self._pending:
+			with self.app.app_context():
+				with db.engine.begin() as conn:
+					self.flush(conn)
+
+	def beat(self, ids, timestamp=None, bind=None):
+		"""Record a heartbeat for `ids`. If heartbeats aren't being coalesced
+		they're written right away using `bind` (defaults to the session).
+		"""
+		timestamp = timestamp or datetime.utcnow()
+
+		with self._lock:
+			for id in ids:
+				if self._pending.get(id) is None or self._pending[id] < timestamp:
+					self._pending[id] = timestamp
+
+		if not self.interval or self.app is None:
+			self.flush(bind if bind is not None else db.session)
+		else:
+			self._start()
+
+	def pending(self):
+		with self._lock:
+			return dict(self._pending)
+
+	def flush(self, bind):
+		"""Write every pending heartbeat with a single UPDATE using `bind` (a
+		session or connection); returns the number of instruments updated.
+		"""
+		with self._lock:
+			pending, self._pending = self._pending, dict()
+
+		if not pending:
+			return 0
+
+		table = Instrument.__table__
+
+		try:
+			bind.execute(table.update()
+							.where(table.c.id.in_(list(pending)))
+							.values(last_updated=case(pending, value=table.c.id)))
+		except Exception:
+			# Put them back unless a newer heartbeat has come in since
+			with self._lock:
+				for id, timestamp in pending.items():
+					self._pending.setdefault(id, timestamp)
+			raise
+
+		return len(pending)
+
+	def _start(self):
+		if self._running:
+			return
+
+		with self._lock:
+			if self._running:
+				return
+
+			self._running = True
+
+		socketio.start_background_task(self._run)
+
+	def _run(self):
+		while True:
+			socketio.sleep(self.interval)
+
+			try:
+				with self.app.app_context():
+					with db.engine.begin() as conn:
+						self.flush(conn)
+			except Exception:
+				sentry.captureException()
+
+
+heartbeats = HeartbeatTracker()
+
+# (table, instr_sn, query signature) -> row count for paginated collections.
+# Ingest keeps the unfiltered per-instrument counts (signature None) current;
+# everything else is recounted once it expires.
+row_counts = TTLCache()
+
+def count_new_readings(model, counts):
+	"""Add newly stored readings ({sn: n}) to the cached per-instrument counts"""
+	for sn, n in counts.items():
+		row_counts.update((model.__tablename__, sn, None), lambda count: count + n)
+
+def forget_counts(model, sns):
+	"""Drop the cached per-instrument counts of `sns`, so they're recounted"""
+	for sn in sns:
+		row_counts.pop((model.__tablename__, sn, None))
 
 
 class Data(db.Model):
@@ -1304,6 +1936,9 @@ class Data(db.Model):
 	model_id		= db.Column(db.Integer, db.ForeignKey('model.id', onupdate='CASCADE'), index=True)
 	model 			= db.relationship('Model', foreign_keys=[model_id], uselist=False)
 
+	# Orphans can report several parameters for the same timestamp
+	__table_args__ = (db.Index('uq_data_reading', 'instr_sn', 'parameter', 'timestamp', unique=True),)
+
 	@staticmethod
 	def create(data):
 		new = Data()
@@ -1327,28 +1962,34 @@ class Data(db.Model):
 			except KeyError:
 				pass
 
-	@staticmethod
-	def from_webhook(data, sn):
-		"""Return a dictionary of data after splitting"""
-		data = data.split(',')
+	# timestamp,value,parameter,unit,flag
+	webhook_layout = [
+		Field('value', 1),
+		Field('parameter', 2, str),
+		Field('unit', 3, str),
+		Field('flag', 4, bool),
+	]
 
-		result = dict()
-		result['instr_sn'] = sn
-		result['timestamp'] = dateutil.parser.parse(data[0])
-		result['value'] = safe_cast(data[1])
-		result['parameter'] = data[2]
-		result['unit'] = data[3]
-		result['flag'] = bool(data[4])
+	from_webhook = staticmethod(compile_layout(webhook_layout))
 
-		return result
+	# (field, column, unit) for ?format=columnar; orphans carry their unit per row
+	json_columns = [('value', 'value', None), ('parameter', 'parameter', None),
+					('unit', 'unit', None)]
+	researcher_json_columns = []
+
+	# What ?filter= and ?sort= may use; see api_1_0.decorators._filter_query
+	filter_columns = ['id', 'timestamp', 'flag'] + [column for field, column, unit in json_columns]
+	sort_columns = ['id', 'timestamp']
+
+	def to_json(self, researcher=False, device=None):
+		device = device or DeviceContext.from_instrument(self.device)
 
-	def to_json(self, researcher=False):
 		payload = {'data': [], 'meta': {}}
 
 		payload = {
-			'instrument': self.device.get_url(),
+			'instrument': device.url,
 			'timestamp': self.timestamp.isoformat(),
-			'timestamp_local': to_timezone(self.timestamp, self.device.timezone),
+			'timestamp_local': to_timezone(self.timestamp, device.tz),
 			'flag': self.flag,
 			'id': self.id,
 		}
@@ -1360,14 +2001,16 @@ class Data(db.Model):
 
 		return payload
 
-	def _plotly(self, **kwargs):
+	def _plotly(self, device=None, **kwargs):
 		"""Export each datapoint in a plotly-friendly format"""
 
 		# shouldn't need the first part of this; for some reason, some data points
 		# are being returned with no parent!
-		if self.device and self.device.timezone:
-			tz_local 	= pytz.timezone(self.device.timezone)
-			ts 			= str(self.timestamp.replace(tzinfo=pytz.UTC).astimezone(tz_local).replace(tzinfo=None))
+		if device is None and self.device:
+			device = DeviceContext.from_instrument(self.device)
+
+		if device and device.tz:
+			ts 			= str(self.timestamp.replace(tzinfo=pytz.UTC).astimezone(device.tz).replace(tzinfo=None))
 		else:
 			ts = None
 
@@ -1473,6 +2116,8 @@ class MITData(db.Model):
 	ox_model 		= db.relationship('Model', foreign_keys=[ox_model_id], uselist=False)
 	pm_model 		= db.relationship('Model', foreign_keys=[pm_model_id], uselist=False)
 
+	__table_args__ = (db.Index('uq_mit_data_reading', 'instr_sn', 'timestamp', unique=True),)
+
 	@staticmethod
 	def create(data):
 		new = MITData()
@@ -1503,57 +2148,49 @@ class MITData(db.Model):
 			except KeyError:
 				pass
 
-	@staticmethod
-	def from_webhook(data, sn):
-		"""Return a dictionary of data after splitting"""
-		data = data.split(',')
-
-		mult = int(data[-1])
-		if mult != 0.0:
-			mult = 1./mult
-
-		result = dict()
-		result['instr_sn'] = sn
-		result['timestamp'] = dateutil.parser.parse(data[0])
-		result['cycles'] = safe_cast(data[1], func=int)
-		result['flag'] = safe_cast(data[2], func=int)
-		result['rh_i'] = safe_cast(data[3])
-		result['temp_i'] = safe_cast(data[4])
-		result['co_we'] = safe_cast(data[5])
-		result['co_ae'] = safe_cast(data[6])
-		result['nox_we'] = safe_cast(data[7])
-		result['nox_ae'] = safe_cast(data[8])
-		result['so2_we'] = safe_cast(data[9])
-		result['so2_ae'] = safe_cast(data[10])
-		result['ox_we'] = safe_cast(data[11])
-		result['ox_ae'] = safe_cast(data[12])
-		result['bin0'] = safe_cast(data[13], mult)
-		result['bin1'] = safe_cast(data[14], mult)
-		result['bin2'] = safe_cast(data[15], mult)
-		result['bin3'] = safe_cast(data[16], mult)
-		result['bin4'] = safe_cast(data[17], mult)
-		result['bin5'] = safe_cast(data[18], mult)
-		result['bin6'] = safe_cast(data[19], mult)
-		result['bin7'] = safe_cast(data[20], mult)
-		result['bin8'] = safe_cast(data[21], mult)
-		result['bin9'] = safe_cast(data[22], mult)
-		result['bin10'] = safe_cast(data[23], mult)
-		result['bin11'] = safe_cast(data[24], mult)
-		result['bin12'] = safe_cast(data[25], mult)
-		result['bin13'] = safe_cast(data[26], mult)
-		result['bin14'] = safe_cast(data[27], mult)
-		result['bin15'] = safe_cast(data[28], mult)
-		result['pm1'] = safe_cast(data[29], mult)
-		result['pm25'] = safe_cast(data[30], mult)
-		result['pm10'] = safe_cast(data[31], mult)
-		result['period'] = safe_cast(data[32])
-		result['bin1MToF'] = safe_cast(data[33])
-		result['bin3MToF'] = safe_cast(data[34])
-		result['bin5MToF'] = safe_cast(data[35])
-		result['bin7MToF'] = safe_cast(data[36])
-		result['sfr'] = safe_cast(data[37])
-
-		return result
+	# timestamp,cycles,flag,rh,temp,<electrochem>,bin0..bin15,pm1,pm25,pm10,period,
+	# <MToF>,sfr,samples; bins and PM are accumulated over `samples`
+	webhook_layout = [
+		Field('cycles', 1, int),
+		Field('flag', 2, int),
+		Field('rh_i', 3),
+		Field('temp_i', 4),
+		Field('co_we', 5),
+		Field('co_ae', 6),
+		Field('nox_we', 7),
+		Field('nox_ae', 8),
+		Field('so2_we', 9),
+		Field('so2_ae', 10),
+		Field('ox_we', 11),
+		Field('ox_ae', 12),
+		Field('bin0', 13, float, per_sample),
+		Field('bin1', 14, float, per_sample),
+		Field('bin2', 15, float, per_sample),
+		Field('bin3', 16, float, per_sample),
+		Field('bin4', 17, float, per_sample),
+		Field('bin5', 18, float, per_sample),
+		Field('bin6', 19, float, per_sample),
+		Field('bin7', 20, float, per_sample),
+		Field('bin8', 21, float, per_sample),
+		Field('bin9', 22, float, per_sample),
+		Field('bin10', 23, float, per_sample),
+		Field('bin11', 24, float, per_sample),
+		Field('bin12', 25, float, per_sample),
+		Field('bin13', 26, float, per_sample),
+		Field('bin14', 27, float, per_sample),
+		Field('bin15', 28, float, per_sample),
+		Field('pm1', 29, float, per_sample),
+		Field('pm25', 30, float, per_sample),
+		Field('pm10', 31, float, per_sample),
+		Field('period', 32),
+		Field('bin1MToF', 33),
+		Field('bin3MToF', 34),
+		Field('bin5MToF', 35),
+		Field('bin7MToF', 36),
+		Field('sfr', 37),
+	]
+
+	from_webhook = staticmethod(compile_layout(webhook_layout))
 
 	@staticmethod
 	def fake(ts, sn):
@@ -1597,13 +2234,29 @@ class MITData(db.Model):
 
 		return MITData(**d)
 
-	def to_json(self, researcher=False, **kwargs):
+	json_columns = [('co', 'co', 'ppbv'), ('o3', 'o3', 'ppbv'), ('nox', 'nox', 'ppbv'),
+					('so2', 'so2', 'ppbv'), ('pm1', 'pm1', 'ug/m3'), ('pm25', 'pm25', 'ug/m3'),
+					('pm10', 'pm10', 'ug/m3'), ('rh', 'rh_i', '%'), ('temp', 'temp_i', 'degC')]
+	researcher_json_columns = [('co_we', 'co_we', 'mV'), ('co_ae', 'co_ae', 'mV'),
+					('o3_we', 'ox_we', 'mV'), ('o3_ae', 'ox_ae', 'mV'),
+					('nox_we', 'nox_we', 'mV'), ('nox_ae', 'nox_ae', 'mV'),
+					('so2_we', 'so2_we', 'mV'), ('so2_ae', 'so2_ae', 'mV')] + \
+					[(name, name, None) for name in ['bin{}'.format(i) for i in range(16)] +
+						['bin1MToF', 'bin3MToF', 'bin5MToF', 'bin7MToF', 'period', 'sfr', 'cycles']]
+
+	# What ?filter= and ?sort= may use; see api_1_0.decorators._filter_query
+	filter_columns = ['id', 'timestamp', 'flag'] + [column for field, column, unit in json_columns]
+	sort_columns = ['id', 'timestamp']
+
+	def to_json(self, researcher=False, device=None, **kwargs):
 		"""Return a dictionary of values.
 		"""
+		device = device or DeviceContext.from_instrument(self.device)
+
 		payload = {
 			'timestamp': self.timestamp.isoformat(),
-			'timestamp_local': to_timezone(self.timestamp, self.device.timezone),
-			'instrument': self.device.get_url(),
+			'timestamp_local': to_timezone(self.timestamp, device.tz),
+			'instrument': device.url,
 			'id': self.id,
 			'flag': self.flag,
 		}
@@ -1657,7 +2310,9 @@ class MITData(db.Model):
 
 		return payload
 
-	def _plotly(self, researcher=False, **kwargs):
+	def _plotly(self, researcher=False, device=None, **kwargs):
+		device = device or DeviceContext.from_instrument(self.device)
+
 		res = dict()
 
 		res['timestamp'] = self.timestamp.isoformat()
@@ -1671,9 +2326,9 @@ class MITData(db.Model):
 		res['RH'] = self.rh_i
 		res['Temperature'] = self.temp_i
 
-		if self.device.timezone:
+		if device.tz:
 			res['timestamp'] = str(to_timezone(self.timestamp,
-						self.device.timezone, replace=True, isoformat=False))
+						device.tz, replace=True, isoformat=False))
 
 		if researcher:
 			res['CO_WE'] = self.co_we
@@ -1722,6 +2377,8 @@ class EBamData(db.Model):
 	model_id		= db.Column(db.Integer, db.ForeignKey('model.id', onupdate='CASCADE'), index=True)
 	model 			= db.relationship('Model', foreign_keys=[model_id], uselist=False)
 
+	__table_args__ = (db.Index('uq_ebam_data_reading', 'instr_sn', 'timestamp', unique=True),)
+
 	@staticmethod
 	def create(data):
 		new = EBamData()
@@ -1757,14 +2414,25 @@ class EBamData(db.Model):
 			except KeyError:
 				pass
 
-	def to_json(self, researcher=False):
+	json_columns = [('pm25', 'conc_hr', 'ug/m3'), ('rh', 'rh_external', '%'),
+					('temp', 'ambient_temp', 'degC')]
+	researcher_json_columns = [('pm25_10min', 'conc_rt', 'ug/m3'), ('flowrate', 'flowrate', 'LPM'),
+					('wind_speed', 'wind_speed', ''), ('wind_dir', 'wind_dir', '')]
+
+	# What ?filter= and ?sort= may use; see api_1_0.decorators._filter_query
+	filter_columns = ['id', 'timestamp', 'flag'] + [column for field, column, unit in json_columns]
+	sort_columns = ['id', 'timestamp']
+
+	def to_json(self, researcher=False, device=None):
+		device = device or DeviceContext.from_instrument(self.device)
+
 		# Set up the dictionary to return
 		payload = {
 			'timestamp': self.timestamp.isoformat(),
-			'timestamp_local': to_timezone(self.timestamp, self.device.timezone),
+			'timestamp_local': to_timezone(self.timestamp, device.tz),
 			'flag': self.flag,
 			'id': self.id,
-			'instrument': self.device.get_url(),
+			'instrument': device.url,
 		}
 
 		payload['pm25'] = {'value': self.conc_hr, 'unit': 'ug/m3'}
@@ -1782,14 +2450,9 @@ class EBamData(db.Model):
 	def get_url(self):
 		return url_for('api_1_0.get_datapoint_by_dev', sn=self.instr_sn, id=self.id, _external=True, _scheme='https')
 
-	def _plotly(self, researcher=False, **kwargs):
-		if self.device.timezone:
-			tz_local = pytz.timezone(self.device.timezone)
-			#ts = str(self.timestamp.replace(tzinfo=pytz.UTC).astimezone(tz_local).replace(tzinfo=None))
-			# Assume timezone isn't an issue
-			ts = None
-		else:
-			ts = None
+	def _plotly(self, researcher=False, device=None, **kwargs):
+		# Assume timezone isn't an issue
+		ts = None
 
 		output = {
 			"timestamp": ts if ts else str(self.timestamp),
@@ -1850,6 +2513,8 @@ class TrexData(db.Model):
 	model_id		= db.Column(db.Integer, db.ForeignKey('model.id', onupdate='CASCADE'), index=True)
 	model 			= db.relationship('Model', foreign_keys=[model_id], uselist=False)
 
+	__table_args__ = (db.Index('uq_trex_data_reading', 'instr_sn', 'timestamp', unique=True),)
+
 	@staticmethod
 	def create(data):
 		new = TrexData()
@@ -1873,30 +2538,31 @@ class TrexData(db.Model):
 			except KeyError:
 				pass
 
-	@staticmethod
-	def from_webhook(data, sn):
-		"""Return a dictionary of data after splitting"""
-		data = data.split(',')
-
-		result = dict()
-		result['instr_sn'] = sn
-		result['timestamp'] = dateutil.parser.parse(data[0])
-		result['so2_we'] = safe_cast(data[1])
-		result['so2_ae'] = safe_cast(data[2])
-		result['rh'] = safe_cast(data[3])
-		result['temp'] = safe_cast(data[4])
+	# timestamp,so2_we,so2_ae,rh,temp[,flag]
+	webhook_layout = [
+		Field('so2_we', 1),
+		Field('so2_ae', 2),
+		Field('rh', 3),
+		Field('temp', 4),
+		Field('flag', 5, bool, optional=True),
+	]
 
-		try:
-			result['flag'] = bool(data[5])
-		except: pass
+	from_webhook = staticmethod(compile_layout(webhook_layout))
+
+	json_columns = [('so2', 'so2', 'ppbv'), ('rh', 'rh', '%'), ('temp', 'temp', 'degC')]
+	researcher_json_columns = [('so2_we', 'so2_we', 'mV'), ('so2_ae', 'so2_ae', 'mV')]
 
-		return result
+	# What ?filter= and ?sort= may use; see api_1_0.decorators._filter_query
+	filter_columns = ['id', 'timestamp', 'flag'] + [column for field, column, unit in json_columns]
+	sort_columns = ['id', 'timestamp']
+
+	def to_json(self, researcher=False, device=None):
+		device = device or DeviceContext.from_instrument(self.device)
 
-	def to_json(self, researcher=False):
 		payload = {
 			'timestamp': self.timestamp.isoformat(),
-			'timestamp_local': to_timezone(self.timestamp, self.device.timezone),
-			'instrument': self.device.get_url(),
+			'timestamp_local': to_timezone(self.timestamp, device.tz),
+			'instrument': device.url,
 			'id': self.id,
 			'flag': self.flag,
 		}
@@ -1911,10 +2577,11 @@ class TrexData(db.Model):
 
 		return payload
 
-	def _plotly(self, researcher=False):
-		if self.device.timezone:
-			tz_local = pytz.timezone(self.device.timezone)
-			ts = str(self.timestamp.replace(tzinfo=pytz.UTC).astimezone(tz_local).replace(tzinfo=None))
+	def _plotly(self, researcher=False, device=None):
+		device = device or DeviceContext.from_instrument(self.device)
+
+		if device.tz:
+			ts = str(self.timestamp.replace(tzinfo=pytz.UTC).astimezone(device.tz).replace(tzinfo=None))
 		else:
 			ts = None
 
@@ -1985,6 +2652,8 @@ class TrexPMData(db.Model):
 	model_id		= db.Column(db.Integer, db.ForeignKey('model.id', onupdate='CASCADE'), index=True)
 	model 			= db.relationship('Model', foreign_keys=[model_id], uselist=False)
 
+	__table_args__ = (db.Index('uq_trex_pm_data_reading', 'instr_sn', 'timestamp', unique=True),)
+
 	@staticmethod
 	def create(data):
 		new = TrexPMData()
@@ -2008,37 +2677,40 @@ class TrexPMData(db.Model):
 			except KeyError:
 				pass
 
-	@staticmethod
-	def from_webhook(data, sn):
-		"""Return a dictionary of data after splitting"""
-		data = data.split(',')
-
-		result = dict()
-		result['instr_sn'] = sn
-		result['timestamp'] = dateutil.parser.parse(data[0])
-		result['rh'] = safe_cast(data[1])
-		result['temp'] = safe_cast(data[2])
-		result['pm1'] = safe_cast(data[3])
-		result['pm25'] = safe_cast(data[4])
-		result['pm10'] = safe_cast(data[5])
-		result['bin0'] = safe_cast(data[6])
-		result['bin1'] = safe_cast(data[7])
-		result['bin2'] = safe_cast(data[8])
-		result['bin3'] = safe_cast(data[9])
-		result['bin4'] = safe_cast(data[10])
-		result['bin5'] = safe_cast(data[11])
-
-		try:
-			result['flag'] = bool(data[12])
-		except: pass
-
-		return result
+	# timestamp,rh,temp,pm1,pm25,pm10,bin0..bin5[,flag]
+	webhook_layout = [
+		Field('rh', 1),
+		Field('temp', 2),
+		Field('pm1', 3),
+		Field('pm25', 4),
+		Field('pm10', 5),
+		Field('bin0', 6),
+		Field('bin1', 7),
+		Field('bin2', 8),
+		Field('bin3', 9),
+		Field('bin4', 10),
+		Field('bin5', 11),
+		Field('flag', 12, bool, optional=True),
+	]
+
+	from_webhook = staticmethod(compile_layout(webhook_layout))
+
+	json_columns = [('pm25', 'pm25', 'ug/m3'), ('pm10', 'pm10', 'ug/m3'), ('rh', 'rh', '%'),
+					('temp', 'temp', 'degC')]
+	researcher_json_columns = [('pm1', 'pm1', 'ug/m3')] + \
+					[(name, name, None) for name in ['bin0', 'bin1', 'bin2', 'bin3', 'bin4', 'bin5']]
+
+	# What ?filter= and ?sort= may use; see api_1_0.decorators._filter_query
+	filter_columns = ['id', 'timestamp', 'flag'] + [column for field, column, unit in json_columns]
+	sort_columns = ['id', 'timestamp']
+
+	def to_json(self, researcher=False, device=None):
+		device = device or DeviceContext.from_instrument(self.device)
 
-	def to_json(self, researcher=False):
 		payload = {
 			'timestamp': self.timestamp.isoformat(),
-			'timestamp_local': to_timezone(self.timestamp, self.device.timezone),
-			'instrument': self.device.get_url(),
+			'timestamp_local': to_timezone(self.timestamp, device.tz),
+			'instrument': device.url,
 			'id': self.id,
 			'flag': self.flag,
 		}
@@ -2062,10 +2734,11 @@ class TrexPMData(db.Model):
 
 		return payload
 
-	def _plotly(self, researcher=False):
-		if self.device.timezone:
-			tz_local = pytz.timezone(self.device.timezone)
-			ts = str(self.timestamp.replace(tzinfo=pytz.UTC).astimezone(tz_local).replace(tzinfo=None))
+	def _plotly(self, researcher=False, device=None):
+		device = device or DeviceContext.from_instrument(self.device)
+
+		if device.tz:
+			ts = str(self.timestamp.replace(tzinfo=pytz.UTC).astimezone(device.tz).replace(tzinfo=None))
 		else:
 			ts = None
 
@@ -2120,6 +2793,204 @@ class TrexPMData(db.Model):
 		return "TrexPM: {}, {:.2f}, {:.2f}, {:.2f}, {}".format(self.timestamp.isoformat(), self.pm1, self.pm25, self.pm10, self.flag)
 
 
+class Rollup(db.Model):
+	"""Hourly and daily count/sum/min/max of the values of each instrument,
+	one row per bucket and column (and parameter, for orphans). Kept up to date
+	by aggregation.rollups and rebuilt with `manage.py rebuild_rollups`.
+	"""
+	__tablename__ = 'rollup'
+
+	id 				= db.Column(db.Integer, primary_key=True, autoincrement=True)
+	instr_sn		= db.Column(db.String(24), db.ForeignKey('instrument.sn',
+							onupdate='CASCADE', ondelete='CASCADE'), nullable=False)
+	freq 			= db.Column(db.Integer, nullable=False)
+	timestamp		= db.Column(db.DateTime, nullable=False)
+	field 			= db.Column(db.String(24), nullable=False)
+	parameter 		= db.Column(db.String(24), nullable=False, default='')
+	count 			= db.Column(db.Integer, nullable=False)
+	sum 			= db.Column(db.Float)
+	min 			= db.Column(db.Float)
+	max 			= db.Column(db.Float)
+
+	__table_args__ = (db.Index('uq_rollup_bucket', 'instr_sn', 'freq', 'field', 'parameter',
+						'timestamp', unique=True),)
+
+	def __repr__(self):
+		return "Rollup {} {}s {}: {}".format(self.instr_sn, self.freq, self.timestamp.isoformat(), self.field)
+
+
+class LatestReading(db.Model):
+	"""Timestamp of the most recent reading of each instrument, and when any
+	of its readings last changed (NULL timestamp: unknown, see MAX(timestamp))"""
+	__tablename__ = 'latest_reading'
+
+	instr_sn		= db.Column(db.String(24), db.ForeignKey('instrument.sn',
+							onupdate='CASCADE', ondelete='CASCADE'), primary_key=True)
+	timestamp		= db.Column(db.DateTime)
+	modified		= db.Column(db.DateTime, default=datetime.utcnow)
+	revision		= db.Column(db.Integer, nullable=False, default=1)
+
+	def __repr__(self):
+		return "Latest {}: {}".format(self.instr_sn, self.timestamp)
+
+
+class LatestReadings(object):
+	"""Finds the most recent reading of an instrument without sorting its data.
+
+	The latest_reading table is moved forward whenever readings are stored and
+	mirrored in memory for `ttl` seconds; the reading itself is then a lookup
+	on the (instr_sn, timestamp) index. Instruments without an entry fall back
+	to MAX(timestamp).
+	"""
+	def __init__(self, maxsize=4096, ttl=60):
+		self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+	def configure(self, maxsize, ttl):
+		self._cache.configure(maxsize=maxsize, ttl=ttl)
+
+	def _write(self, sn, timestamp=None, update=None, bind=None):
+		"""Set the entry of `sn` to `timestamp` (or the `update` expression,
+		if the entry exists) and mark it modified
+		"""
+		bind = bind if bind is not None else db.session
+		table = LatestReading.__table__
+		modified = datetime.utcnow()
+
+		update = update if update is not None else timestamp
+
+		if bind.execute(table.update().where(table.c.instr_sn == sn).values(timestamp=update,
+							modified=modified, revision=table.c.revision + 1)).rowcount == 0:
+			bind.execute(table.insert().prefix_with('IGNORE', dialect='mysql')
+							.prefix_with('OR IGNORE', dialect='sqlite'),
+						{'instr_sn': sn, 'timestamp': timestamp, 'modified': modified, 'revision': 1})
+
+		self._cache.pop(sn)
+
+	def seen(self, readings, bind=None):
+		"""Record newly stored readings ({sn: timestamp}) using `bind` (a
+		session or connection; defaults to the session)
+		"""
+		column = LatestReading.__table__.c.timestamp
+
+		for sn, timestamp in readings.items():
+			newer = db.case([(db.or_(column == None, column < timestamp), timestamp)], else_=column)
+
+			self._write(sn, timestamp, update=newer, bind=bind)
+
+	def touch(self, sn, bind=None):
+		"""Record that readings of `sn` were changed in place"""
+		self._write(sn, update=LatestReading.__table__.c.timestamp, bind=bind)
+
+	def forget(self, sn, bind=None):
+		"""Record that readings of `sn` were deleted; its latest reading is
+		looked up again the next time it's needed
+		"""
+		self._write(sn, None, bind=bind)
+
+	def version(self, sn, model):
+		"""((timestamp, revision), modified) of `sn`, read from the database;
+		the first changes whenever a reading of the instrument is stored,
+		updated or deleted, the second is when that last happened. The mirror
+		is refreshed with the timestamp read, so the reading served next is
+		the one this version describes.
+		"""
+		row = db.session.query(LatestReading.timestamp, LatestReading.revision,
+							LatestReading.modified).filter_by(instr_sn=sn).first()
+
+		if row is None:
+			return (self.timestamp(sn, model), None), None
+
+		if row[0] is not None:
+			self._cache.set(sn, row[0])
+		else:
+			self._cache.pop(sn)
+
+		return (row[0], row[1]), row[2]
+
+	def timestamp(self, sn, model=None):
+		"""Timestamp of the most recent reading of `sn` or None. Without an
+		entry, the data table (`model`) is searched if given.
+		"""
+		timestamp = self._cache.get(sn)
+		if timestamp is not None:
+			return timestamp
+
+		timestamp = db.session.query(LatestReading.timestamp).filter_by(instr_sn=sn).scalar()
+
+		if timestamp is None and model is not None:
+			timestamp = db.session.query(db.func.max(model.timestamp)) \
+							.filter(model.instr_sn == sn).scalar()
+
+		if timestamp is not None:
+			self._cache.set(sn, timestamp)
+
+		return timestamp
+
+	def reading(self, model, sn):
+		"""The most recent reading (a `model` instance) of `sn` or None"""
+		timestamp = self.timestamp(sn, model)
+		if timestamp is None:
+			return None
+
+		reading = model.query.filter_by(instr_sn=sn, timestamp=timestamp).first()
+
+		if reading is None:
+			# Deleted or rolled back since; look it up the slow way
+			self._cache.pop(sn)
+
+			reading = model.query.filter(model.instr_sn == sn).order_by(model.timestamp.desc()).first()
+			if reading is not None:
+				self._cache.set(sn, reading.timestamp)
+
+		return reading
+
+	def readings(self, model, sns):
+		"""The most recent readings of several instruments storing `model` as
+		a {sn: reading} dict; everything with an entry is loaded by one query
+		"""
+		sns = set(sns)
+		if not sns:
+			return dict()
+
+		query = model.query.join(LatestReading, db.and_(LatestReading.instr_sn == model.instr_sn,
+							LatestReading.timestamp == model.timestamp)) \
+						.filter(model.instr_sn.in_(sns))
+
+		found = dict()
+		for reading in query:
+			if reading.instr_sn not in found:
+				found[reading.instr_sn] = reading
+				self._cache.set(reading.instr_sn, reading.timestamp)
+
+		for sn in sns - set(found):
+			reading = self.reading(model, sn)
+			if reading is not None:
+				found[sn] = reading
+
+		return found
+
+	def clear(self):
+		self._cache.clear()
+
+
+latest_readings = LatestReadings()
+
+def _reading_inserted(mapper, connection, target):
+	if target.instr_sn is not None and target.timestamp is not None:
+		latest_readings.seen({target.instr_sn: target.timestamp}, bind=connection)
+
+def _reading_updated(mapper, connection, target):
+	latest_readings.touch(target.instr_sn, bind=connection)
+
+def _reading_deleted(mapper, connection, target):
+	latest_readings.forget(target.instr_sn, bind=connection)
+
+for _model in (Data, MITData, EBamData, TrexData, TrexPMData):
+	event.listen(_model, 'after_insert', _reading_inserted)
+	event.listen(_model, 'after_update', _reading_updated)
+	event.listen(_model, 'after_delete', _reading_deleted)
+
+
 ########## OTHER THINGS ############
 class Model(db.Model):
 	__tablename__ = 'model'
@@ -2149,15 +3020,103 @@ class Model(db.Model):
 
 		return Instrument.query.get(self.instr_id)
 
+	@property
+	def path(self):
+		return os.path.join(current_app.config['MODELS_DIR'], self.filename)
+
 	def load_from_file(self):
-		"""Load a model from file using joblib and return
+		"""Load a model from file using joblib and return (served from the
+		model registry once the model has been saved)
 		"""
-		return joblib.load(os.path.join(current_app.config['MODELS_DIR'], self.filename))
+		if self.id is None:
+			return joblib.load(self.path)
+
+		return model_registry.get(self.id, path=self.path)
 
 	def __repr__(self):
 		return self.label
 
 
+class ModelRegistry(object):
+	"""A per-worker LRU of unpickled calibration models keyed by (id, mtime).
+
+	Each model file is loaded at most once per worker and reloaded only if the
+	file changes on disk. With `mmap_mode` set (e.g. 'r'), large numpy arrays
+	in uncompressed pickles are memory-mapped instead of copied, so workers on
+	the same host share those pages.
+	"""
+	def __init__(self, maxsize=16, mmap_mode=None):
+		self.mmap_mode 	= mmap_mode
+		self._models 	= TTLCache(maxsize=maxsize, ttl=None)
+		self._paths 	= dict()
+		self._keys 		= dict()
+
+	def configure(self, maxsize, mmap_mode=None):
+		self.mmap_mode = mmap_mode
+		self._models.configure(maxsize=maxsize, ttl=None)
+
+		self._paths = dict()
+		self._keys = dict()
+
+	def get(self, model_id, path=None):
+		"""Return the unpickled model with `model_id` (or None if it doesn't exist)"""
+		if path is None:
+			path = self._paths.get(model_id)
+
+			if path is None:
+				model = Model.query.get(model_id)
+				if model is None:
+					return None
+
+				path = model.path
+
+		self._paths[model_id] = path
+
+		key = (model_id, os.stat(path).st_mtime)
+
+		model = self._models.get(key)
+		if model is None:
+			model = self._models.set(key, joblib.load(path, mmap_mode=self.mmap_mode))
+
+			# Drop the copy loaded from the previous version of the file
+			previous = self._keys.get(model_id)
+			if previous is not None and previous != key:
+				self._models.pop(previous)
+
+			self._keys[model_id] = key
+
+		return model
+
+	def invalidate(self, model_id=None, filename=None):
+		"""Forget one model (by id or filename) or, with no arguments, all of them"""
+		if model_id is None and filename is None:
+			self._models.clear()
+			self._paths = dict()
+			self._keys = dict()
+
+			return
+
+		ids = [model_id] if model_id is not None else []
+
+		if filename is not None:
+			ids += [k for k, v in self._paths.items() if os.path.basename(v) == filename]
+
+		for each in ids:
+			self._paths.pop(each, None)
+
+			key = self._keys.pop(each, None)
+			if key is not None:
+				self._models.pop(key)
+
+
+model_registry = ModelRegistry()
+
+@event.listens_for(Model, 'after_update')
+@event.listens_for(Model, 'after_delete')
+def _model_changed(mapper, connection, target):
+	model_registry.invalidate(target.id)
+
+
 class Log(db.Model):
 	__tablename__ = 'log'
 
@@ -2168,6 +3127,16 @@ class Log(db.Model):
 	addressed 		= db.Column(db.Boolean, default=False)
 	level 			= db.Column(db.String(12), index=True, default='INFO')
 	instr_sn 		= db.Column(db.String(24), db.ForeignKey('instrument.sn'), index=True)
+	revision 		= db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+	# Cursor pages are read in (opened, id) order, for all logs or one device's
+	__table_args__ = (db.Index('ix_log_opened', 'opened', 'id'),
+					db.Index('ix_log_instr_sn_opened', 'instr_sn', 'opened', 'id'))
+
+	# What ?filter= and ?sort= may use; see api_1_0.decorators._filter_query.
+	# Each sort column has an index (opened through ix_log_opened)
+	filter_columns 	= ['id', 'opened', 'closed', 'addressed', 'level', 'instr_sn']
+	sort_columns 	= ['id', 'opened', 'level', 'instr_sn']
 
 	@staticmethod
 	def create(data):
@@ -2222,3 +3191,9 @@ class Log(db.Model):
 
 	def __repr__(self):
 		return "{} {} {}".format(self.opened, self.level, self.message)
+
+@event.listens_for(Log, 'before_update')
+def _log_updated(mapper, connection, target):
+	# Logs are edited in place; the revision lets conditional GETs notice
+	if any(attr.history.has_changes() for attr in db.inspect(target).attrs if attr.key != 'revision'):
+		target.revision = (target.revision or 0) + 1
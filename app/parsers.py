@@ -0,0 +1,160 @@
+"""Declarative parsers for the comma-separated payloads sent by the Particle
+webhooks.
+
+Each data model describes its wire layout as a list of `Field`s and builds its
+`from_webhook` with `compile_layout`, which generates a specialised parser once
+at import time instead of interpreting the layout for every reading.
+"""
+import re
+import datetime
+from collections import namedtuple
+import dateutil.parser
+
+# Strict ISO-8601 (what the firmware sends); anything else goes to dateutil
+_ISO_8601 = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)'
+                       r'(?:\.(\d{1,6})\d*)?(Z|[+-]\d\d:?\d\d)?$')
+
+def parse_timestamp(value):
+    """Parse a timestamp and return it as a naive datetime in UTC.
+
+    Strict ISO-8601 strings are parsed with a regular expression; everything
+    else falls back to dateutil. Timestamps carrying an offset are converted to
+    UTC, timestamps without one are assumed to already be in UTC.
+    """
+    match = _ISO_8601.match(value)
+    if match is None:
+        ts = dateutil.parser.parse(value)
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        return ts
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+
+    ts = datetime.datetime(int(year), int(month), int(day), int(hour),
+                           int(minute), int(second),
+                           int(fraction.ljust(6, '0')) if fraction else 0)
+
+    if offset and offset != 'Z':
+        delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:]))
+        ts = ts - delta if offset[0] == '+' else ts + delta
+
+    return ts
+
+def to_float(value, multiplier=1):
+    """Cast to a float, returning None for empty, invalid or NaN values."""
+    try:
+        res = float(value)
+    except ValueError:
+        return None
+
+    # NaN is the only value not equal to itself
+    if res != res:
+        return None
+
+    return res * multiplier
+
+def to_int(value, multiplier=1):
+    """Cast to an int, returning None for empty or invalid values."""
+    try:
+        return int(value) * multiplier
+    except ValueError:
+        return None
+
+def to_bool(value, multiplier=1):
+    """Any non-empty value is truthy (matches the firmware's flag encoding)."""
+    return bool(value)
+
+def to_str(value, multiplier=1):
+    return value
+
+CONVERTERS = {
+    float: to_float,
+    int: to_int,
+    bool: to_bool,
+    str: to_str,
+}
+
+class Field(namedtuple('Field', ['name', 'position', 'type', 'multiplier', 'optional'])):
+    """A single field in a webhook payload.
+
+    `multiplier` is either a number or a callable that receives the list of raw
+    values and returns the multiplier for this reading. Optional fields are left
+    out of the result when the payload is too short to contain them; missing
+    required fields raise an IndexError.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, position, type=float, multiplier=1, optional=False):
+        if type not in CONVERTERS:
+            raise ValueError("Unsupported field type: {}".format(type))
+
+        return super(Field, cls).__new__(cls, name, position, type, multiplier, optional)
+
+def compile_layout(layout):
+    """Generate a parser function `parse(data, sn)` for the given layout.
+
+    The timestamp is always the first value. The generated function returns a
+    dictionary ready to be passed to the model's `create`.
+    """
+    namespace = {'parse_timestamp': parse_timestamp}
+    multipliers = dict()
+    required, optional = [], []
+
+    for i, field in enumerate(layout):
+        namespace['convert_{}'.format(i)] = CONVERTERS[field.type]
+
+        if callable(field.multiplier):
+            # Each distinct callable is evaluated once per reading
+            if field.multiplier not in multipliers:
+                multipliers[field.multiplier] = 'multiplier_{}'.format(len(multipliers))
+                namespace['get_' + multipliers[field.multiplier]] = field.multiplier
+
+            multiplier = multipliers[field.multiplier]
+        else:
+            multiplier = repr(field.multiplier)
+
+        expr = 'convert_{}(values[{}], {})'.format(i, field.position, multiplier)
+
+        if field.optional:
+            optional.append((field, expr))
+        else:
+            required.append((field, expr))
+
+    lines = ["def parse(data, sn):",
+             "    values = data.split(',')"]
+
+    for name in multipliers.values():
+        lines.append("    {0} = get_{0}(values)".format(name))
+
+    lines.append("    result = {")
+    lines.append("        'instr_sn': sn,")
+    lines.append("        'timestamp': parse_timestamp(values[0]),")
+    for field, expr in required:
+        lines.append("        {!r}: {},".format(field.name, expr))
+    lines.append("    }")
+
+    for field, expr in optional:
+        lines.append("    if len(values) > {}:".format(field.position))
+        lines.append("        result[{!r}] = {}".format(field.name, expr))
+
+    lines.append("    return result")
+
+    source = '\n'.join(lines)
+
+    exec(compile(source, '<webhook layout>', 'exec'), namespace)
+
+    parse = namespace['parse']
+    parse.layout = tuple(layout)
+    parse.source = source
+    parse.__doc__ = "Return a dictionary of data after splitting"
+
+    return parse
+
+def per_sample(values):
+    """Multiplier for counts that are accumulated over the number of samples
+    sent as the last value of the payload.
+    """
+    samples = int(values[-1])
+
+    return 1. / samples if samples != 0 else 0.
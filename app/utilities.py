@@ -1,5 +1,4 @@
 """Utility functions."""
-import math
 import sendgrid
 import boto3
 import os
@@ -27,22 +26,6 @@ def prev_month_start(dt):
 
     return date(_y, _m, _d)
 
-def safe_cast(value, multiplier=1, func=float):
-    """Cast a value to a float safely."""
-    res = None
-    try:
-        res = func(value)
-    except:
-        pass
-
-    if res is not None and math.isnan(res):
-        res = None
-
-    if res is not None:
-        res = res * multiplier
-
-    return res
-
 def send_email(email_subject, recipient, message, config = None):
     """Send an email using SendGrid."""
     try:
@@ -31,8 +31,57 @@ class Config:
 	TMP_DIR = 'temp_files'
 	MODELS_DIR = 'ml_models'
 
+	# Unpickled calibration models kept per worker; set the mmap mode to 'r' to
+	# memory-map large arrays in uncompressed model files
+	ML_MODEL_CACHE_SIZE = 16
+	ML_MODEL_MMAP_MODE = None
+
 	ALLOWED_EXTENSIONS	= ['csv', 'txt', 'png', 'jpg', 'jpeg', 'md', 'dat', 'pkl', 'sav']
 
+	API_CREDENTIALS_CACHE_SIZE = 4096
+	API_CREDENTIALS_CACHE_TTL = 60
+	INSTRUMENT_DIRECTORY_TTL = 300
+	INSTRUMENT_DIRECTORY_MISS_TTL = 5
+
+	# Totals of paginated collections (?count=estimate) are cached for this long
+	API_ROW_COUNT_CACHE_SIZE = 4096
+	API_ROW_COUNT_TTL = 300
+
+	# ?filter= on unindexed columns of a data table must be limited to a
+	# timestamp range of at most this many days
+	API_FILTER_SCAN_DAYS = 31
+
+	# The latest reading of each instrument is mirrored in memory for this long
+	LATEST_READING_TTL = 60
+
+	# Compress JSON and CSV responses of at least COMPRESS_MIN_SIZE bytes with
+	# the first of COMPRESS_ENCODINGS the client accepts (br and zstd need the
+	# brotli and zstandard packages)
+	COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', '1') == '1'
+	COMPRESS_ENCODINGS = ['br', 'zstd', 'gzip']
+	COMPRESS_LEVEL = 6
+	COMPRESS_MIN_SIZE = 500
+
+	# Instrument last_updated heartbeats are coalesced and written every N seconds
+	HEARTBEAT_INTERVAL = 30
+
+	# Write-behind ingest: buffer validated readings in-process and bulk insert
+	# them every INGEST_FLUSH_ROWS rows or INGEST_FLUSH_INTERVAL_MS
+	INGEST_WRITE_BEHIND = os.environ.get('INGEST_WRITE_BEHIND', '0') == '1'
+	INGEST_BUFFER_SIZE = 10000
+	INGEST_FLUSH_ROWS = 500
+	INGEST_FLUSH_INTERVAL_MS = 1000
+
+	# Buffered rows that can't be written because the database is unreachable
+	# are retried on up to this many consecutive flushes before being dropped
+	INGEST_FLUSH_RETRIES = 30
+
+	# Hours touched by new readings are rolled up every N seconds; the aggregate
+	# endpoint reads hourly and daily buckets from the rollups once they've been
+	# backfilled with `manage.py rebuild_rollups`
+	ROLLUP_INTERVAL = 60
+	AGGREGATE_FROM_ROLLUPS = os.environ.get('AGGREGATE_FROM_ROLLUPS', '0') == '1'
+
 	ALLOWED_POLLUTANTS = ['so2', 'h2s', 'pm25', 'pm10']
 	MAX_AGE_ON_MAP_HRS = 12
 
@@ -61,6 +110,9 @@ class TestingConfig(Config):
 
 	AWS_BUCKET = 'tataaqtest'
 	EMAILS = False
+	INGEST_WRITE_BEHIND = False
+	HEARTBEAT_INTERVAL = 0
+	ROLLUP_INTERVAL = 0
 
 class ProductionConfig(Config):
 	DEBUG = False
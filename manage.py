@@ -177,5 +177,110 @@ def backup(prev_month=False, debug=False):
 	else:
 		daily_backup_data_to_s3(fig)
 
+@manager.command
+def recalibrate(sn=None, t0=None, tf=None, chunksize=10000):
+	"""Recompute calibrated values with each instrument's current models"""
+	from app.models import Instrument
+	from app.parsers import parse_timestamp
+
+	t0 = parse_timestamp(t0) if t0 else None
+	tf = parse_timestamp(tf) if tf else None
+
+	query = Instrument.query
+	if sn is not None:
+		query = query.filter_by(sn=sn)
+
+	for instrument in query.all():
+		if not any(instrument.model_ids.values()):
+			continue
+
+		n = instrument.recalibrate(t0=t0, tf=tf, chunksize=int(chunksize))
+
+		print ("{}: {} values recalibrated".format(instrument.sn, n))
+
+@manager.command
+def rebuild_rollups(sn=None, t0=None, tf=None):
+	"""Recompute the hourly and daily rollups from the raw data (backfills)"""
+	from app.models import Instrument
+	from app.aggregation import rebuild_rollups
+	from app.parsers import parse_timestamp
+
+	t0 = parse_timestamp(t0) if t0 else None
+	tf = parse_timestamp(tf) if tf else None
+
+	query = Instrument.query
+	if sn is not None:
+		query = query.filter_by(sn=sn)
+
+	for instrument in query.all():
+		if not hasattr(type(instrument), 'results'):
+			continue
+
+		n = rebuild_rollups(instrument, start=t0, end=tf)
+
+		print ("{}: {} hours rolled up".format(instrument.sn, n))
+
+@manager.command
+def dedupe_data(dry_run=False):
+	"""Remove repeated readings from the data tables and add the unique index"""
+	from app.models import Data, MITData, EBamData, TrexData, TrexPMData
+	from app.ingest import dedupe_readings
+
+	for model in (Data, MITData, EBamData, TrexData, TrexPMData):
+		n = dedupe_readings(model, dry_run=bool(dry_run))
+
+		print ("{}: {} duplicate rows {}".format(model.__tablename__, n,
+					"found" if dry_run else "removed"))
+
+@manager.command
+def benchmark_parsers(n=10000):
+	"""Time the webhook payload parsers against dateutil"""
+	import timeit
+	import dateutil.parser
+	from app.models import Data, MITData, TrexData, TrexPMData
+	from app.parsers import parse_timestamp
+
+	n = int(n)
+
+	payloads = [
+		(Data, "2017-08-11T04:44:30Z,108.72,o3,ppb,0"),
+		(MITData, "2017-08-21T04:37:00Z,10,1,98.9,72.8,793.3,558.3,569.2,618.2,"
+			"648.7,598.4,833.3,794.0,74.0,8.6,4.0,1.4,0.4,1.0,0.2,0.2,0.0,0.0,0.0,"
+			"0.0,0.0,0.0,0.0,0.0,35.69,42.03,44.43,3.47,6.7,6.7,5.0,2.5,3.65,10"),
+		(TrexData, "2017-08-05T14:00:35Z,12287.8,12287.8,100.0,125.0"),
+		(TrexPMData, "2017-08-05T14:00:35Z,45,20,1,2,3,4,5,6,7,8,9,1"),
+	]
+
+	def report(label, seconds):
+		print ("{:<28} {:>8.2f} us/call".format(label, 1e6 * seconds / n))
+
+	report("dateutil.parser.parse", timeit.timeit(
+		lambda: dateutil.parser.parse("2017-08-21T04:37:00Z"), number=n))
+	report("parse_timestamp", timeit.timeit(
+		lambda: parse_timestamp("2017-08-21T04:37:00Z"), number=n))
+
+	for model, payload in payloads:
+		report("{}.from_webhook".format(model.__name__), timeit.timeit(
+			lambda: model.from_webhook(payload, 'SN000001'), number=n))
+
+@manager.command
+def benchmark_local_time(n=1000000):
+	"""Time adding timestamp_local to n readings, per row vs vectorized"""
+	import timeit
+	import pandas as pd
+	from app.helpers import to_timezone, local_timestamps
+
+	n = int(n)
+	tz = 'Asia/Kolkata'
+	index = pd.date_range('2018-01-01', periods=n, freq='min', name='timestamp')
+
+	def report(label, seconds):
+		print ("{:<28} {:>8.3f} s ({:.3f} us/row)".format(label, seconds, 1e6 * seconds / n))
+
+	report("to_timezone (per row)", timeit.timeit(
+		lambda: index.map(lambda x: to_timezone(x, tz, replace=True, isoformat=False)), number=1))
+	report("local_timestamps", timeit.timeit(
+		lambda: local_timestamps(index, tz), number=1))
+
 if __name__ == '__main__':
 	manager.run()
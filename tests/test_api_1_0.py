@@ -1,6 +1,6 @@
 import unittest
 from app.models import *
-from app import assets
+from app import assets, formats
 from app import create_app, db
 from base64 import b64encode
 import json
@@ -150,6 +150,78 @@ class CredentialsModelTestCase(unittest.TestCase):
 
         self.assertEqual(s, 401)
 
+    def test_credentials_cache(self):
+        u = User.query.filter_by(role=self.role_user).first()
+        token = u.api_token
+
+        r, s, h = self.get(url_for('api_1_0.check_auth'), token=token)
+
+        self.assertEqual(s, 200)
+        self.assertIn(token, credentials_cache)
+        self.assertNotIn('RESEARCH', credentials_cache.get(token).scopes)
+
+        # Changing the role should drop the cached principal
+        u = User.query.filter_by(role=self.role_user).first()
+        u.role = Role.query.filter_by(name='Researcher').first()
+
+        db.session.add(u)
+        db.session.commit()
+
+        self.assertNotIn(token, credentials_cache)
+
+        r, s, h = self.get(url_for('api_1_0.check_auth'), token=token)
+
+        self.assertIn('RESEARCH', credentials_cache.get(token).scopes)
+
+        # Re-scoping a key in place should take effect on the next request
+        creds = Credentials.query.filter_by(key=token).first()
+        creds.user_id = None
+
+        db.session.add(creds)
+        db.session.commit()
+
+        self.assertNotIn(token, credentials_cache)
+
+        r, s, h = self.get(url_for('api_1_0.check_auth'), token=token)
+
+        self.assertIsNone(credentials_cache.get(token).user_id)
+
+        creds.user_id = u.id
+
+        db.session.add(creds)
+        db.session.commit()
+
+        # ...as should re-keying it, for both the old and the new key
+        r, s, h = self.get(url_for('api_1_0.check_auth'), token=token)
+
+        self.assertIn(token, credentials_cache)
+
+        creds.key = 'REKEYED0000000000000000'
+
+        db.session.add(creds)
+        db.session.commit()
+
+        self.assertNotIn(token, credentials_cache)
+
+        r, s, h = self.get(url_for('api_1_0.check_auth'), token=token)
+
+        self.assertEqual(s, 401)
+
+        token = creds.key
+
+        r, s, h = self.get(url_for('api_1_0.check_auth'), token=token)
+
+        self.assertEqual(s, 200)
+
+        # Dropping the key should take effect immediately
+        Credentials.query.filter_by(key=token).first().drop()
+
+        self.assertNotIn(token, credentials_cache)
+
+        r, s, h = self.get(url_for('api_1_0.check_auth'), token=token)
+
+        self.assertEqual(s, 401)
+
     def test_no_auth_key(self):
         r, s, v = self.get(url_for('api_1_0.check_auth'), token='na')
 
@@ -390,6 +462,165 @@ class CredentialsModelTestCase(unittest.TestCase):
         self.assertEqual(pt.rh_i, 98.9)
         self.assertEqual(pt.temp_i, 72.8)
 
+    def test_webhook_post_batch(self):
+        t = TREX.query.first()
+        n = t.results.count()
+
+        readings = [
+            "2017-08-05T14:00:35Z,12287.8,12287.8,100.0,125.0",
+            "2017-08-05T14:01:35Z,12280.1,12281.4,99.0,124.0",
+            "not-a-timestamp,1.0",
+            "2017-08-05T14:02:35Z,12283.3,12282.0,98.0,123.0"
+        ]
+
+        data = {
+              "name": "RAW",
+              "data": "\n".join(readings),
+              "coreid": t.particle_id,
+            }
+
+        resp = self.client.post(url_for('api_1_0.webhook_post_batch'),
+                    headers=self._get_headers(form=True),
+                    content_type='application/x-www-form-urlencoded',
+                    data=data)
+
+        body = json.loads(resp.get_data(as_text=True))
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(body['accepted'], 3)
+        self.assertEqual(body['rejected'], 1)
+        self.assertEqual(body['results'][2]['status'], 'rejected')
+
+        t = TREX.query.first()
+
+        self.assertEqual(t.results.count(), n + 3)
+
+        # Webhook retries are acknowledged without storing the readings twice
+        resp = self.client.post(url_for('api_1_0.webhook_post_batch'),
+                    headers=self._get_headers(form=True),
+                    content_type='application/x-www-form-urlencoded',
+                    data=data)
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(t.results.count(), n + 3)
+
+        # Nothing valid should be a bad request
+        data['data'] = "bad;data"
+
+        resp = self.client.post(url_for('api_1_0.webhook_post_batch'),
+                    headers=self._get_headers(form=True),
+                    content_type='application/x-www-form-urlencoded',
+                    data=data)
+
+        self.assertEqual(resp.status_code, 400)
+
+        # ...as is a device without a webhook layout
+        e = EBAM.query.filter_by(sn='EBAM002').first()
+        e.particle_id = 'ebam002'
+
+        db.session.commit()
+
+        data['coreid'] = 'ebam002'
+
+        resp = self.client.post(url_for('api_1_0.webhook_post_batch'),
+                    headers=self._get_headers(form=True),
+                    content_type='application/x-www-form-urlencoded',
+                    data=data)
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_webhook_post_write_behind(self):
+        from app.ingest import ingest_buffer
+
+        t = TREX.query.first()
+        n = t.results.count()
+
+        # Enable write-behind with thresholds that leave flushing to us
+        self.app.config['INGEST_WRITE_BEHIND'] = True
+        self.app.config['INGEST_FLUSH_ROWS'] = 1000
+        self.app.config['INGEST_FLUSH_INTERVAL_MS'] = 60000
+
+        ingest_buffer.init_app(self.app)
+
+        try:
+            flushed = ingest_buffer.stats()['rows_flushed']
+
+            data = {
+                  "name": "RAW",
+                  "data": "2017-08-05T14:00:35Z,12287.8,12287.8,100.0,125.0",
+                  "coreid": t.particle_id,
+                }
+
+            resp = self.client.post(url_for('api_1_0.webhook_post'),
+                        headers=self._get_headers(form=True),
+                        content_type='application/x-www-form-urlencoded',
+                        data=data)
+
+            self.assertEqual(resp.status_code, 202)
+
+            data['data'] = "2017-08-05T14:01:35Z,12280.1,12281.4,99.0,124.0;" \
+                            "2017-08-05T14:02:35Z,12283.3,12282.0,98.0,123.0"
+
+            resp = self.client.post(url_for('api_1_0.webhook_post_batch'),
+                        headers=self._get_headers(form=True),
+                        content_type='application/x-www-form-urlencoded',
+                        data=data)
+
+            self.assertEqual(resp.status_code, 202)
+
+            # Nothing has been written yet
+            self.assertEqual(ingest_buffer.stats()['depth'], 3)
+            self.assertEqual(t.results.count(), n)
+
+            self.assertEqual(ingest_buffer.flush(), 3)
+
+            stats = ingest_buffer.stats()
+
+            self.assertEqual(stats['depth'], 0)
+            self.assertEqual(stats['rows_flushed'], flushed + 3)
+            self.assertIsNotNone(stats['last_flush_ms'])
+
+            self.assertEqual(t.results.count(), n + 3)
+
+            # Rows that hit a database outage are put back and retried
+            from app import ingest
+            from sqlalchemy.exc import OperationalError
+
+            insert_rows = ingest.insert_rows
+
+            def unreachable(*args, **kwargs):
+                raise OperationalError('INSERT', {}, Exception('server has gone away'))
+
+            data['data'] = "2017-08-05T14:03:35Z,12280.1,12281.4,99.0,124.0"
+
+            resp = self.client.post(url_for('api_1_0.webhook_post_batch'),
+                        headers=self._get_headers(form=True),
+                        content_type='application/x-www-form-urlencoded',
+                        data=data)
+
+            self.assertEqual(resp.status_code, 202)
+
+            before = ingest_buffer.stats()
+
+            ingest.insert_rows = unreachable
+            try:
+                self.assertEqual(ingest_buffer.flush(), 0)
+            finally:
+                ingest.insert_rows = insert_rows
+
+            stats = ingest_buffer.stats()
+
+            self.assertEqual(stats['depth'], 1)
+            self.assertEqual(stats['rows_retried'], before['rows_retried'] + 1)
+            self.assertEqual(stats['rows_failed'], before['rows_failed'])
+
+            self.assertEqual(ingest_buffer.flush(), 1)
+            self.assertEqual(t.results.count(), n + 4)
+        finally:
+            self.app.config['INGEST_WRITE_BEHIND'] = False
+
+            ingest_buffer.init_app(self.app)
+
     def test_webhook_post_meta(self):
         t = Orphan.query.first()
 
@@ -475,6 +706,11 @@ class CredentialsModelTestCase(unittest.TestCase):
 
         self.assertEqual(resp.status_code, 201)
 
+        # The event is logged against the instrument found by its particle_id
+        log = Log.query.filter_by(instr_sn=t.sn).order_by(Log.id.desc()).first()
+
+        self.assertEqual(log.message, 'Device Reset: success')
+
         data = {
             "data": "success",
             "name": "spark/flash/status",
@@ -517,6 +753,52 @@ class CredentialsModelTestCase(unittest.TestCase):
 
         self.assertEqual(s, 201)
 
+        n = i.results.count()
+
+        # Posting the same reading again returns the stored datapoint
+        data['conc_rt'] = 2.
+
+        dup, s, v = self.post(url_for('api_1_0.data_post'), data=data)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(dup['id'], r['id'])
+        self.assertEqual(i.results.count(), n)
+
+    def test_post_data_bulk(self):
+        ebam = EBAM.query.first()
+        trex = TREX.query.first()
+
+        n_ebam, n_trex = ebam.results.count(), trex.results.count()
+
+        data = [
+            {'timestamp': "2017-01-01 12:01:32", 'instr_sn': ebam.sn,
+                'conc_rt': 1., 'conc_hr': 23., 'alarm': 0},
+            {'timestamp': "2017-01-01 12:01:32", 'instr_sn': trex.sn,
+                'so2': 12., 'so2_we': 230., 'so2_ae': 220., 'temp': 21., 'rh': 50.},
+            {'timestamp': "2017-01-01 12:02:32", 'instr_sn': trex.sn,
+                'so2': 13., 'so2_we': 231., 'so2_ae': 221., 'temp': 21., 'rh': 50.},
+            {'timestamp': "2017-01-01 12:01:32", 'instr_sn': 'NOT-A-DEVICE'},
+            {'instr_sn': trex.sn, 'so2': 12.}
+        ]
+
+        r, s, v = self.post(url_for('api_1_0.data_post_bulk'), data=data)
+
+        self.assertEqual(s, 201)
+        self.assertEqual(r['created'], 3)
+        self.assertEqual(r['rejected'], 2)
+        self.assertEqual([x['status'] for x in r['results']],
+                    ['created', 'created', 'created', 'rejected', 'rejected'])
+
+        ebam, trex = EBAM.query.first(), TREX.query.first()
+
+        self.assertEqual(ebam.results.count(), n_ebam + 1)
+        self.assertEqual(trex.results.count(), n_trex + 2)
+
+        # Not an array
+        r, s, v = self.post(url_for('api_1_0.data_post_bulk'), data={'instr_sn': trex.sn})
+
+        self.assertEqual(s, 400)
+
     def test_get_paginated_data(self):
         i = Orphan.query.first()
 
@@ -525,6 +807,489 @@ class CredentialsModelTestCase(unittest.TestCase):
         self.assertEqual(s, 200)
         self.assertIsNotNone(r['meta']['first_url'])
 
+    def test_get_cursor_paginated_data(self):
+        i = TREX.query.first()
+        sn, n = i.sn, i.results.count()
+
+        # Walk forward through every page
+        ids, cursor, pages = [], '', []
+        while cursor is not None:
+            r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, cursor=cursor,
+                                per_page=3), token=self.admin_api_key)
+
+            self.assertEqual(s, 200)
+            self.assertNotIn('total', r['meta'])
+
+            ids += [x['id'] for x in r['data']]
+            pages.append(r)
+            cursor = r['meta']['next']
+
+        self.assertEqual(len(ids), n)
+        self.assertEqual(len(set(ids)), n)
+        self.assertIsNone(pages[0]['meta']['prev'])
+
+        timestamps = [x['timestamp'] for p in pages for x in p['data']]
+
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        # ...and back one page
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn,
+                            cursor=pages[-1]['meta']['prev'], per_page=3), token=self.admin_api_key)
+
+        self.assertEqual([x['id'] for x in r['data']], [x['id'] for x in pages[-2]['data']])
+
+        # Newest first, with the total
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, cursor='', order='desc',
+                            total='true', per_page=3), token=self.admin_api_key)
+
+        self.assertEqual(r['meta']['total'], n)
+        self.assertEqual(r['data'][0]['id'], ids[-1])
+
+        # Tampered cursors are rejected
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, cursor='not-a-cursor'),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 400)
+
+        # Logs and devices take cursors as well
+        r, s, v = self.get(url_for('api_1_0.get_all_logs', cursor='', per_page=2),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+
+        r, s, v = self.get(url_for('api_1_0.get_devices', cursor='', per_page=2),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertTrue(len(r['data']) <= 2)
+
+    def test_cursor_query_plans(self):
+        from app.api_1_0.decorators import _beyond, _keyset_columns
+
+        i = TREX.query.first()
+
+        def explain(query):
+            compiled = query.statement.compile(dialect=db.engine.dialect)
+            params = [compiled.params[name] for name in compiled.positiontup]
+
+            rows = db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), *params)
+
+            return ' '.join(str(row[-1]) for row in rows)
+
+        opened = datetime.datetime(2018, 1, 1)
+
+        # Log pages seek to the cursor on (opened, id), for all logs or one
+        # device's, and are read in index order
+        for query, index in ((Log.query, 'ix_log_opened'),
+                             (Log.query.filter_by(instr_sn=i.sn), 'ix_log_instr_sn_opened')):
+            columns = _keyset_columns(Log)
+
+            for op, order in (('__gt__', 'asc'), ('__lt__', 'desc')):
+                plan = explain(query.filter(_beyond(columns, [opened, 10], op))
+                                    .order_by(*[getattr(c, order)() for c in columns]))
+
+                self.assertIn(index, plan)
+                self.assertIn('opened', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+        # ...as do data pages on the reading index
+        columns = _keyset_columns(TrexData)
+
+        plan = explain(TrexData.query.filter_by(instr_sn=i.sn)
+                            .filter(_beyond(columns, [opened, 10], '__gt__'))
+                            .order_by(*columns))
+
+        self.assertIn('uq_trex_data_reading', plan)
+        self.assertIn('timestamp>', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_get_aggregate_data(self):
+        i = TREX.query.first()
+        readings = i.results.all()
+
+        r, s, v = self.get(url_for('api_1_0.get_aggregate_by_dev', sn=i.sn, freq='1d',
+                            agg='mean,max,count'), token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(r['meta']['agg'], ['mean', 'max', 'count'])
+        self.assertEqual(r['meta']['units']['so2'], 'ppbv')
+        self.assertEqual(sum(x['so2_count'] for x in r['data']), len(readings))
+        self.assertAlmostEqual(max(x['so2_max'] for x in r['data']), max(x.so2 for x in readings))
+
+        for x in r['data']:
+            self.assertTrue(x['timestamp'].endswith('T00:00:00'))
+
+        # Percentiles are computed with pandas instead
+        r, s, v = self.get(url_for('api_1_0.get_aggregate_by_dev', sn=i.sn, freq='10min',
+                            agg='count,p95'), token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(sum(x['so2_count'] for x in r['data']), len(readings))
+        self.assertIn('so2_p95', r['data'][0])
+
+        timestamps = [x['timestamp'] for x in r['data']]
+
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        # Researchers get the raw signals as well
+        r, s, v = self.get(url_for('api_1_0.get_aggregate_by_dev', sn=i.sn, agg='mean'),
+                            token=self.admin_api_key)
+
+        self.assertIn('so2_we_mean', r['data'][0])
+
+        for params in [dict(freq='1w'), dict(agg='median'), dict(start='2018-01-02', end='2018-01-01')]:
+            r, s, v = self.get(url_for('api_1_0.get_aggregate_by_dev', sn=i.sn, **params),
+                                token=self.admin_api_key)
+
+            self.assertEqual(s, 400)
+
+        # Hourly and daily buckets can come from the rollups instead
+        for freq in ('1h', '1d'):
+            url = url_for('api_1_0.get_aggregate_by_dev', sn=i.sn, freq=freq, agg='mean,max,count,sum')
+
+            self.app.config['AGGREGATE_FROM_ROLLUPS'] = False
+            raw, s, v = self.get(url, token=self.admin_api_key)
+
+            self.app.config['AGGREGATE_FROM_ROLLUPS'] = True
+            rolled, s, v = self.get(url, token=self.admin_api_key)
+
+            self.assertEqual(s, 200)
+            self.assertEqual([x['timestamp'] for x in rolled['data']], [x['timestamp'] for x in raw['data']])
+
+            for a, b in zip(raw['data'], rolled['data']):
+                self.assertEqual(a['so2_count'], b['so2_count'])
+                self.assertEqual(a['so2_max'], b['so2_max'])
+                self.assertAlmostEqual(a['so2_mean'], b['so2_mean'])
+
+    def test_data_page_query_count(self):
+        from sqlalchemy import event
+
+        i = MIT.query.first()
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        try:
+            queries = []
+
+            # The first request warms the credentials and instrument caches
+            for per_page in (1, 1, 10):
+                del statements[:]
+
+                r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=per_page,
+                                    count='exact'), token=self.admin_api_key)
+
+                self.assertEqual(s, 200)
+                self.assertEqual(len(r['data']), per_page)
+
+                queries.append(len(statements))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        # The number of queries doesn't grow with the page size
+        self.assertEqual(queries[1], queries[2])
+        self.assertEqual(r['data'][0]['instrument'], i.get_url())
+
+    def test_conditional_get(self):
+        from sqlalchemy import event
+
+        i = MIT.query.first()
+        url = url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=10)
+
+        def get(**headers):
+            rv = self.client.get(url, headers=dict(self._get_headers(self.admin_api_key), **headers))
+            db.session.remove()
+
+            return rv
+
+        rv = get()
+        etag = rv.headers['ETag']
+        last_modified = rv.headers['Last-Modified']
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(etag.startswith('W/'))
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        try:
+            rv = get(**{'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        # Answered from the version alone, without touching the data table
+        self.assertEqual(rv.status_code, 304)
+        self.assertFalse([s for s in statements if MITData.__tablename__ in s])
+
+        rv = get(**{'If-Modified-Since': last_modified})
+        self.assertEqual(rv.status_code, 304)
+
+        # Any change to the readings changes the ETag
+        reading = MITData.query.filter_by(instr_sn=i.sn).first()
+        reading.co = -1.
+        db.session.commit()
+
+        rv = get(**{'If-None-Match': etag})
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+        # The latest reading is the one the ETag was built from, even if this
+        # worker's mirror is behind
+        latest = MITData.query.filter_by(instr_sn=i.sn).order_by(MITData.timestamp.desc()).first()
+        oldest = MITData.query.filter_by(instr_sn=i.sn).order_by(MITData.timestamp).first()
+
+        latest_readings._cache.set(i.sn, oldest.timestamp)
+
+        rv = self.client.get(url_for('api_1_0.get_most_recent_datapoint', sn=i.sn),
+                    headers=self._get_headers(self.admin_api_key))
+
+        self.assertEqual(json.loads(rv.get_data(as_text=True))['id'], latest.id)
+
+        # Aggregates only revalidate when their window is fixed
+        for end, status in ((None, 200), ('2100-01-01', 304)):
+            aggregate = url_for('api_1_0.get_aggregate_by_dev', sn=i.sn, end=end)
+
+            rv = self.client.get(aggregate, headers=self._get_headers(self.admin_api_key))
+            rv = self.client.get(aggregate, headers=dict(self._get_headers(self.admin_api_key),
+                        **{'If-None-Match': rv.headers['ETag'],
+                           'If-Modified-Since': rv.headers.get('Last-Modified') or last_modified}))
+
+            self.assertEqual(rv.status_code, status)
+
+        # Logs and devices are edited in place, which must change the ETag too
+        log = Log.create(dict(instr_sn=i.sn, message='Device Reset', level='INFO'))
+
+        db.session.add(log)
+        db.session.commit()
+
+        log_id, instr_id = log.id, i.id
+
+        def revalidate(url, change):
+            rv = self.client.get(url, headers=self._get_headers(self.admin_api_key))
+            etag = rv.headers['ETag']
+
+            rv = self.client.get(url, headers=dict(self._get_headers(self.admin_api_key),
+                        **{'If-None-Match': etag}))
+
+            self.assertEqual(rv.status_code, 304)
+
+            change()
+            db.session.commit()
+
+            rv = self.client.get(url, headers=dict(self._get_headers(self.admin_api_key),
+                        **{'If-None-Match': etag}))
+
+            self.assertEqual(rv.status_code, 200)
+            self.assertNotEqual(rv.headers['ETag'], etag)
+
+        def edit_log():
+            log = Log.query.get(log_id)
+            log.addressed = not log.addressed
+
+        def edit_device():
+            MIT.query.get(instr_id).location = 'Elsewhere'
+
+        revalidate(url_for('api_1_0.get_all_logs'), edit_log)
+        revalidate(url_for('api_1_0.get_logs_by_device', sn=i.sn), edit_log)
+        revalidate(url_for('api_1_0.get_devices'), edit_device)
+
+        self.assertEqual(Log.query.get(log_id).revision, 3)
+
+    def test_compressed_responses(self):
+        import gzip
+        from app.compression import compressor
+
+        i = MIT.query.first()
+        url = url_for('api_1_0.get_device', sn=i.sn)
+
+        def get(**headers):
+            rv = self.client.get(url, headers=dict(self._get_headers(self.admin_api_key), **headers))
+            db.session.remove()
+
+            return rv
+
+        plain = get()
+
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain.headers.get('Vary'))
+
+        compressor.min_size = 0
+        compressed = get(**{'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.get_data()), plain.get_data())
+
+        # The compressed representation has a weak ETag that still validates
+        self.assertEqual(compressed.headers['ETag'], 'W/' + plain.headers['ETag'])
+
+        rv = get(**{'Accept-Encoding': 'gzip', 'If-None-Match': compressed.headers['ETag']})
+
+        self.assertEqual(rv.status_code, 304)
+
+        # Nothing the client can't decode
+        rv = get(**{'Accept-Encoding': 'identity'})
+
+        self.assertIsNone(rv.headers.get('Content-Encoding'))
+
+    @unittest.skipIf(formats.msgpack is None, "msgpack is not installed")
+    def test_msgpack_responses(self):
+        import msgpack
+
+        i = TREX.query.first()
+        url = url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=5)
+
+        plain, s, v = self.get(url, token=self.admin_api_key)
+
+        rv = self.client.get(url, headers=dict(self._get_headers(self.admin_api_key),
+                                                Accept='application/msgpack'))
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(rv.get_data(), raw=False), plain)
+
+    def test_get_columnar_data(self):
+        i = TREX.query.first()
+        rows, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=5),
+                            token=self.admin_api_key)
+
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=5,
+                            format='columnar'), token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(r['meta']['format'], 'columnar')
+        self.assertEqual(r['meta']['units']['so2'], 'ppbv')
+        self.assertEqual(r['meta']['instrument'], i.get_url())
+        self.assertNotIn('so2_we', r['data'])
+
+        self.assertEqual(r['data']['id'], [x['id'] for x in rows['data']])
+        self.assertEqual(r['data']['timestamp'], [x['timestamp'] for x in rows['data']])
+        self.assertEqual(r['data']['so2'], [x['so2']['value'] for x in rows['data']])
+        self.assertIn('format=columnar', r['meta']['next_url'])
+
+        # Cursor pages as well
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=5, cursor='',
+                            format='columnar'), token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(len(r['data']['so2']), 5)
+
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, format='xml'),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 400)
+
+    def test_get_projected_data(self):
+        from sqlalchemy import event
+
+        i = MIT.query.first()
+        full, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=5),
+                            token=self.admin_api_key)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        try:
+            r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, per_page=5,
+                                fields='timestamp,pm25,rh'), token=self.admin_api_key)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(s, 200)
+        self.assertIn('fields=', r['meta']['first_url'])
+
+        for row, each in zip(r['data'], full['data']):
+            self.assertEqual(set(row), {'timestamp', 'pm25', 'rh'})
+            self.assertEqual(row['timestamp'], each['timestamp'])
+            self.assertEqual(row['pm25'], each['pm25'])
+            self.assertEqual(row['rh'], each['rh'])
+
+        # Only the columns asked for are selected
+        self.assertFalse([s for s in statements if 'mit_data.bin0' in s])
+
+        # Research fields need research privileges
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, fields='pm25,bin0'),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 400)
+
+        r, s, v = self.get(url_for('api_1_0.get_research_data_by_dev', sn=i.sn, fields='pm25,bin0'),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(set(r['data'][0]), {'pm25', 'bin0'})
+
+    def test_get_data_count_modes(self):
+        i = EBAM.query.first()
+        sn, n = i.sn, i.results.count()
+
+        # No count at all; whether there's a next page comes from the rows
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, count='none', per_page=1),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(r['meta']['count'], 'none')
+        self.assertNotIn('total', r['meta'])
+        self.assertNotIn('last_url', r['meta'])
+        self.assertEqual(r['meta']['next_url'] is not None, n > 1)
+
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, count='exact'),
+                            token=self.admin_api_key)
+
+        self.assertEqual(r['meta']['total'], n)
+
+        # The cached estimate follows new readings without recounting
+        data = {'timestamp': "2017-01-01 12:01:32", 'instr_sn': sn, 'conc_rt': 1.,
+                'conc_hr': 23., 'flow': 12., 'ws': 12, 'wd': 54, 'at': 12, 'rhx': 51,
+                'rhi': 12.3, 'bv_c': 12, 'ft_c': 12, 'alarm': 2}
+
+        r, s, v = self.post(url_for('api_1_0.data_post'), data=data)
+
+        self.assertEqual(s, 201)
+        self.assertEqual(row_counts.get((EBamData.__tablename__, sn, None)), n + 1)
+
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn),
+                            token=self.admin_api_key)
+
+        self.assertEqual(r['meta']['count'], 'estimate')
+        self.assertEqual(r['meta']['total'], n + 1)
+
+        # ?limit= caps the collection (and its total) without breaking the count
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, limit=3, per_page=2),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(r['meta']['total'], 3)
+        self.assertEqual(r['meta']['pages'], 2)
+        self.assertEqual(len(r['data']), 2)
+
+        r, s, v = self.get(r['meta']['next_url'], token=self.admin_api_key)
+
+        self.assertEqual(s, 200)
+        self.assertEqual(len(r['data']), 1)
+        self.assertIsNone(r['meta']['next_page'])
+
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, limit=-1),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 400)
+
+        r, s, v = self.get(url_for('api_1_0.get_data_by_dev', sn=sn, count='all'),
+                            token=self.admin_api_key)
+
+        self.assertEqual(s, 400)
+
     def test_get_data_user(self):
         u = User.query.get(2)
         i = u.devices.first()
@@ -605,6 +1370,46 @@ class CredentialsModelTestCase(unittest.TestCase):
 
         self.assertEqual(s, 200)
 
+        # The latest reading of that instrument, not of the whole table
+        m = i._get_data_model()
+        latest = m.query.filter(m.instr_sn == i.sn).order_by(m.timestamp.desc()).first()
+
+        self.assertEqual(r['id'], latest.id)
+
+    def test_get_latest_datapoints(self):
+        u = User.query.get(2)
+
+        r, s, v = self.get(url_for('api_1_0.get_latest_datapoints'), token=u.api_token)
+
+        self.assertEqual(s, 200)
+
+        # Only (and all of) the instruments the user can view
+        self.assertEqual(set(r['data']), {i.sn for i in u.following})
+        self.assertEqual(r['meta']['count'], len(r['data']))
+
+        for sn, reading in r['data'].items():
+            i = Instrument.query.filter_by(sn=sn).first()
+
+            if reading is not None:
+                self.assertEqual(reading['id'], i.most_recent_datapoint().id)
+
+        # ...or just the ones asked for
+        sns = sorted(r['data'])[:2]
+
+        r, s, v = self.get(url_for('api_1_0.get_latest_datapoints', sn=','.join(sns + ['NOT-A-DEVICE'])),
+                            token=u.api_token)
+
+        self.assertEqual(sorted(r['data']), sns)
+
+        # Instrument keys follow no one
+        r, s, v = self.get(url_for('api_1_0.get_latest_datapoints'))
+
+        self.assertEqual(s, 401)
+
+        r, s, v = self.get(url_for('api_1_0.get_latest_datapoints'), token='not-a-key')
+
+        self.assertEqual(s, 401)
+
     def test_update_old_datapoint(self):
         u = User.query.first()
         pt = TrexData.query.first()
@@ -715,6 +1520,72 @@ class CredentialsModelTestCase(unittest.TestCase):
         for each in data:
             self.assertNotEqual(each['city'], 'Delhi')
 
+    def test_filter_compiler(self):
+        i = MIT.query.first()
+        t = i.most_recent_datapoint().timestamp
+
+        def get(**kwargs):
+            return self.get(url_for('api_1_0.get_data_by_dev', sn=i.sn, **kwargs),
+                                token=self.admin_api_key)
+
+        # Values are coerced and the timestamp bounds become one range
+        spec = 'timestamp,ge,{};timestamp,le,{};pm25,ge,0.5'.format(
+                    (t - datetime.timedelta(days=7)).isoformat(), t.isoformat())
+
+        r, s, v = get(filter=spec, per_page=100)
+
+        self.assertEqual(s, 200)
+        for each in r['data']:
+            self.assertGreaterEqual(each['pm25']['value'], 0.5)
+
+        # Rejected: unknown columns and ops, bad values, unbounded scans and
+        # sorting on anything unindexed
+        for kwargs in ({'filter': 'nope,eq,1'}, {'filter': 'pm25,like,1'},
+                       {'filter': 'pm25,ge,high'}, {'filter': 'pm25,ge,0.5'},
+                       {'filter': 'timestamp,ge,2000-01-01;pm25,ge,0.5'},
+                       {'filter': 'bin7,ge,1'}, {'sort': 'bin7,desc'}):
+            r, s, v = get(**kwargs)
+
+            self.assertEqual(s, 400)
+
+    def test_filter_query_plans(self):
+        from app.api_1_0.decorators import _filter_query, _sort_query
+
+        i = MIT.query.first()
+
+        def explain(query):
+            compiled = query.statement.compile(dialect=db.engine.dialect)
+            params = [compiled.params[name] for name in compiled.positiontup]
+
+            rows = db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), *params)
+
+            return ' '.join(str(row[-1]) for row in rows)
+
+        base = MITData.query.filter_by(instr_sn=i.sn)
+
+        # Time ranges (including a bare date) search the reading index
+        for spec in ('timestamp,ge,2018-01-01;timestamp,lt,2018-01-08',
+                     'timestamp,eq,2018-01-01',
+                     'timestamp,ge,2018-01-01;timestamp,lt,2018-01-08;pm25,gt,10'):
+            plan = explain(_filter_query(MITData, base, spec))
+
+            self.assertIn('uq_mit_data_reading', plan)
+            self.assertIn('timestamp>', plan)
+            self.assertNotIn('SCAN', plan)
+
+        # ...and sorting by time reads it in order
+        plan = explain(_sort_query(MITData, _filter_query(MITData, base,
+                        'timestamp,ge,2018-01-01'), 'timestamp,desc'))
+
+        self.assertNotIn('TEMP B-TREE', plan)
+
+        # Every column logs can be sorted by is read in index order
+        for column in Log.sort_columns:
+            for order in ('asc', 'desc'):
+                plan = explain(_sort_query(Log, Log.query, '{},{}'.format(column, order)))
+
+                self.assertNotIn('TEMP B-TREE', plan)
+
     def test_sorting(self):
         u = User.query.get(1)
         token = u.api_token
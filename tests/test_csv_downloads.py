@@ -11,7 +11,7 @@ from io import StringIO
 from sqlalchemy.exc import IntegrityError
 import boto3
 from flask_login import login_user, logout_user, current_user
-from app import assets
+from app import assets, formats
 
 
 class CredentialsModelTestCase(unittest.TestCase):
@@ -250,3 +250,100 @@ class CredentialsModelTestCase(unittest.TestCase):
 
             for key in d.public_cols:
                 self.assertTrue(key in cols)
+
+    def test_streamed_download(self):
+        r = Role.query.filter_by(name='Administrator').first()
+        u = User.query.filter_by(role=r).first()
+        d = TREX.query.first()
+
+        resp = self.login_user(u)
+
+        rv = self.client.get(
+                url_for("api_1_0.download_csv",
+                        sn=d.sn, start="2000-01-01",
+                        end="2100-01-01"))
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.is_streamed)
+        self.assertIsNone(rv.headers.get('ETag'))
+
+        body = pd.read_csv(StringIO(rv.get_data(as_text=True)), sep=',')
+
+        # Every reading, oldest first, and only the permitted columns
+        self.assertEqual(len(body), d.results.count())
+        self.assertEqual(list(body['timestamp']), sorted(body['timestamp']))
+        self.assertEqual(set(body.columns) - {'timestamp', 'timestamp_local'}, set(d.private_cols))
+
+        # The file is the same however it is chunked
+        query = TrexData.query.filter_by(instr_sn=d.sn)
+        chunks = list(d.iter_csv(query, cols_to_keep=d.private_cols, chunksize=3))
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), ''.join(d.iter_csv(query, cols_to_keep=d.private_cols)))
+
+        # ...and laid out like df_from_query, with or without a timezone
+        for timezone in (None, 'US/Hawaii'):
+            d.timezone = timezone
+
+            df = d.df_from_query(query, cols_to_keep=d.private_cols)
+            body = pd.read_csv(StringIO(''.join(d.iter_csv(query, cols_to_keep=d.private_cols))))
+
+            self.assertEqual(list(body.columns), ['timestamp'] + list(df.columns))
+
+    @unittest.skipIf(formats.pyarrow is None, "pyarrow is not installed")
+    def test_binary_downloads(self):
+        from io import BytesIO
+        import pyarrow
+
+        r = Role.query.filter_by(name='Administrator').first()
+        u = User.query.filter_by(role=r).first()
+        d = TREX.query.first()
+
+        resp = self.login_user(u)
+
+        df = d.df_from_query(TrexData.query.filter_by(instr_sn=d.sn), cols_to_keep=d.private_cols)
+
+        for format in ('parquet', 'arrow'):
+            rv = self.client.get(url_for("api_1_0.download_csv", sn=d.sn, start="2000-01-01",
+                                    end="2100-01-01", format=format))
+
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.mimetype, formats.EXPORT_FORMATS[format])
+            self.assertIn('.' + format, rv.headers['Content-Disposition'])
+
+            if format == 'parquet':
+                body = pd.read_parquet(BytesIO(rv.get_data()))
+            else:
+                body = pyarrow.RecordBatchStreamReader(BytesIO(rv.get_data())).read_all().to_pandas()
+
+            # Typed columns, the same values as df_from_query
+            self.assertEqual(len(body), len(df))
+            self.assertEqual(str(body['timestamp'].dtype), 'datetime64[ns]')
+            self.assertEqual(str(body['so2'].dtype), 'float64')
+            self.assertEqual(list(body['timestamp']), list(df.index))
+
+        # Unknown formats are rejected
+        rv = self.client.get(url_for("api_1_0.download_csv", sn=d.sn, start="2000-01-01",
+                                end="2100-01-01", format='xls'))
+
+        self.assertEqual(rv.status_code, 400)
+
+    def test_compressed_download(self):
+        import gzip
+
+        r = Role.query.filter_by(name='Administrator').first()
+        u = User.query.filter_by(role=r).first()
+        d = TREX.query.first()
+
+        resp = self.login_user(u)
+
+        url = url_for("api_1_0.download_csv", sn=d.sn, start="2000-01-01", end="2100-01-01")
+
+        plain = self.client.get(url)
+        rv = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        # Streamed downloads are compressed as they're sent
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.is_streamed)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(rv.get_data()), plain.get_data())
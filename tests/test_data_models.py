@@ -128,6 +128,12 @@ class CredentialsModelTestCase(unittest.TestCase):
 
         #self.assertNotEqual(old_ts, pltly['timestamp'])
 
+        # A shared DeviceContext serializes exactly like the row's own instrument
+        device = DeviceContext.from_instrument(i)
+
+        self.assertEqual(new.to_json(researcher=True, device=device), new.to_json(researcher=True))
+        self.assertEqual(new._plotly(device=device), pltly)
+
         # Test get_url
         url = new.get_url()
 
@@ -223,6 +229,177 @@ class CredentialsModelTestCase(unittest.TestCase):
         # drop
         self.assertTrue(new.drop())
 
+    def test_webhook_parsers(self):
+        from app.parsers import parse_timestamp
+
+        # Strict ISO-8601 strings take the fast path and come back naive in UTC
+        self.assertEqual(parse_timestamp("2017-08-15T13:16:00Z"),
+                            datetime.datetime(2017, 8, 15, 13, 16))
+        self.assertEqual(parse_timestamp("2017-08-15T13:16:00.25"),
+                            datetime.datetime(2017, 8, 15, 13, 16, 0, 250000))
+        self.assertEqual(parse_timestamp("2017-08-15T13:16:00-04:00"),
+                            datetime.datetime(2017, 8, 15, 17, 16))
+
+        # ...anything else falls back to dateutil
+        self.assertEqual(parse_timestamp("Aug 15 2017 1:16PM"),
+                            datetime.datetime(2017, 8, 15, 13, 16))
+
+        with self.assertRaises(ValueError):
+            parse_timestamp("not a timestamp")
+
+        # MIT: bins and PM are divided by the number of samples (last value)
+        data = "2017-08-15T13:16:00Z,10,0,45.0,37.9,0.8,39.0,8549.5,9178.8,453.6,354.6,13.9,13.1,45.6,18.3,15.4,9.3,4.2,4.1,3.0,1.3,0.4,0.2,0.0,0.0,0.0,0.0,0.0,0.0,42.75,71.50,108.74,1.99,7.9,10.1,10.6,7.7,3.13,10"
+
+        result = MITData.from_webhook(data, sn='SN001')
+
+        self.assertEqual(result['instr_sn'], 'SN001')
+        self.assertEqual(result['cycles'], 10)
+        self.assertEqual(result['flag'], 0)
+        self.assertEqual(result['rh_i'], 45.0)
+        self.assertAlmostEqual(result['bin0'], 4.56)
+        self.assertAlmostEqual(result['pm25'], 7.15)
+        self.assertEqual(result['period'], 1.99)
+        self.assertEqual(result['sfr'], 3.13)
+
+        # Bad values are stored as None rather than rejecting the reading
+        result = TrexData.from_webhook("2017-08-05T14:00:35Z,nan,,100.0,125.0", sn='SN002')
+
+        self.assertIsNone(result['so2_we'])
+        self.assertIsNone(result['so2_ae'])
+        self.assertEqual(result['temp'], 125.0)
+        self.assertNotIn('flag', result)
+
+        result = TrexPMData.from_webhook("2017-08-05T14:00:35Z,45,20,1,2,3,4,5,6,7,8,9,1", sn='SN003')
+
+        self.assertEqual(result['pm25'], 2.)
+        self.assertEqual(result['bin5'], 9.)
+        self.assertTrue(result['flag'])
+
+        result = Data.from_webhook("2017-08-11T04:44:30Z,108.72,o3,ppb,0", sn='SN004')
+
+        self.assertEqual(result['parameter'], 'o3')
+        self.assertEqual(result['unit'], 'ppb')
+        self.assertEqual(result['value'], 108.72)
+
+        # Missing required fields raise
+        with self.assertRaises(IndexError):
+            Data.from_webhook("2017-08-11T04:44:30Z,108.72", sn='SN004')
+
+    def test_unique_readings(self):
+        from app.ingest import dedupe_readings, insert_rows
+
+        i = TREX.query.first()
+        ts = datetime.datetime(2017, 1, 1, 12)
+
+        db.session.add(TrexData.create(dict(timestamp=ts, instr_sn=i.sn, so2_we=1.)))
+        db.session.commit()
+
+        # The same reading can't be stored twice...
+        with self.assertRaises(IntegrityError):
+            db.session.add(TrexData.create(dict(timestamp=ts, instr_sn=i.sn, so2_we=2.)))
+            db.session.commit()
+
+        db.session.rollback()
+
+        # ...and bulk inserts skip repeats instead of failing
+        rows = [dict(timestamp=ts, instr_sn=i.sn, so2_we=2.),
+                dict(timestamp=ts + datetime.timedelta(minutes=1), instr_sn=i.sn),
+                dict(timestamp=ts + datetime.timedelta(minutes=1), instr_sn=i.sn)]
+
+        self.assertEqual(insert_rows(TrexData, rows), 1)
+        db.session.commit()
+
+        self.assertEqual(TrexData.query.filter_by(instr_sn=i.sn, timestamp=ts).one().so2_we, 1.)
+
+        # Repeats that get past the lookup (another worker wrote them in the
+        # meantime) are skipped by the database and not counted
+        from app import ingest
+
+        key = (TrexData.__tablename__, i.sn, None)
+        row_counts.set(key, 10)
+
+        lookup, ingest.new_rows = ingest.new_rows, lambda model, rows, bind=None: rows
+        try:
+            self.assertEqual(insert_rows(TrexData, [dict(timestamp=ts, instr_sn=i.sn),
+                        dict(timestamp=ts + datetime.timedelta(minutes=2), instr_sn=i.sn)]), 1)
+        finally:
+            ingest.new_rows = lookup
+
+        db.session.commit()
+
+        self.assertEqual(row_counts.get(key), 11)
+
+        self.assertEqual(dedupe_readings(TrexData, dry_run=True), 0)
+        self.assertEqual(dedupe_readings(TrexData), 0)
+
+    def test_rollups(self):
+        from app.aggregation import rebuild_rollups
+        from app.ingest import insert_rows
+
+        i = TREX.query.first()
+
+        def totals(freq):
+            rollups = Rollup.query.filter_by(instr_sn=i.sn, freq=freq, field='so2').all()
+
+            return sum(r.count for r in rollups), max(r.max for r in rollups)
+
+        # Readings are rolled up as they're stored...
+        readings = i.results.all()
+        expected = (len(readings), max(r.so2 for r in readings))
+
+        self.assertEqual(totals(3600), expected)
+        self.assertEqual(totals(86400), expected)
+
+        # ...through the bulk insert as well...
+        ts = datetime.datetime(2017, 1, 1, 12)
+
+        self.assertEqual(insert_rows(TrexData, [dict(timestamp=ts, instr_sn=i.sn, so2=1e6)]), 1)
+        db.session.commit()
+
+        self.assertEqual(totals(86400), (len(readings) + 1, 1e6))
+
+        # ...and dropped with them
+        TrexData.query.filter_by(instr_sn=i.sn, timestamp=ts).one().drop()
+
+        self.assertEqual(totals(3600), expected)
+        self.assertEqual(totals(86400), expected)
+
+        # Backfills start from scratch
+        Rollup.query.filter_by(instr_sn=i.sn).delete()
+        db.session.commit()
+
+        self.assertTrue(rebuild_rollups(i) > 0)
+        self.assertEqual(totals(3600), expected)
+        self.assertEqual(totals(86400), expected)
+
+    def test_rollup_retries(self):
+        from app import aggregation
+
+        hour = datetime.datetime(2017, 1, 1, 12)
+        done = []
+
+        def refresh(model, sn, timestamps, bind=None):
+            if sn == 'B':
+                raise RuntimeError("database went away")
+
+            done.append(sn)
+
+            return len(timestamps)
+
+        tracker = aggregation.RollupTracker(interval=60)
+        tracker._pending = {(TrexData, sn): {hour} for sn in 'ABC'}
+
+        # Only the instrument that failed and the ones after it are retried
+        refresh_rollups, aggregation.refresh_rollups = aggregation.refresh_rollups, refresh
+        try:
+            with self.assertRaises(RuntimeError):
+                tracker.flush()
+        finally:
+            aggregation.refresh_rollups = refresh_rollups
+
+        self.assertEqual(done, ['A'])
+        self.assertEqual(set(tracker.pending()), {(TrexData, 'B'), (TrexData, 'C')})
+
     def test_make_group(self):
         g = Group('Trex2017')
 
@@ -516,6 +516,164 @@ class CredentialsModelTestCase(unittest.TestCase):
 
         self.assertNotEqual(last, i.last_updated)
 
+    def test_df_from_query(self):
+        i = TREX.query.first()
+        i.timezone = 'Asia/Kolkata'
+
+        db.session.add(i)
+        db.session.commit()
+
+        query = TrexData.query.filter_by(instr_sn=i.sn).order_by(TrexData.id.desc())
+
+        df = i.df_from_query(query, cols_to_keep=i.public_cols)
+
+        # Sorted in SQL, pruned to the kept columns and local time first
+        self.assertEqual(len(df), i.results.count())
+        self.assertTrue(df.index.is_monotonic_increasing)
+        self.assertEqual(list(df.columns), ['timestamp_local', 'so2', 'temp', 'rh', 'flag', 'instr_sn'])
+
+        for ts, local in zip(df.index, df['timestamp_local']):
+            self.assertEqual(local.to_pydatetime(), to_timezone(ts.to_pydatetime(), i.timezone,
+                                replace=True, isoformat=False))
+
+    def test_heartbeats(self):
+        i, j = TREX.query.first(), MIT.query.first()
+
+        t0 = datetime.datetime(2018, 1, 1)
+        t1 = datetime.datetime(2018, 1, 2)
+
+        tracker = HeartbeatTracker()
+        tracker.configure(self.app, interval=3600)
+
+        # Heartbeats are coalesced in memory, keeping the latest per instrument
+        tracker.beat([i.id, j.id], timestamp=t0)
+        tracker.beat([i.id], timestamp=t1)
+        tracker.beat([i.id], timestamp=t0)
+
+        self.assertEqual(tracker.pending(), {i.id: t1, j.id: t0})
+
+        # ...and written back with a single UPDATE
+        self.assertEqual(tracker.flush(db.session), 2)
+        self.assertEqual(tracker.pending(), {})
+
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(TREX.query.get(i.id).last_updated, t1)
+        self.assertEqual(MIT.query.get(j.id).last_updated, t0)
+
+        # Without an interval they're written straight away
+        tracker.configure(self.app, interval=0)
+        tracker.beat([i.id], timestamp=t0)
+
+        self.assertEqual(tracker.pending(), {})
+
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(TREX.query.get(i.id).last_updated, t0)
+
+    def test_latest_readings(self):
+        from app.ingest import insert_rows
+
+        i = MIT.query.first()
+
+        def slow():
+            return MITData.query.filter(MITData.instr_sn == i.sn) \
+                        .order_by(MITData.timestamp.desc()).first()
+
+        self.assertEqual(i.most_recent_datapoint().id, slow().id)
+        self.assertEqual(LatestReading.query.get(i.sn).timestamp, slow().timestamp)
+
+        # Bulk inserts move the pointer forward, older readings don't
+        newest = slow().timestamp + datetime.timedelta(hours=1)
+
+        insert_rows(MITData, [
+            {'instr_sn': i.sn, 'timestamp': newest, 'co': 1.},
+            {'instr_sn': i.sn, 'timestamp': newest - datetime.timedelta(days=365), 'co': 2.}])
+        db.session.commit()
+
+        self.assertEqual(LatestReading.query.get(i.sn).timestamp, newest)
+        self.assertEqual(i.most_recent_datapoint().co, 1.)
+        self.assertEqual(latest_readings.timestamp(i.sn), newest)
+
+        # Every change moves the version on
+        version = latest_readings.version(i.sn, MITData)
+
+        reading = i.most_recent_datapoint()
+        reading.co = 3.
+        db.session.commit()
+
+        self.assertNotEqual(latest_readings.version(i.sn, MITData), version)
+
+        # Deleting the latest reading falls back to the data table
+        db.session.delete(i.most_recent_datapoint())
+        db.session.commit()
+
+        self.assertIsNone(LatestReading.query.get(i.sn).timestamp)
+        self.assertEqual(i.most_recent_datapoint().id, slow().id)
+
+    def test_instrument_directory(self):
+        i = TREX.query.first()
+
+        d = instrument_directory.get(particle_id=i.particle_id)
+
+        self.assertEqual(d.sn, i.sn)
+        self.assertEqual(d.id, i.id)
+        self.assertIs(d.data_model, TrexData)
+        self.assertIs(d.instrument_class, TREX)
+        self.assertEqual(d.model_ids, {'so2': None})
+
+        # Subsequent lookups by any key are served from memory
+        self.assertIs(instrument_directory.get(sn=i.sn), d)
+        self.assertIs(instrument_directory.get(id=i.id), d)
+
+        # Heartbeats don't invalidate the descriptor
+        i.update()
+        db.session.commit()
+
+        self.assertIs(instrument_directory.get(sn=i.sn), d)
+
+        # ...but changes to the instrument do
+        i.timezone = 'US/Hawaii'
+
+        db.session.add(i)
+        db.session.commit()
+
+        self.assertEqual(instrument_directory.get(sn=i.sn).timezone, 'US/Hawaii')
+
+        # Permission changes made elsewhere (another worker) reach access()
+        # right away, while get() keeps serving the descriptor until the ttl
+        g = Group('Directory')
+
+        db.session.add(g)
+        db.session.commit()
+
+        db.session.execute(Instrument.__table__.update().where(
+                    Instrument.__table__.c.id == i.id).values(group_id=g.id, private=True))
+        db.session.commit()
+
+        self.assertIsNone(instrument_directory.get(sn=i.sn).group_id)
+        self.assertEqual(instrument_directory.access(i.sn).group_id, g.id)
+        self.assertTrue(instrument_directory.access(i.sn).private)
+        self.assertIsNone(instrument_directory.access('NOT-A-DEVICE'))
+
+        # Unknown and deleted instruments resolve to None; misses are
+        # remembered until an instrument is added
+        self.assertIsNone(instrument_directory.get(sn='NOT-A-DEVICE'))
+        self.assertIn(('sn', 'NOT-A-DEVICE'), instrument_directory._missing)
+
+        db.session.add(TREX.create(dict(sn='NOT-A-DEVICE', location='CP', city='Delhi',
+                    country='IN', private=False)))
+        db.session.commit()
+
+        self.assertEqual(instrument_directory.get(sn='NOT-A-DEVICE').sn, 'NOT-A-DEVICE')
+
+        sn = i.sn
+        i.drop()
+
+        self.assertIsNone(instrument_directory.get(sn=sn))
+
     def test_orphan_evaluate(self):
         i = Orphan.query.first()
 
@@ -577,6 +735,14 @@ class CredentialsModelTestCase(unittest.TestCase):
 
         self.assertIsNotNone(m.load_from_file())
 
+        # The model is only unpickled once per worker
+        self.assertIs(m.load_from_file(), model_registry.get(m.id))
+
+        cached = model_registry.get(m.id)
+        model_registry.invalidate(filename=m.filename)
+
+        self.assertIsNot(model_registry.get(m.id), cached)
+
         pt = dict(
                 timestamp=datetime.datetime.utcnow(),
                 instr_sn=i.sn,
@@ -602,12 +768,61 @@ class CredentialsModelTestCase(unittest.TestCase):
         self.assertEqual(new_pt.rh, pt['rh'])
         self.assertIsNotNone(new_pt.so2)
 
+    def test_trex_recalibrate(self):
+        i = TREX.query.first()
+
+        i.fakedata(n=25)
+
+        # Nothing to do without a model
+        self.assertEqual(i.recalibrate(), 0)
+
+        # ...or if the model it points at is gone
+        i.so2_model_id = (db.session.query(db.func.max(Model.id)).scalar() or 0) + 1
+
+        db.session.add(i)
+        db.session.commit()
+
+        self.assertIsNone(model_registry.get(i.so2_model_id))
+        self.assertEqual(i.recalibrate(), 0)
+
+        m = Model(filename="trex001_hybrid_20171214202354.sav", label='trex001-hybrid-model')
+
+        db.session.add(m)
+        db.session.commit()
+
+        i.so2_model = m
+
+        db.session.add(i)
+        db.session.commit()
+
+        n = i.results.count()
+
+        # Small chunks to make sure every chunk is picked up
+        self.assertEqual(i.recalibrate(chunksize=10), n)
+
+        for pt in i.results.all():
+            self.assertEqual(pt.model_id, m.id)
+            self.assertIsNotNone(pt.so2)
+
+        # Recalibrated values match what ingest computes for the same reading
+        pt = i.results.first()
+        data = i.evaluate(dict(timestamp=pt.timestamp, instr_sn=i.sn, so2_we=pt.so2_we,
+                    so2_ae=pt.so2_ae, temp=pt.temp, rh=pt.rh))
+
+        self.assertAlmostEqual(pt.so2, data['so2'])
+
+        # Restricting the time range
+        t0 = i.results.order_by(TrexData.timestamp.desc()).first().timestamp
+
+        self.assertEqual(i.recalibrate(t0=t0), 1)
+
     def test_trexpm_evaluate(self):
         i = TrexPM.query.first()
 
         self.assertIsNone(i.pm_model)
 
-        self.assertIsNone(i.evaluate(dict()))
+        # Without a model the reading passes through untouched
+        self.assertEqual(i.evaluate(dict(pm25=12.1)), dict(pm25=12.1))
 
 
     def test_mit_evaluate(self):